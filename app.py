@@ -1,5 +1,6 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import sqlite3
 import hashlib
@@ -9,20 +10,53 @@ import os
 import time
 import tempfile
 import unicodedata
+import functools
+import sys
+import threading
+import multiprocessing
+import queue
+import csv
+import json
+import pickle
+import codecs
+import mmap
+import zlib
+import zipfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FuturesTimeout
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta, timezone
-from collections import Counter # Necessário para o Backfilling
+from collections import Counter, OrderedDict # Counter: contagens (falhas, separadores) | OrderedDict: cache LRU
+import pot_workers  # entrada dos processos filhos (run_process_pool)
 
 # Tenta importar bibliotecas externas opcionais
 try:
-    import matplotlib.pyplot as plt
+    # Sem pyplot: o gráfico do relatório é desenhado na thread da tarefa, sem estado global
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 except ImportError:
-    plt = None
+    Figure = None
 
 try:
     from fpdf import FPDF
 except ImportError:
     FPDF = None
 
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    import chardet
+except ImportError:
+    chardet = None
+
 # ===========================================
 # CONFIGURAÇÃO INICIAL E ESTILOS
 # ===========================================
@@ -128,6 +162,8 @@ def render_header():
 # ===========================================
 
 DB_FILE = 'pot_system.db'
+# Tarefas em segundo plano escrevem em paralelo às sessões: espera o lock em vez de falhar
+DB_BUSY_TIMEOUT = 30
 
 def init_db():
     conn = sqlite3.connect(DB_FILE, check_same_thread=False)
@@ -166,13 +202,6 @@ def init_db():
         )
     ''')
     
-    try:
-        c.execute("ALTER TABLE payments ADD COLUMN competencia TEXT")
-        c.execute("ALTER TABLE payments ADD COLUMN mes_ref TEXT") # Garantir existencia
-        c.execute("ALTER TABLE payments ADD COLUMN ano_ref TEXT") # Garantir existencia
-    except sqlite3.OperationalError:
-        pass 
-
     c.execute('''
         CREATE TABLE IF NOT EXISTS bank_discrepancies (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -207,10 +236,242 @@ def init_db():
                   ('admin@prefeitura.sp.gov.br', default_pass, 'admin_ti', 'Administrador TI', 0))
     
     conn.commit()
+    
+    # WAL: leituras das sessões não bloqueiam durante uploads (persistente no arquivo)
+    conn.execute("PRAGMA journal_mode=WAL")
+    apply_migrations(conn)
     conn.close()
 
+# ===========================================
+# MIGRAÇÕES DE ESQUEMA (VERSIONADAS)
+# ===========================================
+
+def add_missing_columns(conn, table, columns):
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for name, col_type in columns:
+        if name not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {name} {col_type}")
+
+def migration_payments_competencia(conn):
+    add_missing_columns(conn, 'payments', [('competencia', 'TEXT'), ('mes_ref', 'TEXT'), ('ano_ref', 'TEXT')])
+
+def migration_payment_keys(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payment_keys (
+            cpf_clean TEXT NOT NULL,
+            card_clean TEXT NOT NULL,
+            qtd_registros INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (cpf_clean, card_clean)
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payment_keys_card ON payment_keys (card_clean)")
+    rebuild_key_index(conn)
+
+def migration_payments_rollup(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS payments_rollup (
+            competencia TEXT,
+            programa TEXT,
+            gerenciadora TEXT,
+            valor_total REAL NOT NULL DEFAULT 0,
+            qtd_registros INTEGER NOT NULL DEFAULT 0,
+            qtd_beneficiarios INTEGER NOT NULL DEFAULT 0,
+            primeiro_id INTEGER
+        )
+    ''')
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_rollup_competencia ON payments_rollup (competencia)")
+    conn.execute("CREATE TABLE IF NOT EXISTS payments_rollup_cards (num_cartao TEXT PRIMARY KEY, qtd_registros INTEGER NOT NULL)")
+    rebuild_rollup(conn)
+
+def migration_payments_aba_origem(conn):
+    add_missing_columns(conn, 'payments', [('aba_origem', 'TEXT')])
+
+def migration_payments_typed(conn):
+    """Alinha o histórico ao PAYMENT_SCHEMA: zeros à esquerda no CPF e datas DD/MM/AAAA em ISO"""
+    conn.execute("""
+        UPDATE payments SET cpf = substr('00' || cpf, -11)
+        WHERE length(cpf) IN (9, 10) AND cpf NOT GLOB '*[^0-9]*'
+    """)
+    conn.execute("""
+        UPDATE payments SET data_pagto = substr(data_pagto, 7, 4) || '-' || substr(data_pagto, 4, 2) || '-' || substr(data_pagto, 1, 2)
+        WHERE data_pagto GLOB '[0-9][0-9]/[0-9][0-9]/[0-9][0-9][0-9][0-9]'
+    """)
+    conn.execute("""
+        UPDATE payments SET data_pagto = substr(data_pagto, 1, 10)
+        WHERE data_pagto GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9] *'
+    """)
+    rebuild_key_index(conn)
+    bump_generation(conn)
+
+def backfill_match_keys(conn, table, sources, batch_rows=200000):
+    """Preenche as chaves de table em lotes por id, com o mesmo cálculo vetorizado do upload"""
+    src_cols = ', '.join(sources.values())
+    last_id = 0
+    while True:
+        chunk = pd.read_sql(f"SELECT id, {src_cols} FROM {table} WHERE id > ? ORDER BY id LIMIT ?",
+                            conn, params=(last_id, batch_rows))
+        if chunk.empty: break
+        keys = add_match_keys(chunk, sources)
+        conn.executemany(f"UPDATE {table} SET card_key = ?, cpf_key = ?, nome_key = ? WHERE id = ?",
+                         keys[MATCH_KEY_COLUMNS + ['id']].itertuples(index=False, name=None))
+        last_id = int(chunk['id'].iloc[-1])
+
+def migration_match_keys(conn):
+    key_cols = [(c, 'TEXT') for c in MATCH_KEY_COLUMNS]
+    add_missing_columns(conn, 'payments', key_cols)
+    add_missing_columns(conn, 'bank_discrepancies', key_cols)
+    backfill_match_keys(conn, 'payments', PAYMENT_KEY_SOURCES)
+    backfill_match_keys(conn, 'bank_discrepancies', BANK_KEY_SOURCES)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_card_key ON payments (card_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_payments_cpf_key ON payments (cpf_key)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_bank_disc_card_key ON bank_discrepancies (card_key)")
+    rebuild_key_index(conn)
+    bump_generation(conn)
+
+def migration_bank_runs(conn):
+    """Livro de conferências por hash do arquivo e uma divergência por (cartão, tipo, arquivo)"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS bank_reconciliation_runs (
+            hash_conteudo TEXT PRIMARY KEY,
+            arquivo TEXT,
+            tipo_arquivo TEXT,
+            qtd_registros INTEGER NOT NULL DEFAULT 0,
+            qtd_divergencias INTEGER NOT NULL DEFAULT 0,
+            processado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    # Cruzamentos repetidos deixaram cópias: fica a mais recente de cada divergência
+    conn.execute("""
+        DELETE FROM bank_discrepancies WHERE id NOT IN (
+            SELECT MAX(id) FROM bank_discrepancies GROUP BY cartao, tipo_erro, arquivo_origem
+        )
+    """)
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_bank_disc_unique ON bank_discrepancies (cartao, tipo_erro, arquivo_origem)")
+    bump_generation(conn)
+
+def migration_backfill_scope(conn):
+    conn.execute(f"CREATE INDEX IF NOT EXISTS idx_payments_backfill ON payments (competencia, id) WHERE {BACKFILL_PENDING_SQL}")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+            escopo TEXT PRIMARY KEY,
+            ultimo_id INTEGER NOT NULL DEFAULT 0,
+            atualizados INTEGER NOT NULL DEFAULT 0,
+            cpfs INTEGER NOT NULL DEFAULT 0,
+            rgs INTEGER NOT NULL DEFAULT 0,
+            atualizado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+def migration_jobs(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            tipo TEXT NOT NULL,
+            usuario TEXT,
+            descricao TEXT,
+            status TEXT NOT NULL,
+            progresso REAL NOT NULL DEFAULT 0,
+            mensagem TEXT,
+            avisos TEXT,
+            erro TEXT,
+            resultado BLOB,
+            criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            iniciado_em TIMESTAMP,
+            finalizado_em TIMESTAMP
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_usuario_tipo ON jobs (usuario, tipo, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+
+SNAPSHOT_DELETE_TRIGGER = """
+    CREATE TRIGGER IF NOT EXISTS trg_payments_snapshot_delete AFTER DELETE ON payments
+    BEGIN INSERT INTO payments_snapshot_dirty (id) VALUES (OLD.id); END
+"""
+
+def migration_snapshot_dirty(conn):
+    """Marca cada linha alterada ou excluída de payments, para o snapshot colunar se atualizar por partes"""
+    # AUTOINCREMENT: seq nunca é reaproveitado, nem depois de esvaziar a tabela
+    conn.execute("CREATE TABLE IF NOT EXISTS payments_snapshot_dirty (seq INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER NOT NULL)")
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_payments_snapshot_update AFTER UPDATE ON payments
+        BEGIN INSERT INTO payments_snapshot_dirty (id) VALUES (OLD.id); END
+    """)
+    conn.execute(SNAPSHOT_DELETE_TRIGGER)
+
+# Ordem importa: cada entrada roda uma única vez e fica registrada em schema_version
+SCHEMA_MIGRATIONS = [
+    (1, "Colunas competencia, mes_ref e ano_ref em payments", migration_payments_competencia),
+    (2, "Índice persistente CPF <-> Cartão", migration_payment_keys),
+    (3, "Índices de consulta em payments e bank_discrepancies", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_arquivo ON payments (arquivo_origem)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_competencia ON payments (competencia)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_num_cartao ON payments (num_cartao)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_cpf ON payments (cpf)",
+        "CREATE INDEX IF NOT EXISTS idx_bank_disc_cartao ON bank_discrepancies (cartao)",
+    ]),
+    (4, "Índice para a lista de anos de referência", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_ano_ref ON payments (ano_ref)",
+    ]),
+    (5, "Contador de geração para o cache de consultas", [
+        "CREATE TABLE IF NOT EXISTS db_meta (chave TEXT PRIMARY KEY, valor INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO db_meta (chave, valor) VALUES ('generation', 0)",
+    ]),
+    (6, "Rollup do Dashboard Executivo", migration_payments_rollup),
+    (7, "Coluna aba_origem (planilhas com várias abas)", migration_payments_aba_origem),
+    (8, "CPF com 11 dígitos e data_pagto em AAAA-MM-DD", migration_payments_typed),
+    (9, "Chaves de comparação gravadas (cartão, CPF, nome)", migration_match_keys),
+    (10, "Livro de conferências bancárias e divergências únicas", migration_bank_runs),
+    (11, "Índice parcial de CPF/RG incompletos e checkpoints do backfilling", migration_backfill_scope),
+    (12, "Tabela de tarefas em segundo plano", migration_jobs),
+    (13, "Marcas de alteração para o snapshot colunar de payments", migration_snapshot_dirty),
+]
+
+def get_schema_version(conn):
+    return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+def apply_migrations(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            descricao TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    if get_schema_version(conn) >= SCHEMA_MIGRATIONS[-1][0]: return
+    
+    for version, descricao, steps in SCHEMA_MIGRATIONS:
+        # BEGIN IMMEDIATE serializa sessões concorrentes; a versão é relida já com o lock
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            if callable(steps): steps(conn)
+            else:
+                for stmt in steps: conn.execute(stmt)
+            conn.execute("INSERT INTO schema_version (version, descricao) VALUES (?, ?)", (version, descricao))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
 def get_db_connection():
-    return sqlite3.connect(DB_FILE, check_same_thread=False)
+    return sqlite3.connect(DB_FILE, check_same_thread=False, timeout=DB_BUSY_TIMEOUT)
+
+def get_db_generation(conn=None):
+    """Contador de escrita: muda a cada gravação que altera payments ou bank_discrepancies"""
+    own = conn is None
+    if own: conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT valor FROM db_meta WHERE chave = 'generation'").fetchone()
+        return row[0] if row else 0
+    finally:
+        if own: conn.close()
+
+def bump_generation(conn):
+    """Invalida o cache de consultas; rodar dentro da transação de escrita (commit fica com o chamador)"""
+    conn.execute("UPDATE db_meta SET valor = valor + 1 WHERE chave = 'generation'")
 
 def log_action(user_email, action, details):
     try:
@@ -222,6 +483,685 @@ def log_action(user_email, action, details):
     except Exception as e:
         print(f"Erro ao logar: {e}")
 
+# ===========================================
+# CACHE DE CONSULTAS (LRU POR GERAÇÃO)
+# ===========================================
+
+QUERY_CACHE_MAX_MB = 256
+
+def estimate_size(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sys.getsizeof(v) for v in value.values())
+    return sys.getsizeof(value)
+
+def cache_copy(value):
+    """Cópia rasa para que a página não altere o objeto guardado no cache"""
+    if isinstance(value, pd.DataFrame): return value.copy(deep=False)
+    if isinstance(value, list): return list(value)
+    if isinstance(value, dict): return dict(value)
+    return value
+
+class QueryCache:
+    """
+    LRU limitado em bytes; entradas de gerações anteriores são descartadas quando chega uma
+    geração mais nova. Um leitor lento que começou antes de uma escrita (geração mais velha)
+    não é servido pelo cache nem grava nele.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.generation = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def _sync_generation(self, generation):
+        """False se generation é mais velha que a do cache (resultado desatualizado)"""
+        if self.generation is not None and generation < self.generation: return False
+        if generation != self.generation:
+            self.entries.clear()
+            self.bytes = 0
+            self.generation = generation
+        return True
+
+    def get(self, key, generation):
+        with self.lock:
+            if self._sync_generation(generation) and key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return True, self.entries[key][0]
+            self.misses += 1
+            return False, None
+
+    def put(self, key, generation, value):
+        size = estimate_size(value)
+        with self.lock:
+            if not self._sync_generation(generation) or size > self.max_bytes: return
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, old_size) = self.entries.popitem(last=False)
+                self.bytes -= old_size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'geracao': self.generation, 'entradas': len(self.entries), 'memoria_mb': self.bytes / 1024 ** 2,
+                'limite_mb': self.max_bytes / 1024 ** 2, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0, 'evictions': self.evictions,
+            }
+
+@st.cache_resource
+def get_query_cache():
+    # Um único cache por processo, compartilhado entre sessões e reruns
+    return QueryCache(QUERY_CACHE_MAX_MB * 1024 ** 2)
+
+def cached_query(func):
+    @functools.wraps(func)
+    def wrapper(*args):
+        key = (func.__name__,) + tuple(tuple(a) if isinstance(a, list) else a for a in args)
+        cache = get_query_cache()
+        generation = get_db_generation()
+        hit, value = cache.get(key, generation)
+        if not hit:
+            value = func(*args)
+            cache.put(key, generation, value)
+        return cache_copy(value)
+    return wrapper
+
+# ===========================================
+# CACHE DE ARTEFATOS (RELATÓRIOS PRONTOS)
+# ===========================================
+# PDFs gerados ficam guardados pelo tipo do relatório e por um hash dos dados de entrada:
+# baixar de novo um relatório cujos dados não mudaram não gera nada. LRU limitado em bytes.
+
+ARTIFACT_CACHE_MAX_MB = 64
+ARTIFACT_CACHE_MAX_FILES = 6   # exportações em arquivo temporário (podem estar em disco)
+
+class ArtifactCache:
+    """
+    LRU de artefatos por chave: bytes ou arquivo temporário (exportações grandes). O limite
+    em bytes conta só o que está em memória; arquivos contam também em max_files e são
+    fechados (apagados) ao sair do cache.
+    """
+    def __init__(self, max_bytes, max_files):
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.files = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Conteúdo em bytes (arquivos são lidos do início) ou None"""
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            data = self.entries[key][0]
+            if isinstance(data, bytes): return data
+            data.seek(0)
+            return data.read()
+
+    def has(self, key):
+        """Se a chave está no cache, sem ler o conteúdo nem contar hit/miss"""
+        with self.lock:
+            return key in self.entries
+
+    def _drop(self, key):
+        data, size = self.entries.pop(key)
+        self.bytes -= size
+        if not isinstance(data, bytes):
+            self.files -= 1
+            data.close()
+
+    def put(self, key, data, size=None):
+        """size: bytes em memória (padrão len(data)); arquivo já despejado em disco passa 0"""
+        size = len(data) if size is None else size
+        with self.lock:
+            if size > self.max_bytes:
+                if not isinstance(data, bytes): data.close()
+                return
+            if key in self.entries: self._drop(key)
+            self.entries[key] = (data, size)
+            self.bytes += size
+            if not isinstance(data, bytes): self.files += 1
+            while self.bytes > self.max_bytes or self.files > self.max_files:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries): self._drop(key)
+
+    def stats(self):
+        with self.lock:
+            return {'entradas': len(self.entries), 'arquivos': self.files, 'memoria_mb': self.bytes / 1024 ** 2,
+                    'limite_mb': self.max_bytes / 1024 ** 2, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+@st.cache_resource
+def get_artifact_cache():
+    return ArtifactCache(ARTIFACT_CACHE_MAX_MB * 1024 ** 2, ARTIFACT_CACHE_MAX_FILES)
+
+def data_fingerprint(df):
+    """SHA-256 das colunas e dos valores do DataFrame (hash vetorizado por linha)"""
+    h = hashlib.sha256(repr(list(df.columns)).encode())
+    h.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return h.hexdigest()
+
+def build_artifact(cache, tipo, df, build):
+    """Artefato do cache ou, na falta, build(df), guardado se saiu em bytes"""
+    key = (tipo, data_fingerprint(df))
+    data = cache.get(key)
+    if data is None:
+        data = build(df)
+        if isinstance(data, bytes): cache.put(key, data)
+    return data
+
+def artifact_download(container, tipo, df, build, label, file_name, mime, version=None):
+    """
+    Download de relatório gerado só quando pedido: com o artefato no cache o botão já
+    baixa; senão "Gerar" monta o arquivo e o download aparece em seguida. version: marca
+    barata dos dados (ex.: geração da base); sem ela a chave é o hash de df inteiro.
+    """
+    cache = get_artifact_cache()
+    key = (tipo, data_fingerprint(df) if version is None else ('versao', version))
+    data = cache.get(key)
+    if data is None:
+        if not container.button(f"⚙️ Gerar {label}", key=f"gerar_{tipo}"): return
+        with st.spinner("Gerando relatório..."):
+            data = build(df)
+        if not isinstance(data, bytes):
+            container.error(data)  # build devolve a mensagem de erro em texto
+            return
+        cache.put(key, data)
+    container.download_button(f"⬇️ Baixar {label}", data, file_name, mime, key=f"baixar_{tipo}")
+
+# ===========================================
+# SNAPSHOT COLUNAR DE PAYMENTS (NPY + MMAP)
+# ===========================================
+# Cópia de payments em um .npy por coluna, aberto com mmap_mode='r': as sessões (e as
+# tarefas) leem as mesmas páginas do cache do sistema em vez de remontar o DataFrame linha a
+# linha do SQLite. Texto vai por dicionário em cada segmento (códigos int32, -1 = NULL, e os
+# valores distintos); números vão crus. Segmentos são imutáveis: depois de uma escrita, as
+# linhas novas e as alteradas/excluídas (marcadas por gatilho em payments_snapshot_dirty)
+# viram um segmento novo, que substitui as versões anteriores dessas linhas. Com segmentos
+# demais a cópia é refeita inteira; exclusões em massa (arquivo inteiro, RESET TOTAL) não
+# marcam linha a linha e também levam à reconstrução. O manifesto (atual.json) é trocado com
+# os.replace. A atualização roda numa thread depois de cada escrita (request_snapshot_refresh);
+# enquanto o snapshot não chega à geração atual da base, as consultas voltam ao SQLite.
+
+SNAPSHOT_DIR = 'payments_snapshot'  # pasta ao lado da base (DB_FILE)
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FETCH_ROWS = 100000
+SNAPSHOT_MAX_SEGMENTS = 16
+SNAPSHOT_MAX_REPLACED = 0.25    # fração de linhas substituídas que força reconstrução
+SNAPSHOT_ORPHAN_SECONDS = 300   # arquivos fora do manifesto são apagados depois disso
+
+class SnapshotUnsupported(Exception):
+    """Valor que o formato não representa (ex.: texto numa coluna numérica)"""
+
+def payment_snapshot_columns(conn):
+    """[(coluna, 'num' | 'texto')] na ordem da tabela, pela afinidade declarada"""
+    cols = []
+    for _, name, decl, *_ in conn.execute("PRAGMA table_info(payments)"):
+        decl = (decl or '').upper()
+        cols.append([name, 'num' if any(t in decl for t in ('INT', 'REAL', 'FLOA', 'DOUB')) else 'texto'])
+    return cols
+
+def snapshot_dir():
+    # Pela base e não pelo diretório de trabalho: quem abre a mesma base lê o mesmo snapshot
+    return os.path.join(os.path.dirname(os.path.abspath(DB_FILE)), SNAPSHOT_DIR)
+
+def snapshot_path(name):
+    return os.path.join(snapshot_dir(), name)
+
+def snapshot_array(seg, col, suffix=''):
+    return np.load(snapshot_path(f"{seg}.{col}{suffix}.npy"), mmap_mode='r')
+
+class SnapshotSegmentBuilder:
+    """Acumula blocos de linhas (tuplas na ordem das colunas) e grava um segmento"""
+    def __init__(self, columns):
+        self.columns = columns
+        self.rows = 0
+        self.parts = {c: [] for c, _ in columns}
+        self.dicts = {c: {} for c, k in columns if k == 'texto'}
+        self.floats = set()  # colunas numéricas com algum REAL no segmento
+
+    def add(self, rows):
+        if not rows: return
+        self.rows += len(rows)
+        for (c, kind), values in zip(self.columns, zip(*rows)):
+            arr = np.array(values, dtype=object)
+            if kind == 'texto':
+                codes, uniques = pd.factorize(arr)  # None -> -1
+                d = self.dicts[c]
+                for u in uniques:
+                    # numpy corta \x00 no fim de str: esse valor não voltaria igual
+                    if not isinstance(u, str) or u.endswith('\x00'): raise SnapshotUnsupported(f"{c}: {u!r}")
+                remap = np.array([d.setdefault(u, len(d)) for u in uniques] + [-1], dtype=np.int32)
+                self.parts[c].append(remap[codes])
+            else:
+                nulls = np.equal(arr, None)
+                tipos = {type(v) for v in set(values)} - {type(None)}
+                if tipos - {int, float}: raise SnapshotUnsupported(f"{c}: {tipos}")
+                if float in tipos: self.floats.add(c)
+                arr[nulls] = 0
+                self.parts[c].append((arr.astype(np.float64 if float in tipos else np.int64), nulls))
+
+    def write(self, substitui):
+        """Grava os arquivos do segmento; substitui: ids que ele tira dos segmentos anteriores"""
+        name = f"seg_{int(time.time())}_{os.urandom(4).hex()}"
+        seg = {'nome': name, 'linhas': self.rows, 'tipos': {}, 'nulos': [], 'substitui': len(substitui)}
+        os.makedirs(snapshot_dir(), exist_ok=True)
+        if len(substitui): np.save(snapshot_path(f"{name}.substitui.npy"), np.asarray(substitui, dtype=np.int64))
+        if not self.rows: return seg
+        for c, kind in self.columns:
+            if kind == 'texto':
+                np.save(snapshot_path(f"{name}.{c}.npy"), np.concatenate(self.parts[c]))
+                np.save(snapshot_path(f"{name}.{c}.dict.npy"), np.array(list(self.dicts[c]), dtype=str))
+                seg['tipos'][c] = 'texto'
+                continue
+            nulls = np.concatenate([n for _, n in self.parts[c]])
+            if c in self.floats:
+                values = np.concatenate([v.astype(np.float64) for v, _ in self.parts[c]])
+                values[nulls] = np.nan
+                seg['tipos'][c] = 'float'
+            else:
+                values = np.concatenate([v for v, _ in self.parts[c]])
+                seg['tipos'][c] = 'int'
+                if nulls.any():
+                    np.save(snapshot_path(f"{name}.{c}.nulos.npy"), nulls)
+                    seg['nulos'].append(c)
+            np.save(snapshot_path(f"{name}.{c}.npy"), values)
+        return seg
+
+def build_snapshot_segment(cursor, columns, substitui=()):
+    builder = SnapshotSegmentBuilder(columns)
+    while True:
+        rows = cursor.fetchmany(SNAPSHOT_FETCH_ROWS)
+        if not rows: break
+        builder.add(rows)
+    return builder.write(substitui)
+
+def load_snapshot_manifest():
+    try:
+        with open(snapshot_path('atual.json'), encoding='utf-8') as fh:
+            return json.load(fh)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_snapshot_manifest(man, base):
+    """
+    Troca o manifesto, a menos que outro refresh tenha trocado antes (a base em disco não é
+    mais a que este leu): aí o trabalho deste é descartado. Devolve o manifesto vigente.
+    """
+    atual = load_snapshot_manifest()
+    if (atual or {}).get('id') != (base or {}).get('id'): return atual
+    os.makedirs(snapshot_dir(), exist_ok=True)
+    tmp = snapshot_path(f"atual.{man['id']}.tmp")
+    with open(tmp, 'w', encoding='utf-8') as fh:
+        json.dump(man, fh)
+    os.replace(tmp, snapshot_path('atual.json'))
+    return man
+
+def remove_snapshot_orphans(man):
+    """Apaga arquivos de segmentos que saíram do manifesto há mais de SNAPSHOT_ORPHAN_SECONDS"""
+    keep = {seg['nome'] for seg in man.get('segmentos', [])}
+    limite = time.time() - SNAPSHOT_ORPHAN_SECONDS
+    for f in os.listdir(snapshot_dir()):
+        if f.split('.')[0] in keep or f == 'atual.json': continue
+        try:
+            if os.path.getmtime(snapshot_path(f)) < limite: os.remove(snapshot_path(f))
+        except OSError:
+            pass  # em uso (Windows) ou já removido: fica para a próxima
+
+def snapshot_reset_count(conn):
+    row = conn.execute("SELECT valor FROM db_meta WHERE chave = 'snapshot_reset'").fetchone()
+    return row[0] if row else 0
+
+def delete_payments_untracked(conn, where_sql=None, params=()):
+    """
+    DELETE em massa (RESET TOTAL, arquivo inteiro) sem o gatilho que grava uma marca por linha
+    em payments_snapshot_dirty: as marcas são esvaziadas e o snapshot será refeito inteiro.
+    Rodar dentro da transação de escrita; depois do commit, discard_payments_snapshot().
+    """
+    if not conn.in_transaction: conn.execute("BEGIN")  # o DROP TRIGGER não pode valer fora dela
+    conn.execute("DROP TRIGGER IF EXISTS trg_payments_snapshot_delete")
+    conn.execute("DELETE FROM payments" + (f" WHERE {where_sql}" if where_sql else ""), params)
+    conn.execute(SNAPSHOT_DELETE_TRIGGER)
+    conn.execute("DELETE FROM payments_snapshot_dirty")
+    # Um refresh que leu as marcas antes desta transação não pode mais seguir por partes
+    conn.execute("""
+        INSERT INTO db_meta (chave, valor) VALUES ('snapshot_reset', 1)
+        ON CONFLICT (chave) DO UPDATE SET valor = valor + 1
+    """)
+
+def refresh_payments_snapshot():
+    """
+    Deixa o snapshot na geração atual da base e devolve o manifesto (None se indisponível).
+    Só linhas novas e alteradas/excluídas são lidas; a reconstrução inteira fica para a
+    primeira vez, mudança de colunas ou segmentos/substituições demais.
+    """
+    base = load_snapshot_manifest()
+    conn = get_db_connection()
+    try:
+        if base and base['geracao'] == get_db_generation(conn):
+            return None if base.get('indisponivel') else base
+        conn.execute("BEGIN")  # geração, marcas e linhas da mesma leitura
+        generation = get_db_generation(conn)
+        reset = snapshot_reset_count(conn)
+        columns = payment_snapshot_columns(conn)
+        max_seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM payments_snapshot_dirty").fetchone()[0]
+        total = conn.execute("SELECT COUNT(*) FROM payments").fetchone()[0]
+        man = {'versao': SNAPSHOT_VERSION, 'id': os.urandom(8).hex(), 'geracao': generation, 'colunas': columns,
+               'linhas': total, 'ultimo_seq': max_seq, 'reset': reset}
+        # Depois de uma exclusão em massa as marcas foram apagadas: só a reconstrução é confiável
+        incremental = (base is not None and not base.get('indisponivel') and base['versao'] == SNAPSHOT_VERSION
+                       and base.get('reset', 0) == reset and base['colunas'] == columns
+                       and len(base['segmentos']) < SNAPSHOT_MAX_SEGMENTS)
+        if incremental:
+            dirty = [r[0] for r in conn.execute("""
+                SELECT DISTINCT id FROM payments_snapshot_dirty WHERE seq > ? AND id <= ? ORDER BY id
+            """, (base['ultimo_seq'], base['ultimo_id']))]
+            substituidas = base['substituidas'] + len(dirty)
+            incremental = substituidas <= SNAPSHOT_MAX_REPLACED * max(total, 1)
+        cols_sql = ', '.join(c for c, _ in columns)
+        try:
+            if incremental:
+                segs = list(base['segmentos'])
+                cur = conn.execute(f"""
+                    SELECT {cols_sql} FROM payments
+                    WHERE id > ? OR id IN (SELECT id FROM payments_snapshot_dirty WHERE seq > ? AND id <= ?)
+                    ORDER BY id
+                """, (base['ultimo_id'], base['ultimo_seq'], base['ultimo_id']))
+                seg = build_snapshot_segment(cur, columns, dirty)
+                if seg['linhas'] or seg['substitui']: segs.append(seg)
+                man.update(segmentos=segs, substituidas=substituidas)
+            else:
+                seg = build_snapshot_segment(conn.execute(f"SELECT {cols_sql} FROM payments ORDER BY id"), columns)
+                man.update(segmentos=[seg], substituidas=0)
+            man['ultimo_id'] = conn.execute("SELECT COALESCE(MAX(id), 0) FROM payments").fetchone()[0]
+        except SnapshotUnsupported as e:
+            man.update(indisponivel=str(e), segmentos=[], substituidas=0, ultimo_id=0)
+        conn.commit()
+        saved = save_snapshot_manifest(man, base)
+        if saved is man:
+            # Marcas já refletidas no manifesto anterior (incremental) ou neste (reconstrução)
+            conn.execute("DELETE FROM payments_snapshot_dirty WHERE seq <= ?", (base['ultimo_seq'] if incremental else max_seq,))
+            conn.commit()
+            if not incremental: remove_snapshot_orphans(man)
+        return None if (saved is None or saved.get('indisponivel')) else saved
+    finally:
+        conn.close()
+
+def snapshot_numeric(parts, col):
+    """Coluna numérica com a inferência do read_sql: int64 sem NULL, float64 com NaN, object se tudo NULL"""
+    values, nulls = [], []
+    for seg, idx in parts:
+        v = snapshot_array(seg['nome'], col)[idx]
+        n = snapshot_array(seg['nome'], col, '.nulos')[idx] if col in seg['nulos'] else (np.isnan(v) if seg['tipos'][col] == 'float' else np.zeros(len(v), bool))
+        values.append(v)
+        nulls.append(n)
+    single = len(values) == 1
+    values, nulls = (values[0], nulls[0]) if single else (np.concatenate(values), np.concatenate(nulls))
+    if len(values) and nulls.all(): return np.full(len(values), None, dtype=object)
+    if nulls.any() and not (single and values.dtype == np.float64):  # segmento float inteiro já tem o NaN gravado
+        values = values.astype(np.float64, copy=not single)
+        values[nulls] = np.nan
+    return values
+
+def snapshot_text(parts, col):
+    pieces = []
+    for seg, idx in parts:
+        codes = snapshot_array(seg['nome'], col)[idx]
+        # Um objeto str por valor distinto; as linhas só apontam para ele
+        vals = np.append(snapshot_array(seg['nome'], col, '.dict').astype(object), None)
+        pieces.append(vals[codes])  # código -1 cai no None do fim
+    return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+def snapshot_frame(man):
+    """
+    Linhas vivas do snapshot em ordem de id. Com um segmento só (snapshot recém-refeito), as
+    colunas numéricas são o próprio mmap: ficam no cache de páginas do sistema, sem cópia.
+    """
+    parts, replaced = [], np.empty(0, dtype=np.int64)
+    for seg in reversed(man['segmentos']):
+        if seg['linhas']:
+            live = np.flatnonzero(~np.isin(snapshot_array(seg['nome'], 'id'), replaced)) if len(replaced) else slice(None)
+            if isinstance(live, slice) or len(live): parts.append((seg, live))
+        if seg['substitui']:
+            replaced = np.concatenate([replaced, np.load(snapshot_path(f"{seg['nome']}.substitui.npy"))])
+    parts.reverse()
+    if not parts: return pd.DataFrame(columns=[c for c, _ in man['colunas']])
+    data = {c: snapshot_text(parts, c) if kind == 'texto' else snapshot_numeric(parts, c) for c, kind in man['colunas']}
+    # copy=False: o pandas não junta as colunas numéricas num bloco novo (mantém o mmap)
+    frame = pd.DataFrame({c: pd.Series(v, copy=False) for c, v in data.items()}, copy=False)
+    if len(parts) > 1:
+        frame = frame.take(np.argsort(frame['id'].to_numpy(), kind='stable')).reset_index(drop=True)
+    return frame
+
+class SnapshotFrames:
+    """
+    Quadro decodificado do manifesto vigente, um por processo: todas as sessões e tarefas
+    leem o mesmo (e o cache de consultas não guarda cópias dele).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.id = None
+        self.geracao = -1
+        self.frame = None
+
+    def get(self, man, build):
+        with self.lock:
+            if man['id'] == self.id: return self.frame
+            if man['geracao'] < self.geracao: return build(man)  # leitor atrasado: não troca o vigente
+            self.id, self.frame = None, None  # solta o anterior antes de montar o próximo
+            self.frame = build(man)
+            self.id, self.geracao = man['id'], man['geracao']
+            return self.frame
+
+@st.cache_resource
+def get_snapshot_frames():
+    return SnapshotFrames()
+
+class SnapshotRefresher:
+    """
+    Atualiza o snapshot numa thread, fora das páginas. Pedidos que chegam durante uma
+    atualização viram uma única rodada seguinte (que pega todas as escritas até ali).
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pending = False
+        self.refresh = None
+
+    def request(self, refresh):
+        with self.lock:
+            self.refresh = refresh  # a do rerun mais recente (o objeto sobrevive aos reruns)
+            if self.thread is not None:
+                self.pending = True
+                return
+            self.thread = threading.Thread(target=self._run, name='pot-snapshot', daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Erro ao atualizar o snapshot de payments: {e}")
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                self.pending = False
+
+@st.cache_resource
+def get_snapshot_refresher():
+    # Um por processo, compartilhado entre sessões, reruns e tarefas
+    return SnapshotRefresher()
+
+def request_snapshot_refresh():
+    """Chamar depois do commit de toda escrita em payments; não espera a atualização"""
+    get_snapshot_refresher().request(refresh_payments_snapshot)
+
+def read_payments_snapshot(column=None, values=None):
+    """
+    Mesmo DataFrame do SELECT * (filtrado por column IN values), lido do snapshot; None se
+    ele não está na geração atual (aí pede a atualização e a página lê do SQLite).
+    """
+    try:
+        man = load_snapshot_manifest()
+        if man is None or man['geracao'] != get_db_generation():
+            request_snapshot_refresh()
+            return None
+        if man.get('indisponivel'): return None
+        frame = get_snapshot_frames().get(man, snapshot_frame)
+        if column is None: return frame.copy(deep=False)
+        return frame[frame[column].isin(list(values))].reset_index(drop=True)
+    except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+        print(f"Snapshot de payments indisponível, lendo do SQLite: {e}")
+        return None
+
+def discard_payments_snapshot():
+    """Tira o manifesto: a próxima atualização refaz o snapshot inteiro (os arquivos antigos saem como órfãos)"""
+    try:
+        os.remove(snapshot_path('atual.json'))
+    except FileNotFoundError:
+        pass
+
+def snapshot_stats():
+    man = load_snapshot_manifest()
+    if not man: return None
+    tamanho = sum(os.path.getsize(snapshot_path(f)) for f in os.listdir(snapshot_dir()))
+    return {'geracao': man['geracao'], 'linhas': man['linhas'], 'segmentos': len(man['segmentos']),
+            'substituidas': man['substituidas'], 'disco_mb': tamanho / 1024 ** 2, 'indisponivel': man.get('indisponivel')}
+
+# ===========================================
+# CAMADA DE CONSULTAS (PAYMENTS)
+# ===========================================
+# Cada página pede só o que exibe; filtros e agregações rodam no SQLite.
+
+PAYMENT_GROUP_COLUMNS = ('programa', 'gerenciadora', 'competencia', 'ano_ref', 'arquivo_origem')
+
+def check_group_column(column):
+    if column not in PAYMENT_GROUP_COLUMNS:
+        raise ValueError(f"Coluna não permitida para agrupamento: {column}")
+    return column
+
+def query_df(sql, params=()):
+    conn = get_db_connection()
+    try:
+        return pd.read_sql(sql, conn, params=params)
+    finally:
+        conn.close()
+
+@cached_query
+def get_payments_count():
+    conn = get_db_connection()
+    try:
+        return conn.execute("SELECT COUNT(*) FROM payments").fetchone()[0]
+    finally:
+        conn.close()
+
+@cached_query
+def get_payments_kpis():
+    """KPIs do Dashboard lidos do rollup, sem varrer payments"""
+    conn = get_db_connection()
+    try:
+        row = conn.execute("""
+            SELECT COALESCE(SUM(qtd_registros), 0), COALESCE(SUM(valor_total), 0),
+                   (SELECT COUNT(*) FROM payments_rollup_cards),
+                   COUNT(DISTINCT programa), COUNT(DISTINCT gerenciadora)
+            FROM payments_rollup
+        """).fetchone()
+    finally:
+        conn.close()
+    return dict(zip(['registros', 'total', 'beneficiarios', 'projetos', 'gerenciadoras'], row))
+
+@cached_query
+def get_totals_by(column):
+    col = check_group_column(column)
+    if col not in ('programa', 'gerenciadora', 'competencia'):
+        raise ValueError(f"Coluna fora do rollup: {col}")
+    return query_df(f"""
+        SELECT {col}, SUM(valor_total) AS valor_pagto FROM payments_rollup
+        WHERE {col} IS NOT NULL GROUP BY {col} ORDER BY {col}
+    """)
+
+@cached_query
+def get_competencias():
+    """Competências na ordem em que apareceram na base (rollup)"""
+    df = query_df("""
+        SELECT competencia FROM payments_rollup WHERE competencia IS NOT NULL
+        GROUP BY competencia ORDER BY MIN(primeiro_id)
+    """)
+    return df['competencia'].tolist()
+
+@cached_query
+def get_distinct_values(column):
+    """Valores distintos na ordem em que apareceram na base"""
+    col = check_group_column(column)
+    df = query_df(f"SELECT {col} FROM payments WHERE {col} IS NOT NULL GROUP BY {col} ORDER BY MIN(id)")
+    return df[col].tolist()
+
+def drop_match_keys(df, with_keys):
+    """Chaves de comparação são internas: só saem para quem pede (detecção de inconsistências)"""
+    return df if with_keys else df.drop(columns=MATCH_KEY_COLUMNS, errors='ignore')
+
+# Pagamentos inteiros: do snapshot (quadro compartilhado, fora do cache de consultas) e,
+# enquanto ele não está na geração atual, do SQLite pelo cache de consultas.
+
+@cached_query
+def query_payments_by_competencia(competencia):
+    return query_df("SELECT * FROM payments WHERE competencia = ?", (competencia,))
+
+@cached_query
+def query_payments_by_programas(programas=None):
+    if not programas: return query_df("SELECT * FROM payments")
+    marks = ",".join("?" * len(programas))
+    return query_df(f"SELECT * FROM payments WHERE programa IN ({marks})", tuple(programas))
+
+def get_payments_by_competencia(competencia, with_keys=False):
+    df = read_payments_snapshot('competencia', [competencia])
+    if df is None: df = query_payments_by_competencia(competencia)
+    return drop_match_keys(df, with_keys)
+
+def get_payments_by_programas(programas=None, with_keys=False, cached=True):
+    """cached=False: sem snapshot, consulta direta (tarefas fora da sessão não enchem o cache de página)"""
+    df = read_payments_snapshot('programa', programas) if programas else read_payments_snapshot()
+    if df is None: df = (query_payments_by_programas if cached else query_payments_by_programas.__wrapped__)(programas)
+    return drop_match_keys(df, with_keys)
+
+@cached_query
+def get_inconsistencies_by_competencia(competencia):
+    return detect_inconsistencies(get_payments_by_competencia(competencia, True))
+
+@cached_query
+def get_bank_discrepancies():
+    return drop_match_keys(query_df("SELECT * FROM bank_discrepancies"), False)
+
 # ===========================================
 # CONTEÚDO DOS MANUAIS
 # ===========================================
@@ -343,122 +1283,191 @@ def format_competencia(mes, ano):
     if not nome_mes: nome_mes = mes_str
     return f"{nome_mes} {ano_str}"
 
+MONTH_NUMBER = {nome: int(k) for k, nome in MONTH_MAP_FULL.items() if len(k) == 2 and k.isdigit()}
+
+def competencia_sort_key(competencia):
+    """'Março 2025' -> ordem cronológica; competências fora do padrão vão para o fim"""
+    nome, _, ano = str(competencia).rpartition(' ')
+    mes = MONTH_NUMBER.get(nome)
+    return (0, int(ano), mes, '') if mes and ano.isdigit() else (1, 0, 0, str(competencia))
+
 # ===========================================
 # PARSER INTELIGENTE BANCO DO BRASIL
 # ===========================================
 
-def parse_smart_bb(file_obj, filename):
-    try:
-        content = file_obj.getvalue().decode('latin-1', errors='ignore')
-    except:
-        content = file_obj.getvalue().decode('utf-8', errors='ignore')
-        
-    lines = content.split('\n')
-    data = []
-    filename_upper = filename.upper()
-    data_arquivo = ""
-    competencia_fmt = ""
-    
-    match_date_header = re.search(r'(\d{2})\s+([A-Za-z]{3})\s+(\d{4})', content[:500])
+BB_BATCH_ROWS = 50000
+BB_READ_BLOCK = 4 << 20
+BB_HEADER_BYTES = 500   # datas do cabeçalho são procuradas só no início do arquivo
+BB_SNIFF_BYTES = 16384
+BB_SNIFF_LINES = 66     # uma página do spool: o cabeçalho de colunas do RESUMO aparece nela
+BB_ENG_MONTHS = {'DEC':'Dezembro','JAN':'Janeiro','FEB':'Fevereiro','MAR':'Março','APR':'Abril','MAY':'Maio','JUN':'Junho','JUL':'Julho','AUG':'Agosto','SEP':'Setembro','OCT':'Outubro','NOV':'Novembro'}
+
+# Padrões compilados uma vez. CADASTRO e LOTE trabalham sobre bytes: em latin-1 cada byte é
+# um caractere, então as fatias de largura fixa são as mesmas do texto decodificado.
+RE_BB_DATE_HEADER = re.compile(r'(\d{2})\s+([A-Za-z]{3})\s+(\d{4})')
+RE_BB_DATE_LOTE = re.compile(r'20\d{6}')
+RE_BB_DATE_ROW = re.compile(rb'(\d{2}/\d{2}/\d{4})')
+# \s do texto em latin-1 inclui \x1c-\x1f, \x85 e \xa0; a classe explícita mantém o regex em bytes equivalente
+BB_WS = rb'[\t\n\x0b\x0c\r\x1c-\x1f \x85\xa0]'
+RE_BB_RESUMO_MAIN = re.compile(rb'%s*(\d{6,})%s+([\d\.]+)%s+(.+)$' % (BB_WS, BB_WS, BB_WS))
+RE_BB_LOTE_NOME_TAIL = re.compile(rb'(\D+)$')
+BB_LOTE_NOME_MARK = b'30000004'
+
+def open_bb_source(source):
+    """
+    Buffer binário com readline/read/seek. Caminho em disco é mapeado em memória (mmap);
+    arquivo enviado pelo Streamlit já está em memória (BytesIO) e é lido direto, sem cópia.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as fh:
+            if os.fstat(fh.fileno()).st_size == 0: return io.BytesIO(b'')
+            return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    source.seek(0)
+    return source
+
+def iter_bb_lines(buf, block_size=BB_READ_BLOCK):
+    """
+    Linhas em bytes, como content.split('\\n'), lidas em blocos de block_size; a linha
+    incompleta no fim de cada bloco segue para o próximo. A linha vazia após o último
+    '\\n' é omitida (não gera registro em nenhum layout).
+    """
+    buf.seek(0)
+    rest = b''
+    while True:
+        block = buf.read(block_size)
+        if not block: break
+        lines = (rest + block).split(b'\n')
+        rest = lines.pop()
+        yield from lines
+    if rest: yield rest
+
+def bb_header_dates(head):
+    """(data_arquivo, competencia_fmt) a partir dos primeiros BB_HEADER_BYTES do arquivo"""
+    match_date_header = RE_BB_DATE_HEADER.search(head)
     if match_date_header:
         d, m_eng, y = match_date_header.groups()
-        eng_map = {'DEC':'Dezembro','JAN':'Janeiro','FEB':'Fevereiro','MAR':'Março','APR':'Abril','MAY':'Maio','JUN':'Junho','JUL':'Julho','AUG':'Agosto','SEP':'Setembro','OCT':'Outubro','NOV':'Novembro'}
-        m_pt = eng_map.get(m_eng.upper(), m_eng)
-        data_arquivo = f"{d}/{m_eng}/{y}"
-        competencia_fmt = f"{m_pt} {y}"
-        
-    if not data_arquivo:
-        match_date_lote = re.search(r'20\d{6}', content[:500]) 
-        if match_date_lote:
-            ds = match_date_lote.group(0) 
-            y, m, d = ds[:4], ds[4:6], ds[6:8]
-            data_arquivo = f"{d}/{m}/{y}"
-            competencia_fmt = format_competencia(m, y)
-
-    if "REL.CADASTRO" in filename_upper or (len(lines) > 0 and lines[0].startswith('0') and 'Projeto' in lines[0]):
-        for line in lines:
-            if line.startswith('1'): 
-                try:
-                    dt_lote_match = re.search(r'(\d{2}/\d{2}/\d{4})', line[150:]) 
-                    dt_row = dt_lote_match.group(1) if dt_lote_match else data_arquivo
-                    comp_row = competencia_fmt
-                    if dt_row and not comp_row:
-                        parts = dt_row.split('/')
-                        if len(parts) == 3: comp_row = format_competencia(parts[1], parts[2])
-
-                    entry = {
-                        'arquivo_origem': filename,
-                        'tipo_arquivo': 'CADASTRO',
-                        'projeto': line[11:42].strip(),
-                        'num_cartao': line[42:52].strip(),
-                        'nome_banco': line[52:92].strip(),
-                        'rg_banco': line[92:104].strip(),
-                        'cpf_banco': line[104:119].strip().replace('.', '').replace('-', ''),
-                        'data_pagto': dt_row,
-                        'competencia': comp_row
-                    }
-                    if entry['num_cartao']: data.append(entry)
-                except: continue
-
-    elif "RESUMO" in filename_upper or "Distrito    Agencia" in content:
-        i = 0
-        while i < len(lines):
-            line = lines[i]
-            match_main = re.search(r'^\s*(\d{6,})\s+([\d\.]+)\s+(.+)$', line)
-            if match_main:
-                cartao = match_main.group(1)
-                valor = match_main.group(2)
-                nome = match_main.group(3).strip()
-                agencia = ''
-                distrito = ''
-                if i + 1 < len(lines):
-                    next_line = lines[i+1]
-                    parts = next_line.split()
-                    if len(parts) >= 2:
-                        distrito = parts[0]
-                        agencia = parts[1]
-                data.append({
-                    'arquivo_origem': filename,
-                    'tipo_arquivo': 'RESUMO_SPOOL',
-                    'projeto': 'N/A', 
-                    'num_cartao': cartao,
-                    'nome_banco': nome,
-                    'rg_banco': '',
-                    'cpf_banco': '',
-                    'agencia': agencia,
-                    'distrito': distrito,
-                    'valor_banco': valor,
-                    'data_pagto': data_arquivo,
-                    'competencia': competencia_fmt
-                })
-                i += 1 
-            i += 1
-
-    elif "LOTE" in filename_upper or (len(lines) > 1 and lines[1].startswith('2000')):
-        for line in lines:
-            if line.startswith('2'): 
-                try:
-                    cartao_candidato = line[13:20].strip()
-                    match_nome = re.search(r'30000004(.+)$', line)
-                    if match_nome: nome = match_nome.group(1).strip()
-                    else:
-                        nome_part = re.search(r'(\D+)$', line)
-                        nome = nome_part.group(1).strip() if nome_part else ""
-                    if cartao_candidato and nome:
-                        data.append({
-                            'arquivo_origem': filename,
-                            'tipo_arquivo': 'LOTE_PROCESSAMENTO',
-                            'projeto': 'LOTE',
-                            'num_cartao': cartao_candidato,
-                            'nome_banco': nome,
-                            'rg_banco': '',
-                            'cpf_banco': '',
-                            'data_pagto': data_arquivo,
-                            'competencia': competencia_fmt
-                        })
-                except: continue
-
-    return pd.DataFrame(data)
+        m_pt = BB_ENG_MONTHS.get(m_eng.upper(), m_eng)
+        return f"{d}/{m_eng}/{y}", f"{m_pt} {y}"
+    match_date_lote = RE_BB_DATE_LOTE.search(head)
+    if match_date_lote:
+        ds = match_date_lote.group(0)
+        y, m, d = ds[:4], ds[4:6], ds[6:8]
+        return f"{d}/{m}/{y}", format_competencia(m, y)
+    return "", ""
+
+def bb_rows_cadastro(lines, filename, data_arquivo, competencia_fmt):
+    comp_by_date = {}
+    for line in lines:
+        if not line.startswith(b'1'): continue
+        text = line.decode('latin-1')
+        num_cartao = text[42:52].strip()
+        if not num_cartao: continue
+        dt_lote_match = RE_BB_DATE_ROW.search(line, 150)
+        dt_row = dt_lote_match.group(1).decode('latin-1') if dt_lote_match else data_arquivo
+        comp_row = competencia_fmt
+        if dt_row and not comp_row:
+            if dt_row not in comp_by_date:
+                parts = dt_row.split('/')
+                comp_by_date[dt_row] = format_competencia(parts[1], parts[2]) if len(parts) == 3 else comp_row
+            comp_row = comp_by_date[dt_row]
+        yield (filename, 'CADASTRO',
+               text[11:42].strip(),
+               num_cartao,
+               text[52:92].strip(),
+               text[92:104].strip(),
+               text[104:119].strip().replace('.', '').replace('-', ''),
+               dt_row, comp_row)
+
+def bb_rows_resumo(lines, filename, data_arquivo, competencia_fmt):
+    # O layout do spool não é de largura fixa: linha principal por regex e a seguinte traz distrito/agência
+    lines = iter(lines)
+    for raw in lines:
+        match_main = RE_BB_RESUMO_MAIN.match(raw)
+        if not match_main: continue
+        next_line = next(lines, None)
+        parts = next_line.decode('latin-1').split() if next_line is not None else []
+        distrito, agencia = (parts[0], parts[1]) if len(parts) >= 2 else ('', '')
+        yield (filename, 'RESUMO_SPOOL', 'N/A', match_main.group(1).decode('latin-1'),
+               match_main.group(3).decode('latin-1').strip(), '', '', agencia, distrito,
+               match_main.group(2).decode('latin-1'), data_arquivo, competencia_fmt)
+
+def bb_rows_lote(lines, filename, data_arquivo, competencia_fmt):
+    for line in lines:
+        if not line.startswith(b'2'): continue
+        cartao_candidato = line[13:20].decode('latin-1').strip()
+        pos = line.find(BB_LOTE_NOME_MARK)
+        if pos != -1 and pos + len(BB_LOTE_NOME_MARK) < len(line):
+            nome = line[pos + len(BB_LOTE_NOME_MARK):].decode('latin-1').strip()
+        else:
+            nome_part = RE_BB_LOTE_NOME_TAIL.search(line)
+            nome = nome_part.group(1).decode('latin-1').strip() if nome_part else ""
+        if cartao_candidato and nome:
+            yield (filename, 'LOTE_PROCESSAMENTO', 'LOTE', cartao_candidato, nome, '', '', data_arquivo, competencia_fmt)
+
+# ===========================================
+# REGISTRO DE LAYOUTS BANCÁRIOS
+# ===========================================
+# Cada layout declara:
+#   sniff(filename_upper, head) -> bool  olhando só o nome e as primeiras linhas (texto latin-1);
+#   columns                              colunas do DataFrame, na ordem das tuplas do decodificador;
+#   rows(lines, filename, data_arquivo, competencia_fmt)  gerador de tuplas a partir das linhas em bytes.
+# A detecção custa O(cabeçalho). Um layout novo (ex.: retorno CNAB 240) é só mais um
+# register_bank_layout, sem mexer nos já registrados.
+
+BANK_LAYOUTS = OrderedDict()   # ordem de registro = prioridade na detecção
+
+def register_bank_layout(name, sniff, columns, rows):
+    BANK_LAYOUTS[name] = {'sniff': sniff, 'columns': columns, 'rows': rows}
+
+BB_BASE_COLUMNS = ['arquivo_origem', 'tipo_arquivo', 'projeto', 'num_cartao', 'nome_banco', 'rg_banco', 'cpf_banco']
+
+def sniff_cadastro(filename_upper, head):
+    return "REL.CADASTRO" in filename_upper or (len(head) > 0 and head[0].startswith('0') and 'Projeto' in head[0])
+
+def sniff_resumo(filename_upper, head):
+    return "RESUMO" in filename_upper or any("Distrito    Agencia" in line for line in head)
+
+def sniff_lote(filename_upper, head):
+    return "LOTE" in filename_upper or (len(head) > 1 and head[1].startswith('2000'))
+
+register_bank_layout('CADASTRO', sniff_cadastro,
+                     BB_BASE_COLUMNS + ['data_pagto', 'competencia'], bb_rows_cadastro)
+register_bank_layout('RESUMO_SPOOL', sniff_resumo,
+                     BB_BASE_COLUMNS + ['agencia', 'distrito', 'valor_banco', 'data_pagto', 'competencia'], bb_rows_resumo)
+register_bank_layout('LOTE_PROCESSAMENTO', sniff_lote,
+                     BB_BASE_COLUMNS + ['data_pagto', 'competencia'], bb_rows_lote)
+
+def detect_bank_layout(filename, head):
+    filename_upper = filename.upper()
+    return next((name for name, layout in BANK_LAYOUTS.items() if layout['sniff'](filename_upper, head)), None)
+
+def iter_bb_batches(source, filename, batch_rows=BB_BATCH_ROWS):
+    """
+    Lê um retorno bancário em streaming e devolve DataFrames de até batch_rows registros.
+    Só o cabeçalho (BB_SNIFF_BYTES) é decodificado para a detecção; o resto do arquivo passa
+    linha a linha pelo decodificador do layout.
+    """
+    buf = open_bb_source(source)
+    try:
+        buf.seek(0)
+        head_bytes = buf.read(BB_SNIFF_BYTES)
+        data_arquivo, competencia_fmt = bb_header_dates(head_bytes[:BB_HEADER_BYTES].decode('latin-1'))
+        name = detect_bank_layout(filename, head_bytes.decode('latin-1').split('\n')[:BB_SNIFF_LINES])
+        if name is None: return
+        layout = BANK_LAYOUTS[name]
+        batch = []
+        for row in layout['rows'](iter_bb_lines(buf), filename, data_arquivo, competencia_fmt):
+            batch.append(row)
+            if len(batch) >= batch_rows:
+                yield pd.DataFrame.from_records(batch, columns=layout['columns'])
+                batch = []
+        if batch: yield pd.DataFrame.from_records(batch, columns=layout['columns'])
+    finally:
+        if isinstance(buf, mmap.mmap): buf.close()
+
+def parse_smart_bb(file_obj, filename):
+    batches = list(iter_bb_batches(file_obj, filename))
+    return pd.concat(batches, ignore_index=True) if batches else pd.DataFrame()
 
 # ===========================================
 # LÓGICA DE NEGÓCIO E VALIDAÇÃO
@@ -478,6 +1487,113 @@ COLUMN_MAP = {
     'gerenciadora': 'gerenciadora', 'entidade': 'gerenciadora', 'parceiro': 'gerenciadora', 'os': 'gerenciadora'
 }
 
+# Esquema de destino das colunas de payments na padronização: tipo -> conversor vetorizado.
+# Cada conversor recebe a coluna em texto e devolve (valores tipados, máscara de falhas).
+# Vazio vira nulo sem contar como falha; inválido vira nulo e é contado (o CPF inválido
+# mantém os dígitos, pois é chave de identificação).
+PAYMENT_SCHEMA = {
+    'num_cartao': 'cartao',
+    'cpf': 'cpf',
+    'rg': 'texto',
+    'valor_pagto': 'moeda',
+    'data_pagto': 'data',
+    'qtd_dias': 'inteiro',
+}
+
+def as_text(s):
+    """Texto aparado; vazio/'nan' viram ''"""
+    txt = s.fillna('').astype(str).str.strip()
+    return txt.mask(txt.str.lower() == 'nan', '')
+
+def pad_cpf(digits):
+    """CPF só com dígitos; 9 ou 10 dígitos são zeros à esquerda perdidos pelo Excel"""
+    return digits.where(~digits.str.len().isin([9, 10]), digits.str.zfill(11))
+
+def coerce_cartao(s):
+    txt = as_text(s).str.replace(r'\.0$', '', regex=True)
+    return txt, pd.Series(False, index=s.index)
+
+def coerce_cpf(s):
+    txt = as_text(s)
+    digits = pad_cpf(txt.str.replace(r'\D', '', regex=True))
+    return digits, (txt != '') & (digits.str.len() != 11)
+
+def coerce_texto(s):
+    txt = as_text(s)
+    return txt.where(txt != '', None), pd.Series(False, index=s.index)
+
+def coerce_moeda(s):
+    """'R$ 1.234,56', '1234,56', '1,234.56', '1.234.567' -> float; o último separador é o decimal"""
+    txt = as_text(s).str.replace(r'R\$|\s', '', regex=True)
+    has_comma, has_dot = txt.str.contains(',', regex=False), txt.str.contains('.', regex=False)
+    comma_decimal = has_comma & (~has_dot | (txt.str.rfind(',') > txt.str.rfind('.')))
+    dot_thousands = ~has_comma & (txt.str.count(r'\.') > 1)
+    num = txt.mask(comma_decimal, txt.str.replace('.', '', regex=False).str.replace(',', '.', regex=False))
+    num = num.mask(has_comma & ~comma_decimal, txt.str.replace(',', '', regex=False))
+    num = num.mask(dot_thousands, txt.str.replace('.', '', regex=False))
+    values = pd.to_numeric(num.where(num != ''), errors='coerce').astype(float)
+    return values, (txt != '') & values.isna()
+
+DATE_FORMATS = [(r'^\d{4}-\d{2}-\d{2}', '%Y-%m-%d', 10), (r'^\d{1,2}/\d{1,2}/\d{4}$', '%d/%m/%Y', None),
+                (r'^\d{1,2}/\d{1,2}/\d{2}$', '%d/%m/%y', None), (r'^\d{1,2}-\d{1,2}-\d{4}$', '%d-%m-%Y', None)]
+
+def parse_dates(s):
+    """Datas em Timestamp: formatos conhecidos em lote; o resto cai no parser genérico (dayfirst)"""
+    txt = as_text(s)
+    out = pd.Series(pd.NaT, index=s.index, dtype='datetime64[ns]')
+    todo = txt != ''
+    for pattern, fmt, width in DATE_FORMATS:
+        hit = todo & txt.str.match(pattern)
+        if hit.any():
+            part = txt[hit].str[:width] if width else txt[hit]
+            out[hit] = pd.to_datetime(part, format=fmt, errors='coerce')
+            todo &= ~hit
+    if todo.any():
+        out[todo] = pd.to_datetime(txt[todo], dayfirst=True, errors='coerce', format='mixed')
+    return out, (txt != '') & out.isna()
+
+def coerce_data(s):
+    dates, failed = parse_dates(s)
+    return dates.dt.strftime('%Y-%m-%d').astype(object).where(dates.notna(), None), failed
+
+def coerce_inteiro(s):
+    txt = as_text(s).str.replace(',', '.', regex=False)
+    num = pd.to_numeric(txt.where(txt != ''), errors='coerce')
+    ok = num.notna() & (num == num.round())
+    return num.where(ok).astype('Int64'), (txt != '') & ~ok
+
+COERCERS = {'cartao': coerce_cartao, 'cpf': coerce_cpf, 'texto': coerce_texto,
+            'moeda': coerce_moeda, 'data': coerce_data, 'inteiro': coerce_inteiro}
+
+def coerce_distinct(coercer, s):
+    """Aplica o conversor só aos valores distintos (datas, valores e dias se repetem muito) e expande"""
+    codes, uniques = pd.factorize(s)
+    codes = np.where(codes < 0, len(uniques), codes)   # nulos apontam para um None no fim
+    values, failed = coercer(pd.Series(np.append(np.asarray(uniques, dtype=object), None), dtype=object))
+    return (pd.Series(values.to_numpy()[codes], index=s.index, dtype=values.dtype),
+            failed.to_numpy()[codes])
+
+def coerce_payment_columns(df, falhas=None):
+    """Converte as colunas presentes para o tipo de PAYMENT_SCHEMA; falhas (Counter) soma os inválidos por coluna"""
+    for col, tipo in PAYMENT_SCHEMA.items():
+        if col not in df.columns: continue
+        df[col], failed = coerce_distinct(COERCERS[tipo], df[col])
+        if falhas is not None and failed.any(): falhas[col] += int(failed.sum())
+    return df
+
+def format_falhas(filename, falhas):
+    if not falhas: return None
+    detalhe = ", ".join(f"{n} em {col}" for col, n in falhas.items())
+    return f"Arquivo {filename}: valores que não puderam ser convertidos ({detalhe})."
+
+def map_column_name(col):
+    """Coluna padronizada para um cabeçalho (nome exato do COLUMN_MAP ou trecho dele), ou None"""
+    col_lower = col.lower()
+    if col_lower in COLUMN_MAP: return COLUMN_MAP[col_lower]
+    for key, val in COLUMN_MAP.items():
+        if key in col_lower: return val
+    return None
+
 def remove_total_row(df):
     if df.empty: return df
     last_idx = df.index[-1]
@@ -492,34 +1608,48 @@ def remove_total_row(df):
     if is_id_empty: df = df.drop(last_idx)
     return df
 
-def standardize_dataframe(df, filename):
+def infer_programa(text):
+    text = text.upper()
+    if 'ADS' in text: return 'ADS'
+    elif 'ABAE' in text: return 'ABAE'
+    elif 'ABASTECE' in text or 'ABAST' in text: return 'ABASTECE'
+    elif 'GAE' in text: return 'GAE'
+    elif 'ESPORTE' in text: return 'ESPORTES'
+    elif 'ZELADO' in text: return 'ZELADORIA'
+    elif 'AGRICULTURA' in text: return 'AGRICULTURA'
+    elif 'DEFESA' in text: return 'DEFESA CIVIL'
+    return 'DESCONHECIDO'
+
+def infer_mes_ano(text):
+    """(mes, ano) citados no nome do arquivo ou da aba; None no que não aparecer"""
+    text = text.upper()
+    mes = next((num_mes for nome_mes, num_mes in MONTH_NUM_MAP.items() if nome_mes in text), None)
+    ano_match = re.search(r'(20\d{2})', text)
+    return mes, ano_match.group(1) if ano_match else None
+
+def standardize_dataframe(df, filename, ctx=None, drop_total_row=True, sheet_name=None, falhas=None):
+    """
+    ctx: dicionário compartilhado entre blocos de um mesmo arquivo (streaming), para que
+    mes_ref/ano_ref sejam inferidos uma única vez. drop_total_row=False nos blocos
+    intermediários, já que a linha de totais só existe no final do arquivo.
+    sheet_name: aba de origem (XLSX). Mês/ano citados na aba têm prioridade sobre o nome
+    do arquivo; o programa vem do arquivo e só cai para a aba se não for identificado.
+    falhas: Counter que acumula, por coluna, os valores que não passaram em PAYMENT_SCHEMA.
+    """
     df['linha_arquivo'] = df.index + 2
     df.columns = [str(c).strip() for c in df.columns]
     
-    rename_dict = {}
-    for col in df.columns:
-        col_lower = col.lower()
-        if col_lower in COLUMN_MAP:
-            rename_dict[col] = COLUMN_MAP[col_lower]
-        else:
-            for key, val in COLUMN_MAP.items():
-                if key in col_lower:
-                    rename_dict[col] = val
-                    break
-    
+    rename_dict = {col: name for col in df.columns if (name := map_column_name(col))}
     df = df.rename(columns=rename_dict)
     df = df.loc[:, ~df.columns.duplicated()]
+
+    essential_check = ['num_cartao', 'nome', 'cpf', 'rg', 'valor_pagto']
+    for col in essential_check:
+        if col not in df.columns: df[col] = None 
+    df = coerce_payment_columns(df, falhas)
     
-    filename_upper = filename.upper()
-    programa = 'DESCONHECIDO'
-    if 'ADS' in filename_upper: programa = 'ADS'
-    elif 'ABAE' in filename_upper: programa = 'ABAE'
-    elif 'ABASTECE' in filename_upper or 'ABAST' in filename_upper: programa = 'ABASTECE'
-    elif 'GAE' in filename_upper: programa = 'GAE'
-    elif 'ESPORTE' in filename_upper: programa = 'ESPORTES'
-    elif 'ZELADO' in filename_upper: programa = 'ZELADORIA'
-    elif 'AGRICULTURA' in filename_upper: programa = 'AGRICULTURA'
-    elif 'DEFESA' in filename_upper: programa = 'DEFESA CIVIL'
+    programa = infer_programa(filename)
+    if programa == 'DESCONHECIDO' and sheet_name: programa = infer_programa(sheet_name)
     
     if 'programa' not in df.columns or df['programa'].isnull().all():
         df['programa'] = programa
@@ -529,28 +1659,26 @@ def standardize_dataframe(df, filename):
     else:
         df['gerenciadora'] = df['gerenciadora'].fillna('NÃO IDENTIFICADA')
         
-    mes_ref = None
-    ano_ref = str(datetime.now().year)
-    
-    for nome_mes, num_mes in MONTH_NUM_MAP.items():
-        if nome_mes in filename_upper:
-            mes_ref = num_mes
-            break
+    if ctx is not None and 'mes_ref' in ctx:
+        mes_ref, ano_ref = ctx['mes_ref'], ctx['ano_ref']
+    else:
+        mes_ref, ano_citado = infer_mes_ano(sheet_name) if sheet_name else (None, None)
+        mes_arquivo, ano_arquivo = infer_mes_ano(filename)
+        mes_ref = mes_ref or mes_arquivo
+        ano_citado = ano_citado or ano_arquivo
+        ano_ref = ano_citado or str(datetime.now().year)
             
-    ano_match = re.search(r'(20\d{2})', filename_upper)
-    if ano_match:
-        ano_ref = ano_match.group(1)
+        if (not mes_ref) and 'data_pagto' in df.columns:
+            try:
+                first_valid_date = df['data_pagto'].dropna().iloc[0]   # já em AAAA-MM-DD
+                mes_ref = first_valid_date[5:7]
+                if not ano_citado:
+                    ano_ref = first_valid_date[:4]
+            except: pass
         
-    if (not mes_ref) and 'data_pagto' in df.columns:
-        try:
-            first_valid_date = pd.to_datetime(df['data_pagto'], dayfirst=True, errors='coerce').dropna().iloc[0]
-            mes_ref = str(first_valid_date.month).zfill(2)
-            if not ano_match:
-                ano_ref = str(first_valid_date.year)
-        except: pass
-    
-    if not mes_ref:
-        mes_ref = str(datetime.now().month).zfill(2)
+        if not mes_ref:
+            mes_ref = str(datetime.now().month).zfill(2)
+        if ctx is not None: ctx.update(mes_ref=mes_ref, ano_ref=ano_ref)
             
     df['mes_ref'] = mes_ref
     df['ano_ref'] = ano_ref
@@ -559,37 +1687,25 @@ def standardize_dataframe(df, filename):
         df['competencia'] = format_competencia(mes_ref, ano_ref)
         
     if 'data_pagto' not in df.columns:
-        df['data_pagto'] = datetime.now().strftime('%d/%m/%Y')
+        df['data_pagto'] = datetime.now().strftime('%Y-%m-%d')
         
-    essential_check = ['num_cartao', 'nome', 'cpf', 'rg', 'valor_pagto']
-    for col in essential_check:
-        if col not in df.columns: df[col] = None 
-
-    df = remove_total_row(df)
+    if drop_total_row: df = remove_total_row(df)
 
-    if 'num_cartao' in df.columns:
-        df['num_cartao'] = df['num_cartao'].fillna('').astype(str).str.strip()
-        df['num_cartao'] = df['num_cartao'].str.replace(r'\.0$', '', regex=True).replace(r'(?i)^nan$', '', regex=True)
-        
-    if 'cpf' in df.columns:
-        df['cpf'] = df['cpf'].fillna('').astype(str).str.strip()
-        df['cpf'] = df['cpf'].str.replace(r'\D', '', regex=True).replace(r'(?i)^nan$', '', regex=True)
-    
-    def clean_currency(x):
-        if isinstance(x, str):
-            x = x.replace('R$', '').replace(' ', '')
-            if ',' in x and '.' in x: x = x.replace('.', '').replace(',', '.')
-            elif ',' in x: x = x.replace(',', '.')
-        try: return float(x)
-        except: return 0.0
-            
-    if 'valor_pagto' in df.columns:
-        df['valor_pagto'] = df['valor_pagto'].apply(clean_currency)
-        
     df['arquivo_origem'] = filename
-    cols_to_keep = ['programa', 'gerenciadora', 'num_cartao', 'nome', 'cpf', 'rg', 'valor_pagto', 'data_pagto', 'competencia', 'qtd_dias', 'mes_ref', 'ano_ref', 'arquivo_origem', 'linha_arquivo']
+    if sheet_name is not None: df['aba_origem'] = sheet_name
+    cols_to_keep = ['programa', 'gerenciadora', 'num_cartao', 'nome', 'cpf', 'rg', 'valor_pagto', 'data_pagto', 'competencia', 'qtd_dias', 'mes_ref', 'ano_ref', 'arquivo_origem', 'aba_origem', 'linha_arquivo']
     final_cols = [c for c in cols_to_keep if c in df.columns]
-    return df[final_cols]
+    # Chaves de comparação calculadas uma vez aqui e reaproveitadas na detecção e na gravação
+    return add_match_keys(df[final_cols])
+
+def source_labels(df):
+    """ARQUIVO exibido nas inconsistências; linhas vindas de planilha levam a aba: 'arquivo.xlsx [Aba]'"""
+    if 'arquivo_origem' not in df.columns: return pd.Series('-', index=df.index, dtype=object)
+    labels = df['arquivo_origem'].astype(object)
+    if 'aba_origem' in df.columns:
+        aba = df['aba_origem'].fillna('').astype(str)
+        labels = labels.where(aba == '', labels.astype(str) + ' [' + aba + ']')
+    return labels
 
 def detect_inconsistencies(df):
     if df is None or df.empty:
@@ -600,183 +1716,1281 @@ def detect_inconsistencies(df):
         if col not in df.columns:
             df[col] = ''
     
-    df_check = df.copy()
-    df_check['cpf_raw'] = df_check['cpf'].fillna('').astype(str).str.strip()
-    df_check['card_raw'] = df_check['num_cartao'].fillna('').astype(str).str.strip()
+    # Motor colunar: máscaras booleanas + groupby().transform, sem iterrows
+    cpf_raw = df['cpf'].fillna('').astype(str).str.strip()
+    card_raw = df['num_cartao'].fillna('').astype(str).str.strip()
+    keys = key_columns(df)
+    cpf_clean, card_clean = keys['cpf_clean'], keys['card_clean']
     
-    df_check['cpf_clean'] = df_check['cpf_raw'].str.replace(r'\D', '', regex=True)
-    df_check['card_clean'] = df_check['card_raw'].str.replace(r'^0+', '', regex=True).str.replace(r'\.0$', '', regex=True)
-    df_check['nome_clean'] = df_check['nome'].apply(remove_accents)
+    # Chave de nome gravada (ou normalizada uma vez por nome distinto); nome vazio não conta
+    nomes = (df['nome_key'] if 'nome_key' in df.columns else name_key(df['nome'])).fillna('')
+    nome_ids = pd.factorize(nomes)[0].astype(float)
+    nome_ids[(nomes == '').to_numpy()] = np.nan
     
-    errors = []
+    positions = np.arange(len(df))
+    blocks = []
+
+    # 1. AUSENCIA
+    cpf_missing = ((cpf_raw == '') | (cpf_raw.str.lower() == 'nan')).to_numpy()
+    card_missing = ((card_raw == '') | (card_raw.str.lower() == 'nan')).to_numpy()
+    aus_mask = cpf_missing | card_missing
+    if aus_mask.any():
+        msg = np.where(cpf_missing & card_missing, "CPF NÃO INFORMADO | CARTÃO NÃO INFORMADO",
+                       np.where(cpf_missing, "CPF NÃO INFORMADO", "CARTÃO NÃO INFORMADO"))
+        blocks.append({
+            'pos': positions[aus_mask],
+            'CPF': cpf_raw.where(cpf_raw != '', 'VAZIO').to_numpy(dtype=object)[aus_mask],
+            'CARTÃO': card_raw.where(card_raw != '', 'VAZIO').to_numpy(dtype=object)[aus_mask],
+            'ERRO': msg[aus_mask].astype(object),
+            'TIPO_ERRO': 'AUSENCIA'
+        })
+
+    valid = ((cpf_clean != '') & (cpf_clean.str.len() > 5)).to_numpy()
+    df_valid = pd.DataFrame({
+        'pos': positions[valid],
+        'cpf_clean': cpf_clean.to_numpy(dtype=object)[valid],
+        'card_clean': card_clean.to_numpy(dtype=object)[valid],
+        'nome_id': nome_ids[valid],
+    })
+    df_valid['card_nn'] = df_valid['card_clean'].where(df_valid['card_clean'] != '')
+
+    # 2. DUPLICIDADE: mesmo CPF com mais de um cartão ou nome
+    by_cpf = df_valid.groupby('cpf_clean')
+    card_conflict = by_cpf['card_nn'].transform('nunique') > 1
+    name_conflict = by_cpf['nome_id'].transform('nunique') > 1
+    dup = df_valid[card_conflict | name_conflict].sort_values('cpf_clean', kind='stable')
+    if not dup.empty:
+        # Valor original do cartão (None, NaN e '' aparecem como vieram), na ordem em que surgem
+        raw_cards = pd.DataFrame({
+            'cpf_clean': dup['cpf_clean'].to_numpy(),
+            'num_cartao': df['num_cartao'].iloc[dup['pos'].to_numpy()].reset_index(drop=True),
+        })[card_conflict[dup.index].to_numpy()]
+        card_msgs = raw_cards.groupby('cpf_clean', sort=False)['num_cartao'].agg(
+            lambda s: f"CONFLITO CARTÃO ({', '.join(map(str, s.unique()))})")
+        card_part = dup['cpf_clean'].map(card_msgs).fillna('').to_numpy(dtype=object)
+        has_card = card_conflict[dup.index].to_numpy()
+        has_name = name_conflict[dup.index].to_numpy()
+        msg = np.where(has_card & has_name, card_part + " | CONFLITO NOME",
+                       np.where(has_card, card_part, "CONFLITO NOME")).astype(object)
+        blocks.append({'pos': dup['pos'].to_numpy(), 'ERRO': msg, 'TIPO_ERRO': 'DUPLICIDADE'})
+
+    # 3. FRAUDE: mesmo cartão associado a CPFs diferentes
+    with_card = df_valid[df_valid['card_clean'] != '']
+    n_cpfs = with_card.groupby('card_clean')['cpf_clean'].transform('nunique')
+    fraud = with_card[n_cpfs > 1].sort_values('card_clean', kind='stable')
+    if not fraud.empty:
+        msg = "FRAUDE: CARTÃO USADO EM " + n_cpfs[fraud.index].astype(str) + " CPFs"
+        blocks.append({'pos': fraud['pos'].to_numpy(), 'ERRO': msg.to_numpy(dtype=object), 'TIPO_ERRO': 'FRAUDE'})
+
+    if not blocks: return pd.DataFrame()
+
+    def col_values(name, default):
+        if name not in df.columns: return np.full(len(df), default, dtype=object)
+        return df[name].to_numpy(dtype=object)
+
+    all_pos = np.concatenate([b['pos'] for b in blocks])
+    cols = {'ID': col_values('id', None), 'ARQUIVO': source_labels(df).to_numpy(dtype=object),
+            'LINHA': col_values('linha_arquivo', '-'), 'CPF': col_values('cpf', '-'),
+            'CARTÃO': col_values('num_cartao', '-'), 'NOME': col_values('nome', '-')}
+    data = {}
+    for name, values in cols.items():
+        if name in ('CPF', 'CARTÃO'):
+            data[name] = np.concatenate([b.get(name, values[b['pos']]) for b in blocks]).tolist()
+        else:
+            data[name] = values[all_pos].tolist()
+    data['ERRO'] = np.concatenate([b['ERRO'] for b in blocks]).tolist()
+    data['TIPO_ERRO'] = np.concatenate([np.full(len(b['pos']), b['TIPO_ERRO'], dtype=object) for b in blocks]).tolist()
 
-    for idx, row in df_check.iterrows():
-        motivos = []
-        is_error = False
-        
-        cpf_val = row['cpf_raw']
-        if not cpf_val or str(cpf_val).lower() == 'nan':
-            motivos.append("CPF NÃO INFORMADO")
-            is_error = True
-            
-        card_val = row['card_raw']
-        if not card_val or str(card_val).lower() == 'nan':
-            motivos.append("CARTÃO NÃO INFORMADO")
-            is_error = True
-            
-        if is_error:
-            errors.append({
-                'ID': row.get('id', None),
-                'ARQUIVO': row.get('arquivo_origem', '-'),
-                'LINHA': row.get('linha_arquivo', '-'),
-                'CPF': cpf_val if cpf_val else "VAZIO",
-                'CARTÃO': card_val if card_val else "VAZIO",
-                'NOME': row.get('nome', '-'),
-                'ERRO': " | ".join(motivos),
-                'TIPO_ERRO': 'AUSENCIA'
-            })
-
-    df_valid = df_check[ 
-        (df_check['cpf_clean'] != '') & 
-        (df_check['cpf_clean'].str.len() > 5)
-    ]
-
-    cpf_groups = df_valid.groupby('cpf_clean')
-    for cpf, group in cpf_groups:
-        unique_cards = [c for c in group['card_clean'].unique() if c]
-        unique_names = [n for n in group['nome_clean'].unique() if n]
-
-        has_card_conflict = len(unique_cards) > 1
-        has_name_conflict = len(unique_names) > 1
-        
-        if has_card_conflict or has_name_conflict:
-            motivo_dup = []
-            if has_card_conflict: 
-                cards_orig = group['num_cartao'].unique()
-                motivo_dup.append(f"CONFLITO CARTÃO ({', '.join(map(str, cards_orig))})")
-            if has_name_conflict: 
-                motivo_dup.append(f"CONFLITO NOME")
-            
-            err_msg = " | ".join(motivo_dup)
-            for _, row in group.iterrows():
-                errors.append({
-                    'ID': row.get('id', None),
-                    'ARQUIVO': row.get('arquivo_origem', '-'),
-                    'LINHA': row.get('linha_arquivo', '-'),
-                    'CPF': row.get('cpf', '-'),
-                    'CARTÃO': row.get('num_cartao', '-'),
-                    'NOME': row.get('nome', '-'),
-                    'ERRO': err_msg,
-                    'TIPO_ERRO': 'DUPLICIDADE'
-                })
-
-    card_groups = df_valid.groupby('card_clean')
-    for card, group in card_groups:
-        if not card: continue
-        unique_cpfs = [c for c in group['cpf_clean'].unique() if c]
-        
-        if len(unique_cpfs) > 1:
-            for _, row in group.iterrows():
-                errors.append({
-                    'ID': row.get('id', None),
-                    'ARQUIVO': row.get('arquivo_origem', '-'),
-                    'LINHA': row.get('linha_arquivo', '-'),
-                    'CPF': row.get('cpf', '-'),
-                    'CARTÃO': row.get('num_cartao', '-'),
-                    'NOME': row.get('nome', '-'),
-                    'ERRO': f"FRAUDE: CARTÃO USADO EM {len(unique_cpfs)} CPFs",
-                    'TIPO_ERRO': 'FRAUDE'
-                })
-
-    if not errors: return pd.DataFrame()
-    
-    res_df = pd.DataFrame(errors)
+    res_df = pd.DataFrame(data)
     res_df['PRIORIDADE'] = res_df['TIPO_ERRO'].map({'AUSENCIA': 1, 'FRAUDE': 2, 'DUPLICIDADE': 3})
     res_df = res_df.sort_values('PRIORIDADE')
     
     return res_df.drop_duplicates(subset=['ARQUIVO', 'LINHA', 'CPF', 'CARTÃO', 'ERRO']).drop(columns=['PRIORIDADE', 'TIPO_ERRO'])
 
+# ===========================================
+# ÍNDICE PERSISTENTE CPF <-> CARTÃO
+# ===========================================
+
+def card_key(s):
+    """Cartão normalizado: sem espaços, zeros à esquerda e '.0' do Excel"""
+    return s.fillna('').astype(str).str.strip().str.replace(r'^0+', '', regex=True).str.replace(r'\.0$', '', regex=True)
+
+def cpf_key(s):
+    """CPF normalizado: só dígitos, com os zeros à esquerda perdidos pelo Excel (ver pad_cpf)"""
+    return pad_cpf(s.fillna('').astype(str).str.strip().str.replace(r'\D', '', regex=True))
+
+def map_distinct(func, s):
+    """func aplicada uma vez por valor distinto de s"""
+    codes, uniques = pd.factorize(s, use_na_sentinel=False)
+    return pd.Series(np.array([func(v) for v in uniques], dtype=object)[codes], index=s.index)
+
+def name_key(s):
+    """Nome normalizado (normalize_name) calculado uma vez por nome distinto"""
+    return map_distinct(normalize_name, s)
+
+# Chaves canônicas gravadas junto de cada linha (payments e bank_discrepancies), com índice.
+# Toda comparação por cartão/CPF/nome lê estas colunas em vez de normalizar texto de novo.
+MATCH_KEY_COLUMNS = ['card_key', 'cpf_key', 'nome_key']
+MATCH_KEY_FUNCS = {'card_key': card_key, 'cpf_key': cpf_key, 'nome_key': name_key}
+PAYMENT_KEY_SOURCES = {'card_key': 'num_cartao', 'cpf_key': 'cpf', 'nome_key': 'nome'}
+BANK_KEY_SOURCES = {'card_key': 'cartao', 'cpf_key': 'cpf_bb', 'nome_key': 'nome_bb'}
+
+def add_match_keys(df, sources=PAYMENT_KEY_SOURCES):
+    """Calcula em lote as chaves ausentes em df; chaves já presentes são mantidas"""
+    missing = {k: src for k, src in sources.items() if k not in df.columns}
+    if not missing: return df
+    return df.assign(**{k: MATCH_KEY_FUNCS[k](df[src]) if src in df.columns else ''
+                        for k, src in missing.items()})
+
+def key_columns(df):
+    if 'card_key' in df.columns and 'cpf_key' in df.columns:
+        return pd.DataFrame({'cpf_clean': df['cpf_key'].fillna(''), 'card_clean': df['card_key'].fillna('')}, index=df.index)
+    return pd.DataFrame({
+        'cpf_clean': cpf_key(df['cpf']),
+        'card_clean': card_key(df['num_cartao']),
+    }, index=df.index)
+
+def extract_key_pairs(df):
+    """Pares (cpf_clean, card_clean) válidos com contagem de registros, nas mesmas regras da Malha Fina"""
+    has_keys = {'card_key', 'cpf_key'} <= set(df.columns) if df is not None else False
+    if df is None or df.empty or not (has_keys or {'cpf', 'num_cartao'} <= set(df.columns)):
+        return pd.DataFrame(columns=['cpf_clean', 'card_clean', 'qtd'])
+    keys = key_columns(df)
+    keys = keys[(keys['cpf_clean'].str.len() > 5) & (keys['card_clean'] != '')]
+    return keys.groupby(['cpf_clean', 'card_clean']).size().reset_index(name='qtd')
+
+def key_index_add(conn, df):
+    pairs = extract_key_pairs(df)
+    if pairs.empty: return
+    conn.executemany("""
+        INSERT INTO payment_keys (cpf_clean, card_clean, qtd_registros) VALUES (?, ?, ?)
+        ON CONFLICT(cpf_clean, card_clean) DO UPDATE SET qtd_registros = qtd_registros + excluded.qtd_registros
+    """, pairs.itertuples(index=False, name=None))
+
+def key_index_remove(conn, df):
+    pairs = extract_key_pairs(df)
+    if pairs.empty: return
+    conn.executemany("UPDATE payment_keys SET qtd_registros = qtd_registros - ? WHERE cpf_clean = ? AND card_clean = ?",
+                     pairs[['qtd', 'cpf_clean', 'card_clean']].itertuples(index=False, name=None))
+    conn.execute("DELETE FROM payment_keys WHERE qtd_registros <= 0")
+
+def rebuild_key_index(conn):
+    """Reconstrói o índice a partir de toda a tabela payments (commit fica com o chamador)"""
+    conn.execute("DELETE FROM payment_keys")
+    if 'card_key' in payments_table_columns(conn):
+        conn.execute("""
+            INSERT INTO payment_keys (cpf_clean, card_clean, qtd_registros)
+            SELECT cpf_key, card_key, COUNT(*) FROM payments
+            WHERE length(cpf_key) > 5 AND card_key != '' GROUP BY cpf_key, card_key
+        """)
+        return
+    # Bases anteriores à migração das chaves gravadas
+    for chunk in pd.read_sql("SELECT cpf, num_cartao FROM payments", conn, chunksize=200000):
+        key_index_add(conn, chunk)
+
+def check_keys_against_history(conn, df):
+    """
+    Confere apenas as chaves do lote novo contra o histórico completo via payment_keys.
+    Deve ser chamada antes de gravar o lote, para que o índice reflita só o histórico.
+    """
+    pairs = extract_key_pairs(df)
+    if pairs.empty: return pd.DataFrame()
+    
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_batch_keys (cpf_clean TEXT, card_clean TEXT)")
+    conn.execute("DELETE FROM tmp_batch_keys")
+    conn.executemany("INSERT INTO tmp_batch_keys VALUES (?, ?)", pairs[['cpf_clean', 'card_clean']].itertuples(index=False, name=None))
+    hist_card = pd.read_sql("""
+        SELECT k.card_clean, k.cpf_clean AS cpf_hist FROM payment_keys k
+        WHERE k.card_clean IN (SELECT card_clean FROM tmp_batch_keys)
+    """, conn)
+    hist_cpf = pd.read_sql("""
+        SELECT k.cpf_clean, k.card_clean AS card_hist FROM payment_keys k
+        WHERE k.cpf_clean IN (SELECT cpf_clean FROM tmp_batch_keys)
+    """, conn)
+    conn.execute("DELETE FROM tmp_batch_keys")
+    
+    # Cartão do lote já vinculado a outro CPF no histórico
+    fraud = pairs.merge(hist_card, on='card_clean')
+    fraud = fraud[fraud['cpf_hist'] != fraud['cpf_clean']]
+    fraud_msg = fraud.groupby(['cpf_clean', 'card_clean'])['cpf_hist'].agg(
+        lambda s: f"FRAUDE: CARTÃO JÁ VINCULADO A OUTRO CPF NO HISTÓRICO ({', '.join(sorted(s))})")
+    
+    # CPF do lote já associado a outro cartão no histórico
+    dup = pairs.merge(hist_cpf, on='cpf_clean')
+    dup = dup[dup['card_hist'] != dup['card_clean']]
+    dup_msg = dup.groupby(['cpf_clean', 'card_clean'])['card_hist'].agg(
+        lambda s: f"CONFLITO CARTÃO COM HISTÓRICO ({', '.join(sorted(s))})")
+    
+    msgs = pd.concat([fraud_msg, dup_msg]).groupby(level=[0, 1]).agg(" | ".join)
+    if msgs.empty: return pd.DataFrame()
+    msgs = msgs.rename('ERRO').reset_index()
+    
+    rows = pd.concat([df, key_columns(df)], axis=1).merge(msgs, on=['cpf_clean', 'card_clean'])
+    return pd.DataFrame({
+        'ID': None,
+        'ARQUIVO': source_labels(rows),
+        'LINHA': rows['linha_arquivo'] if 'linha_arquivo' in rows.columns else '-',
+        'CPF': rows['cpf'],
+        'CARTÃO': rows['num_cartao'],
+        'NOME': rows['nome'] if 'nome' in rows.columns else '-',
+        'ERRO': rows['ERRO'],
+    })
+
+# ===========================================
+# CONFERÊNCIA BANCÁRIA (CRUZAMENTO EM SQL)
+# ===========================================
+
+BANK_DISCREPANCY_COLUMNS = ['cartao', 'nome_sis', 'nome_bb', 'cpf_sis', 'cpf_bb', 'rg_sis', 'rg_bb', 'divergencia', 'arquivo_origem', 'tipo_erro']
+BANK_DISCREPANCY_KEY = ['cartao', 'tipo_erro', 'arquivo_origem']  # única em bank_discrepancies
+
+def reconcile_bank_records(conn, bank_df):
+    """
+    Cruza os registros do banco com o histórico dentro do SQLite. Os registros distintos do
+    banco vão para uma tabela temporária com as mesmas chaves canônicas gravadas em payments;
+    do histórico saem, pelo índice de card_key, só as identidades distintas desses cartões,
+    então um cartão pago em 24 competências é comparado uma única vez.
+    Devolve as divergências nas colunas de bank_discrepancies, já com as chaves.
+    """
+    bank = pd.DataFrame({
+        'cartao': card_key(bank_df['num_cartao']),
+        'nome_bb': bank_df['nome_banco'],
+        'cpf_bb': bank_df['cpf_banco'].fillna('').astype(str).str.strip(),
+        'rg_bb': bank_df['rg_banco'],
+        'arquivo_origem': bank_df['arquivo_origem'],
+    }).drop_duplicates()
+    bank = bank[bank['cartao'] != '']
+    if bank.empty: return pd.DataFrame(columns=BANK_DISCREPANCY_COLUMNS + MATCH_KEY_COLUMNS)
+    bank = add_match_keys(bank, BANK_KEY_SOURCES)
+
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS tmp_bank (
+            card_key TEXT, cpf_key TEXT, nome_key TEXT, nome_bb TEXT, cpf_bb TEXT, rg_bb TEXT, arquivo_origem TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS temp.idx_tmp_bank_card ON tmp_bank (card_key)")
+    conn.execute("DELETE FROM tmp_bank")
+    cols = ['card_key', 'cpf_key', 'nome_key', 'nome_bb', 'cpf_bb', 'rg_bb', 'arquivo_origem']
+    conn.executemany(f"INSERT INTO tmp_bank ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                     bank[cols].astype(object).where(bank[cols].notna(), None).itertuples(index=False, name=None))
+
+    # Uma linha por identidade do histórico (chaves normalizadas) dos cartões do lote: RG,
+    # pontuação ou acentos diferentes não contam como outra identidade. Nome/CPF/RG exibidos
+    # são os do pagamento mais recente dela.
+    conn.execute("DROP TABLE IF EXISTS temp.tmp_bank_sis")
+    conn.execute("""
+        CREATE TEMP TABLE tmp_bank_sis AS
+        SELECT p.card_key, p.nome_key, p.cpf_key, p.nome, p.cpf, p.rg
+        FROM payments p
+        JOIN (
+            SELECT MAX(id) AS id FROM payments
+            WHERE card_key IN (SELECT card_key FROM tmp_bank)
+            GROUP BY card_key, nome_key, cpf_key
+        ) u ON u.id = p.id
+    """)
+
+    divs = pd.read_sql("""
+        SELECT b.card_key AS cartao, s.nome AS nome_sis, b.nome_bb, s.cpf AS cpf_sis, b.cpf_bb, s.rg AS rg_sis, b.rg_bb,
+               'ALERTA MÁXIMO: NOME DIVERGENTE' AS divergencia, b.arquivo_origem, 'SUSPEITA_TROCA_TITULARIDADE' AS tipo_erro
+        FROM tmp_bank_sis s
+        JOIN tmp_bank b ON b.card_key = s.card_key
+        WHERE coalesce(s.nome_key, '') != b.nome_key
+        UNION ALL
+        SELECT b.card_key, s.nome, b.nome_bb, s.cpf, b.cpf_bb, s.rg, b.rg_bb,
+               'CPF DIVERGENTE (FRAUDE)', b.arquivo_origem, 'DADOS_CADASTRAIS'
+        FROM tmp_bank_sis s
+        JOIN tmp_bank b ON b.card_key = s.card_key
+        WHERE length(b.cpf_bb) > 5 AND coalesce(s.cpf_key, '') != b.cpf_key
+    """, conn)
+    conn.execute("DELETE FROM tmp_bank")
+    conn.execute("DROP TABLE IF EXISTS temp.tmp_bank_sis")
+    return add_match_keys(collapse_bank_discrepancies(divs), BANK_KEY_SOURCES)
+
+def collapse_bank_discrepancies(divs):
+    """
+    Uma divergência por (cartao, tipo_erro, arquivo_origem), a chave única de
+    bank_discrepancies: sem isso o upsert funde as linhas e a contagem informada não bate
+    com a gravada. Um cartão com várias identidades no histórico junta os valores do
+    sistema (distintos, separados por " | "); os do banco são os da primeira linha em ordem.
+    """
+    if divs.empty: return divs
+    divs = divs.sort_values(BANK_DISCREPANCY_KEY + ['nome_bb', 'cpf_bb', 'rg_bb', 'nome_sis', 'cpf_sis', 'rg_sis'],
+                            na_position='last', kind='stable')
+    dup = divs.duplicated(BANK_DISCREPANCY_KEY, keep=False)
+    if not dup.any(): return divs.reset_index(drop=True)
+    join_values = lambda s: ' | '.join(s.dropna().astype(str).unique()) or None
+    agg = {c: join_values if c in ('nome_sis', 'cpf_sis', 'rg_sis') else 'first'
+           for c in BANK_DISCREPANCY_COLUMNS if c not in BANK_DISCREPANCY_KEY}
+    merged = divs[dup].groupby(BANK_DISCREPANCY_KEY, sort=False).agg(agg).reset_index()
+    return pd.concat([divs[~dup], merged[BANK_DISCREPANCY_COLUMNS]], ignore_index=True)
+
+def file_content_hash(file_obj, block_size=1 << 20):
+    """SHA-256 do conteúdo do upload, lido em blocos; o cursor volta ao início"""
+    h = hashlib.sha256()
+    file_obj.seek(0)
+    for block in iter(lambda: file_obj.read(block_size), b''):
+        h.update(block)
+    file_obj.seek(0)
+    return h.hexdigest()
+
+def get_processed_bank_files(conn, hashes):
+    """{hash: (arquivo, processado_em)} dos arquivos já conferidos"""
+    hashes = list(hashes)
+    if not hashes: return {}
+    rows = conn.execute(f"""
+        SELECT hash_conteudo, arquivo, processado_em FROM bank_reconciliation_runs
+        WHERE hash_conteudo IN ({','.join('?' * len(hashes))})
+    """, hashes).fetchall()
+    return {h: (arquivo, quando) for h, arquivo, quando in rows}
+
+def save_bank_discrepancies(conn, dd):
+    """
+    Grava as divergências por upsert em (cartao, tipo_erro, arquivo_origem): reconferir um
+    arquivo só atualiza o que já existe. Devolve quantas divergências são novas.
+    """
+    if dd.empty: return 0
+    cols = BANK_DISCREPANCY_COLUMNS + MATCH_KEY_COLUMNS
+    updates = ', '.join(f"{c} = excluded.{c}" for c in cols if c not in BANK_DISCREPANCY_KEY)
+    before = conn.execute("SELECT COUNT(*) FROM bank_discrepancies").fetchone()[0]
+    conn.executemany(f"""
+        INSERT INTO bank_discrepancies ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})
+        ON CONFLICT(cartao, tipo_erro, arquivo_origem) DO UPDATE SET {updates}, created_at = CURRENT_TIMESTAMP
+    """, dd[cols].astype(object).where(dd[cols].notna(), None).itertuples(index=False, name=None))
+    return conn.execute("SELECT COUNT(*) FROM bank_discrepancies").fetchone()[0] - before
+
+def record_bank_runs(conn, runs):
+    """runs: [(hash, arquivo, tipo_arquivo, qtd_registros, qtd_divergencias)]"""
+    conn.executemany("""
+        INSERT INTO bank_reconciliation_runs (hash_conteudo, arquivo, tipo_arquivo, qtd_registros, qtd_divergencias)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(hash_conteudo) DO UPDATE SET
+            arquivo = excluded.arquivo, tipo_arquivo = excluded.tipo_arquivo, qtd_registros = excluded.qtd_registros,
+            qtd_divergencias = excluded.qtd_divergencias, processado_em = CURRENT_TIMESTAMP
+    """, runs)
+
+# ===========================================
+# ROLLUP DO DASHBOARD (COMPETÊNCIA x PROGRAMA x GERENCIADORA)
+# ===========================================
+
+def competencia_filter(competencias):
+    """WHERE para uma lista de competências, incluindo NULL quando presente"""
+    values = [c for c in competencias if c is not None and not pd.isna(c)]
+    parts = []
+    if values: parts.append(f"competencia IN ({','.join('?' * len(values))})")
+    if len(values) < len(competencias): parts.append("competencia IS NULL")
+    return " OR ".join(parts) or "0", tuple(values)
+
+def refresh_rollup(conn, competencias):
+    """
+    Recalcula só as competências tocadas por uma escrita (índice em competencia).
+    Contagens distintas não admitem delta, então a competência inteira é reagregada.
+    """
+    competencias = list(pd.unique(pd.Series(list(competencias), dtype=object)))
+    if not competencias: return
+    where, params = competencia_filter(competencias)
+    conn.execute(f"DELETE FROM payments_rollup WHERE {where}", params)
+    conn.execute(f"""
+        INSERT INTO payments_rollup (competencia, programa, gerenciadora, valor_total, qtd_registros, qtd_beneficiarios, primeiro_id)
+        SELECT competencia, programa, gerenciadora, COALESCE(SUM(valor_pagto), 0), COUNT(*), COUNT(DISTINCT num_cartao), MIN(id)
+        FROM payments WHERE {where}
+        GROUP BY competencia, programa, gerenciadora
+    """, params)
+
+def rollup_cards_add(conn, df):
+    if 'num_cartao' not in df.columns: return
+    counts = df['num_cartao'].dropna().value_counts()
+    conn.executemany("""
+        INSERT INTO payments_rollup_cards (num_cartao, qtd_registros) VALUES (?, ?)
+        ON CONFLICT(num_cartao) DO UPDATE SET qtd_registros = qtd_registros + excluded.qtd_registros
+    """, ((str(k), int(v)) for k, v in counts.items()))
+
+def rollup_cards_remove(conn, df):
+    counts = df['num_cartao'].dropna().value_counts()
+    conn.executemany("UPDATE payments_rollup_cards SET qtd_registros = qtd_registros - ? WHERE num_cartao = ?",
+                     ((int(v), str(k)) for k, v in counts.items()))
+    conn.execute("DELETE FROM payments_rollup_cards WHERE qtd_registros <= 0")
+
+def rebuild_rollup(conn):
+    """Reconstrução completa dos agregados (recuperação; commit fica com o chamador)"""
+    conn.execute("DELETE FROM payments_rollup")
+    conn.execute("""
+        INSERT INTO payments_rollup (competencia, programa, gerenciadora, valor_total, qtd_registros, qtd_beneficiarios, primeiro_id)
+        SELECT competencia, programa, gerenciadora, COALESCE(SUM(valor_pagto), 0), COUNT(*), COUNT(DISTINCT num_cartao), MIN(id)
+        FROM payments GROUP BY competencia, programa, gerenciadora
+    """)
+    conn.execute("DELETE FROM payments_rollup_cards")
+    conn.execute("""
+        INSERT INTO payments_rollup_cards (num_cartao, qtd_registros)
+        SELECT num_cartao, COUNT(*) FROM payments WHERE num_cartao IS NOT NULL GROUP BY num_cartao
+    """)
+
+# ===========================================
+# GRAVAÇÃO DE PAGAMENTOS (ÍNDICE + ROLLUP + CACHE)
+# ===========================================
+# Toda escrita em payments passa por aqui para manter as estruturas derivadas
+# na mesma transação. O commit fica sempre com o chamador.
+
+def payments_table_columns(conn):
+    return [row[1] for row in conn.execute("PRAGMA table_info(payments)")]
+
+def insert_payments(conn, df, rollup=True):
+    """rollup=False adia o recálculo do rollup (ingestão em blocos chama refresh_rollup ao final)"""
+    if df is None or df.empty: return
+    df = add_match_keys(df)
+    cols = [c for c in payments_table_columns(conn) if c in df.columns]
+    values = df[cols].astype(object)
+    values = values.where(df[cols].notna(), None)
+    conn.executemany(f"INSERT INTO payments ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                     values.itertuples(index=False, name=None))
+    key_index_add(conn, df)
+    rollup_cards_add(conn, df)
+    if rollup: refresh_rollup(conn, df['competencia'] if 'competencia' in df.columns else [None])
+    bump_generation(conn)
+
+def delete_payments(conn, where_sql, params=(), bulk=False):
+    """bulk=True (arquivo inteiro): ver delete_payments_untracked; o snapshot é refeito"""
+    removed = pd.read_sql(f"SELECT cpf, num_cartao, competencia, card_key, cpf_key FROM payments WHERE {where_sql}", conn, params=params)
+    if removed.empty: return
+    if bulk: delete_payments_untracked(conn, where_sql, params)
+    else: conn.execute(f"DELETE FROM payments WHERE {where_sql}", params)
+    key_index_remove(conn, removed)
+    rollup_cards_remove(conn, removed)
+    refresh_rollup(conn, removed['competencia'])
+    bump_generation(conn)
+
+# ===========================================
+# DETECÇÃO DE LAYOUT DE CSV (CODIFICAÇÃO, SEPARADOR, CABEÇALHO)
+# ===========================================
+# Só os primeiros KB são inspecionados; o arquivo é lido uma única vez com o layout
+# escolhido. Layouts detectados ficam em cache pela impressão digital da linha de
+# cabeçalho, então novos envios da mesma gerenciadora pulam a detecção.
+
+CSV_SNIFF_BYTES = 16384
+CSV_SNIFF_LINES = 30
+CSV_DELIMITERS = ';,\t|'
+CSV_HEADER_MIN_COLUMNS = 3   # colunas reconhecidas pelo COLUMN_MAP para aceitar uma linha como cabeçalho
+CSV_LAYOUT_CACHE_MAX = 512
+
+class LayoutCache:
+    """LRU de layouts de CSV por hash da linha de cabeçalho"""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries: return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, layout):
+        with self.lock:
+            self.entries[key] = layout
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries: self.entries.popitem(last=False)
+
+@st.cache_resource
+def get_csv_layout_cache():
+    return LayoutCache(CSV_LAYOUT_CACHE_MAX)
+
+def header_fingerprint(raw_line):
+    return hashlib.md5(raw_line.rstrip(b'\r')).hexdigest()
+
+def detect_encoding(sample):
+    """BOM, depois UTF-8 estrito, depois chardet; amostra só ASCII (ou sem palpite confiável) fica em latin1"""
+    if sample.startswith(b'\xef\xbb\xbf'): return 'utf-8-sig'
+    if sample.startswith((b'\xff\xfe', b'\xfe\xff')): return 'utf-16'
+    if sample.isascii(): return 'latin1'
+    try:
+        sample.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # Amostra cortada no meio de um caractere multibyte ainda é UTF-8
+        if e.start >= len(sample) - 3 and e.reason == 'unexpected end of data': return 'utf-8'
+    if chardet is not None:
+        guess = chardet.detect(sample)
+        if guess.get('encoding') and (guess.get('confidence') or 0) >= 0.7: return guess['encoding']
+    return 'latin1'
+
+def sniff_delimiter(lines):
+    """Separador presente no maior número de linhas com a mesma contagem (empate: mais campos)"""
+    best, best_score = ';', (0, 0)
+    for sep in CSV_DELIMITERS:
+        counts = Counter(n for n in (line.count(sep) for line in lines) if n)
+        if not counts: continue
+        n_fields, n_lines = counts.most_common(1)[0]
+        if (n_lines, n_fields) > best_score: best, best_score = sep, (n_lines, n_fields)
+    return best
+
+def sniff_header_row(lines, sep):
+    """Primeira linha com ao menos CSV_HEADER_MIN_COLUMNS colunas reconhecidas; None se não houver"""
+    for i, fields in enumerate(csv.reader(lines, delimiter=sep)):
+        if len({map_column_name(f.strip()) for f in fields} - {None}) >= CSV_HEADER_MIN_COLUMNS: return i
+    return None
+
+def sniff_csv_layout(file_obj):
+    """{'encoding', 'sep', 'header_row'} a partir dos primeiros CSV_SNIFF_BYTES; devolve o arquivo no início"""
+    sample = file_obj.read(CSV_SNIFF_BYTES)
+    file_obj.seek(0)
+    raw_lines = sample.split(b'\n')[:CSV_SNIFF_LINES]
+    cache = get_csv_layout_cache()
+    for i, raw_line in enumerate(raw_lines):
+        cached = cache.get(header_fingerprint(raw_line))
+        if cached: return dict(cached, header_row=i)
+
+    encoding = detect_encoding(sample)
+    lines = sample.decode(encoding, errors='ignore').split('\n')
+    if len(sample) == CSV_SNIFF_BYTES: lines = lines[:-1]   # última linha pode estar cortada
+    lines = [line.rstrip('\r') for line in lines[:CSV_SNIFF_LINES]]
+    sep = sniff_delimiter(lines)
+    header_row = sniff_header_row(lines, sep)
+    # Linhas em bytes só batem com as de texto em codificações compatíveis com ASCII
+    if header_row is not None and header_row < len(raw_lines) and not encoding.lower().startswith(('utf-16', 'utf-32')):
+        cache.put(header_fingerprint(raw_lines[header_row]), {'encoding': encoding, 'sep': sep})
+    return {'encoding': encoding, 'sep': sep, 'header_row': header_row or 0}
+
+def read_csv_layout(file_obj, layout, **kwargs):
+    # latin1 decodifica qualquer byte; nas demais, um byte inválido fora da amostra não derruba a leitura
+    errors = 'strict' if codecs.lookup(layout['encoding']).name == 'iso8859-1' else 'replace'
+    return pd.read_csv(file_obj, sep=layout['sep'], encoding=layout['encoding'], encoding_errors=errors,
+                       skiprows=layout['header_row'], dtype=str, **kwargs)
+
+# ===========================================
+# INGESTÃO EM STREAMING (CSV / XLSX GRANDE)
+# ===========================================
+
+STREAM_THRESHOLD_MB = 50   # CSVs acima disso são lidos, padronizados e gravados em blocos
+XLSX_STREAM_THRESHOLD_MB = 10   # XLSX é zip: 10 MB compactados já passam de milhões de células
+CSV_CHUNK_ROWS = 100000
+XLSX_CHUNK_ROWS = 50000
+
+def read_csv_chunks(file_obj, chunk_rows=CSV_CHUNK_ROWS, layout=None):
+    """Uma única leitura com o layout farejado; o índice compensa as linhas antes do cabeçalho"""
+    layout = layout or sniff_csv_layout(file_obj)
+    for chunk in read_csv_layout(file_obj, layout, chunksize=chunk_rows):
+        chunk.index += layout['header_row']
+        yield chunk
+
+def xlsx_cell_text(value):
+    """Mesma conversão do read_excel(dtype=str): 12.0 -> '12', data -> 'AAAA-MM-DD HH:MM:SS'"""
+    if value is None or value == '': return None
+    if isinstance(value, float) and value.is_integer(): return str(int(value))
+    return str(value)
+
+def xlsx_header(row):
+    """Cabeçalho como o pandas monta: célula vazia vira 'Unnamed: i', repetidos ganham '.1', '.2'..."""
+    header, seen = [], Counter()
+    for i, value in enumerate(row):
+        name = xlsx_cell_text(value) or f"Unnamed: {i}"
+        if seen[name]: header.append(f"{name}.{seen[name]}")
+        else: header.append(name)
+        seen[name] += 1
+    return header
+
+def read_xlsx_chunks(file_obj, chunk_rows=XLSX_CHUNK_ROWS):
+    """
+    Percorre todas as abas de um XLSX em modo read_only (linhas lidas direto do XML, sem
+    carregar a planilha inteira) e devolve (aba, bloco) com até chunk_rows linhas.
+    Em cada aba o cabeçalho é a primeira linha não vazia e linhas totalmente vazias são
+    puladas; o índice do bloco é o número da linha na aba - 2, para que linha_arquivo
+    aponte a linha real da planilha.
+    """
+    wb = openpyxl.load_workbook(file_obj, read_only=True, data_only=True)
+    try:
+        for ws in wb.worksheets:
+            # A dimensão gravada por alguns geradores de planilha é errada; lê até a última linha real
+            ws.reset_dimensions()
+            header, rows, index = None, [], []
+            for n, row in enumerate(ws.iter_rows(values_only=True), start=1):
+                values = [xlsx_cell_text(v) for v in row]
+                if not any(v is not None and v.strip() for v in values): continue
+                if header is None:
+                    header = xlsx_header(row)
+                    continue
+                values = values[:len(header)] + [None] * (len(header) - len(values))
+                rows.append(values)
+                index.append(n - 2)
+                if len(rows) >= chunk_rows:
+                    yield ws.title, pd.DataFrame(rows, columns=header, index=index, dtype=str)
+                    rows, index = [], []
+            if rows: yield ws.title, pd.DataFrame(rows, columns=header, index=index, dtype=str)
+    finally:
+        wb.close()
+
+def is_xlsx(filename):
+    return filename.lower().endswith(('.xlsx', '.xlsm')) and openpyxl is not None
+
+def read_upload_chunks(file_obj, filename, layout=None):
+    """(aba, bloco) de um arquivo de upload; CSV tem uma única 'aba' None"""
+    if is_xlsx(filename):
+        yield from read_xlsx_chunks(file_obj)
+    else:
+        for chunk in read_csv_chunks(file_obj, layout=layout): yield None, chunk
+
+def is_large_upload(f):
+    size_mb = getattr(f, 'size', 0) / 1024 ** 2
+    if f.name.endswith('.csv'): return size_mb > STREAM_THRESHOLD_MB
+    return is_xlsx(f.name) and size_mb > XLSX_STREAM_THRESHOLD_MB
+
+def standardize_chunks(chunks, filename, falhas=None):
+    """
+    Padroniza uma sequência de (aba, bloco). Cada aba tem seu próprio ctx (mes_ref/ano_ref)
+    e sua própria linha de totais: um bloco fica retido até o próximo chegar, e só o último
+    de cada aba passa por remove_total_row.
+    """
+    ctxs = {}
+    pending = None
+    for sheet, chunk in chunks:
+        if pending is not None:
+            yield standardize_dataframe(pending[1], filename, ctx=ctxs.setdefault(pending[0], {}),
+                                        drop_total_row=pending[0] != sheet, sheet_name=pending[0], falhas=falhas)
+        pending = (sheet, chunk)
+    if pending is not None:
+        yield standardize_dataframe(pending[1], filename, ctx=ctxs.setdefault(pending[0], {}),
+                                    drop_total_row=True, sheet_name=pending[0], falhas=falhas)
+
+def ingest_file_streaming(conn, file_obj, filename, falhas=None, layout=None):
+    """
+    Lê, padroniza, valida e grava um CSV/XLSX bloco a bloco, com memória limitada ao tamanho
+    do bloco. No CSV o índice do read_csv continua entre blocos, então linha_arquivo segue a
+    numeração do arquivo; no XLSX segue a numeração de cada aba (ver read_xlsx_chunks).
+    Tudo roda na transação de conn (commit fica com o chamador).
+    """
+    issues, conflicts, competencias = [], [], set()
+    total = 0
+    for std in standardize_chunks(read_upload_chunks(file_obj, filename, layout), filename, falhas):
+        if std.empty: continue
+        # O índice de chaves já contém os blocos anteriores (mesma transação)
+        conflicts.append(check_keys_against_history(conn, std))
+        issues.append(detect_inconsistencies(std))
+        insert_payments(conn, std, rollup=False)
+        competencias.update(std['competencia'].unique())
+        total += len(std)
+    refresh_rollup(conn, competencias)
+
+    issues = [d for d in issues if not d.empty]
+    conflicts = [d for d in conflicts if not d.empty]
+    return (total,
+            pd.concat(issues, ignore_index=True) if issues else pd.DataFrame(),
+            pd.concat(conflicts, ignore_index=True) if conflicts else pd.DataFrame())
+
+# ===========================================
+# PROCESSAMENTO PARALELO (POOL DE PROCESSOS)
+# ===========================================
+
+UPLOAD_WORKERS = os.cpu_count() or 1
+
+WORKER_POOL_TIMEOUT = 60 * 60  # segundos para o pool inteiro; depois disso os filhos são encerrados
+
+def stop_process_pool(ex):
+    """Encerra os filhos na hora (shutdown sozinho esperaria um filho travado)"""
+    for p in list((getattr(ex, '_processes', None) or {}).values()):
+        if p.is_alive(): p.terminate()
+    ex.shutdown(wait=False, cancel_futures=True)
+
+def run_process_pool(func, args_list, max_workers=None, on_progress=None, timeout=WORKER_POOL_TIMEOUT):
+    """
+    Executa func(*args) para cada tupla de args_list em processos filhos e devolve os
+    resultados na ordem, como lista de (resultado, erro). Os filhos nascem por spawn, não
+    por fork: o servidor do Streamlit tem várias threads (sessões, tarefas) e um filho
+    copiado com um lock delas travado fica preso para sempre. Cada filho carrega o app.py
+    via pot_workers e chama func pelo nome, então func é de nível de módulo e args precisam
+    ser serializáveis. Com um único item/worker roda no próprio processo. Passado timeout
+    (segundos, no total) os filhos são encerrados e sobe RuntimeError, que falha a tarefa.
+    on_progress(feitos, total) a cada item.
+    """
+    n_workers = min(max_workers or UPLOAD_WORKERS, len(args_list))
+    if n_workers <= 1:
+        out = []
+        for args in args_list:
+            try: out.append((func(*args), None))
+            except Exception as e: out.append((None, str(e)))
+            if on_progress: on_progress(len(out), len(args_list))
+        return out
+
+    ex = ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn'))
+    futures = {ex.submit(pot_workers.call, func.__name__, args): i for i, args in enumerate(args_list)}
+    out = [None] * len(args_list)
+    try:
+        for done, fut in enumerate(as_completed(futures, timeout=timeout), 1):
+            out[futures[fut]] = fut.result()
+            if on_progress: on_progress(done, len(args_list))
+    except FuturesTimeout:
+        stop_process_pool(ex)
+        raise RuntimeError(f"Processamento paralelo excedeu o limite de {timeout:.0f} s; processos encerrados")
+    except BrokenProcessPool:
+        stop_process_pool(ex)
+        raise RuntimeError("Um processo de trabalho terminou inesperadamente (memória insuficiente?)")
+    except BaseException:
+        stop_process_pool(ex)
+        raise
+    ex.shutdown()
+    return out
+
+def read_upload_bytes(name, data, layout=None):
+    """Entrada do pool: o JobFile (classe do __main__ do Streamlit) não passa pelo pickle"""
+    return read_upload_file(JobFile(name, data), layout)
+
+def read_upload_file(f, layout=None):
+    """
+    Etapa paralelizável do upload: leitura + standardize_dataframe. Devolve (df, avisos).
+    layout: layout do CSV já farejado no processo principal (onde fica o cache de layouts).
+    """
+    f.seek(0)
+    falhas = Counter()
+    if is_xlsx(f.name):
+        # Todas as abas, lidas em streaming; a memória fica com o resultado padronizado
+        parts = [d for d in standardize_chunks(read_xlsx_chunks(f), f.name, falhas) if not d.empty]
+        df_std = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+    else:
+        if f.name.endswith('.csv'): 
+            layout = layout or sniff_csv_layout(f)
+            df = read_csv_layout(f, layout, low_memory=False)
+            df.index += layout['header_row']
+        else: df = pd.read_excel(f, dtype=str)
+        df_std = standardize_dataframe(df, f.name, falhas=falhas)
+    avisos = [] if not df_std.empty else [f"Arquivo {f.name} lido, mas sem registros válidos."]
+    if falhas: avisos.append(format_falhas(f.name, falhas))
+    return df_std, avisos
+
 # ===========================================
 # LÓGICA DE BACKFILLING (NOVA)
 # ===========================================
 
+def doc_key_sql(col):
+    """normalize_key() como expressão SQL: sem . - / e espaços (NULL vira '')"""
+    return f"trim(replace(replace(replace(replace(coalesce({col}, ''), '.', ''), '-', ''), '/', ''), ' ', ''), char(9, 10, 13))"
+
+def doc_key_short_sql(col, min_len):
+    """length(normalize_key(col)) < min_len; só documentos que não são puro dígito pagam os replace()"""
+    return (f"(CASE WHEN length(coalesce({col}, '')) < {min_len} THEN 1 "
+            f"WHEN {col} GLOB '*[^0-9]*' THEN length({doc_key_sql(col)}) < {min_len} ELSE 0 END)")
+
+def consensus_values(df, col, min_len):
+    """
+    Valor mais frequente de col por card_key, só entre documentos com mais de min_len
+    caracteres úteis. Empate fica com o que aparece primeiro (como Counter.most_common).
+    """
+    vals = df[col].dropna().astype(str)
+    valid = (vals.str.replace(r'[./\- ]', '', regex=True).str.strip().str.len() > min_len) \
+        & ~vals.str.upper().str.contains('NAN', regex=False)
+    cand = pd.DataFrame({'card_key': df.loc[vals.index[valid], 'card_key'], col: vals[valid]})
+    counts = cand.groupby(['card_key', col], sort=False).size().rename('n').reset_index()
+    best = counts.sort_values(['card_key', 'n'], ascending=[True, False], kind='stable').drop_duplicates('card_key')
+    return best.set_index('card_key')[col]
+
 def build_master_key(conn):
     """
-    Cria a 'Chave Mestra' (Dicionário) usando Histórico + Retorno Bancário
+    Cria a 'Chave Mestra' usando Histórico + Retorno Bancário: um DataFrame indexado
+    por card_key com o CPF e o RG de consenso de cada conta
     """
     # 1. Dados Históricos do Sistema
-    df_pay = pd.read_sql("SELECT num_cartao, cpf, rg FROM payments WHERE num_cartao IS NOT NULL AND num_cartao != ''", conn)
+    df_pay = pd.read_sql("SELECT card_key, cpf, rg FROM payments WHERE card_key != ''", conn)
     
     # 2. Dados de Retorno Bancário (considerados fonte de verdade para Docs)
-    df_bank = pd.read_sql("SELECT cartao as num_cartao, cpf_bb as cpf, rg_bb as rg FROM bank_discrepancies WHERE cartao IS NOT NULL", conn)
+    df_bank = pd.read_sql("SELECT card_key, cpf_bb as cpf, rg_bb as rg FROM bank_discrepancies WHERE card_key != ''", conn)
     
-    # Unifica
+    # Unifica (cartões já normalizados pela chave gravada)
     df_all = pd.concat([df_pay, df_bank], ignore_index=True)
     
-    master_map = {}
-    
-    groups = df_all.groupby('num_cartao')
-    
-    for card, group in groups:
-        card_clean = normalize_key(card)
-        if not card_clean: continue
-        
-        # Encontrar CPF mais frequente (Consenso)
-        cpfs = [c for c in group['cpf'].dropna().astype(str) if len(normalize_key(c)) > 5 and 'NAN' not in c.upper()]
-        best_cpf = Counter(cpfs).most_common(1)[0][0] if cpfs else None
-        
-        # Encontrar RG mais frequente
-        rgs = [r for r in group['rg'].dropna().astype(str) if len(normalize_key(r)) > 3 and 'NAN' not in r.upper()]
-        best_rg = Counter(rgs).most_common(1)[0][0] if rgs else None
-        
-        if best_cpf or best_rg:
-            master_map[card_clean] = {'cpf': best_cpf, 'rg': best_rg}
-            
-    return master_map
+    master = pd.concat([consensus_values(df_all, 'cpf', 5), consensus_values(df_all, 'rg', 3)], axis=1)
+    master.index.name = 'card_key'
+    return master.reset_index()
+
+# Linhas com CPF ou RG vazio/curto. A mesma expressão define o índice parcial
+# idx_payments_backfill e filtra as consultas; o SQLite só usa o índice se o texto bater.
+BACKFILL_PENDING_SQL = f"({doc_key_short_sql('cpf', 5)} OR {doc_key_short_sql('rg', 3)})"
+BACKFILL_BATCH_ROWS = 20000
+
+def stage_master_key(conn, master):
+    staged = master.assign(cpf_key=cpf_key(master['cpf']))
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS tmp_master_key (card_key TEXT PRIMARY KEY, cpf TEXT, cpf_key TEXT, rg TEXT)")
+    conn.execute("DELETE FROM tmp_master_key")
+    cols = ['card_key', 'cpf', 'cpf_key', 'rg']
+    conn.executemany("INSERT INTO tmp_master_key VALUES (?, ?, ?, ?)",
+                     staged[cols].astype(object).where(staged[cols].notna(), None).itertuples(index=False, name=None))
+
+def backfill_scope(competencias=None):
+    """(nome do escopo no checkpoint, WHERE, parâmetros); None = base inteira"""
+    if competencias is None: return '*', "1", ()
+    where, params = competencia_filter(competencias)
+    return '|'.join(sorted(map(str, competencias))), f"({where})", params
+
+def backfill_fixes_sql(scope_where):
+    """Linhas pendentes do escopo (id entre ? e ?) que a Chave Mestra consegue completar"""
+    return f"""
+        SELECT p.id, m.cpf IS NOT NULL AND p.sem_cpf AS fix_cpf, m.rg IS NOT NULL AND p.sem_rg AS fix_rg, m.cpf, m.cpf_key, m.rg
+        FROM (
+            SELECT id, card_key, {doc_key_short_sql('cpf', 5)} AS sem_cpf, {doc_key_short_sql('rg', 3)} AS sem_rg
+            FROM payments WHERE {scope_where} AND {BACKFILL_PENDING_SQL} AND id > ? AND id <= ?
+        ) p JOIN tmp_master_key m ON m.card_key = p.card_key
+        WHERE (m.cpf IS NOT NULL AND p.sem_cpf) OR (m.rg IS NOT NULL AND p.sem_rg)
+    """
+
+def simulate_backfill(conn, scope_where, params):
+    """Dry-run: (registros, CPFs, RGs) que seriam recuperados, sem gravar nada"""
+    return conn.execute(f"""
+        SELECT COUNT(*), COALESCE(SUM(fix_cpf), 0), COALESCE(SUM(fix_rg), 0) FROM ({backfill_fixes_sql(scope_where)})
+    """, params + (0, sys.maxsize)).fetchone()
+
+def backfill_batch(conn, scope_where, params, after_id, batch_rows):
+    """
+    Corrige o próximo lote de até batch_rows linhas pendentes com id > after_id num único
+    UPDATE ... FROM. Devolve (último id do lote ou None se acabou, lidas, atualizados, CPFs, RGs).
+    """
+    lidas, last_id = conn.execute(f"""
+        SELECT COUNT(*), MAX(id) FROM (
+            SELECT id FROM payments WHERE {scope_where} AND {BACKFILL_PENDING_SQL} AND id > ? ORDER BY id LIMIT ?
+        )
+    """, params + (after_id, batch_rows)).fetchone()
+    if last_id is None: return None, 0, 0, 0, 0
+
+    conn.execute("DROP TABLE IF EXISTS temp.tmp_backfill")
+    conn.execute(f"CREATE TEMP TABLE tmp_backfill AS {backfill_fixes_sql(scope_where)}", params + (after_id, last_id))
+    updated, rec_cpf, rec_rg = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(fix_cpf), 0), COALESCE(SUM(fix_rg), 0) FROM tmp_backfill").fetchone()
+    conn.execute("""
+        UPDATE payments SET
+            cpf = CASE WHEN b.fix_cpf THEN b.cpf ELSE payments.cpf END,
+            cpf_key = CASE WHEN b.fix_cpf THEN b.cpf_key ELSE payments.cpf_key END,
+            rg = CASE WHEN b.fix_rg THEN b.rg ELSE payments.rg END
+        FROM tmp_backfill b WHERE b.id = payments.id
+    """)
+    # CPFs recuperados passam a valer no índice CPF <-> Cartão
+    conn.execute("""
+        INSERT INTO payment_keys (cpf_clean, card_clean, qtd_registros)
+        SELECT p.cpf_key, p.card_key, COUNT(*) FROM tmp_backfill b JOIN payments p ON p.id = b.id
+        WHERE b.fix_cpf AND length(p.cpf_key) > 5 AND p.card_key != ''
+        GROUP BY p.cpf_key, p.card_key
+        ON CONFLICT(cpf_clean, card_clean) DO UPDATE SET qtd_registros = qtd_registros + excluded.qtd_registros
+    """)
+    conn.execute("DROP TABLE IF EXISTS temp.tmp_backfill")
+    if updated: bump_generation(conn)
+    return last_id, lidas, updated, rec_cpf, rec_rg
+
+def run_backfill(conn, competencias=None, dry_run=False, batch_rows=BACKFILL_BATCH_ROWS, on_progress=None):
+    """
+    Backfilling das competências pedidas (None = base inteira), só sobre as linhas do índice
+    parcial de CPF/RG incompletos. Cada lote é gravado junto com o checkpoint do escopo, então
+    uma execução interrompida recomeça do último lote confirmado. dry_run só conta.
+    on_progress(processadas, pendentes) é chamado a cada lote.
+    """
+    escopo, where, params = backfill_scope(competencias)
+    master = build_master_key(conn)
+    stage_master_key(conn, master)
+    result = {'contas': len(master), 'retomado_de': 0}
+    try:
+        if dry_run:
+            result['atualizados'], result['cpfs'], result['rgs'] = simulate_backfill(conn, where, params)
+            result['pendentes'] = conn.execute(f"SELECT COUNT(*) FROM payments WHERE {where} AND {BACKFILL_PENDING_SQL}", params).fetchone()[0]
+            return result
+
+        row = conn.execute("SELECT ultimo_id, atualizados, cpfs, rgs FROM backfill_checkpoints WHERE escopo = ?", (escopo,)).fetchone()
+        last_id, updated, rec_cpf, rec_rg = row or (0, 0, 0, 0)
+        result['retomado_de'] = last_id
+        done, total = conn.execute(f"""
+            SELECT COALESCE(SUM(id <= ?), 0), COUNT(*) FROM payments WHERE {where} AND {BACKFILL_PENDING_SQL}
+        """, (last_id,) + params).fetchone()
+        result['pendentes'] = total
+        while True:
+            batch_last, lidas, n, c, r = backfill_batch(conn, where, params, last_id, batch_rows)
+            if batch_last is None: break
+            last_id, updated, rec_cpf, rec_rg = batch_last, updated + n, rec_cpf + c, rec_rg + r
+            conn.execute("""
+                INSERT INTO backfill_checkpoints (escopo, ultimo_id, atualizados, cpfs, rgs) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(escopo) DO UPDATE SET ultimo_id = excluded.ultimo_id, atualizados = excluded.atualizados,
+                    cpfs = excluded.cpfs, rgs = excluded.rgs, atualizado_em = CURRENT_TIMESTAMP
+            """, (escopo, last_id, updated, rec_cpf, rec_rg))
+            conn.commit()
+            done += lidas
+            if on_progress: on_progress(done, total)
+        conn.execute("DELETE FROM backfill_checkpoints WHERE escopo = ?", (escopo,))
+        conn.commit()
+        result.update(atualizados=updated, cpfs=rec_cpf, rgs=rec_rg)
+        return result
+    finally:
+        conn.execute("DELETE FROM tmp_master_key")
+
+def get_backfill_checkpoint(conn, competencias=None):
+    escopo = backfill_scope(competencias)[0]
+    return conn.execute("SELECT ultimo_id, atualizados, atualizado_em FROM backfill_checkpoints WHERE escopo = ?", (escopo,)).fetchone()
 
 # ===========================================
 # GERAÇÃO DE RELATÓRIOS E PDF (MANTIDO)
 # ===========================================
 
-def generate_bb_txt(df):
-    buffer = io.StringIO()
-    header = f"{'0':<11}{'Projeto':<31}{'NumCartão':<10} {'Nome':<40} {'RG':<12} {'CPF':<15}\n"
-    buffer.write(header)
-    for _, row in df.iterrows():
-        projeto = str(row.get('programa', ''))[:30]
-        cartao = str(row.get('num_cartao', ''))[:15]
-        nome = str(row.get('nome', ''))[:40]
-        rg = str(row.get('rg', ''))[:12]
-        cpf = str(row.get('cpf', ''))[:14]
-        line = f"{'1':<11}{projeto:<31}{cartao:<10} {nome:<40} {rg:<12} {cpf:<15}\n"
-        buffer.write(line)
-    return buffer.getvalue()
-
-def print_pdf_row_multiline(pdf, widths, data, align='L', fill=False):
-    font_size = 8
-    pdf.set_font("Arial", '', font_size)
-    line_height = 5
-    max_lines = 1
-    for i, datum in enumerate(data):
-        col_width = widths[i]
-        text_width = pdf.get_string_width(sanitize_text(str(datum)))
-        if text_width > col_width - 2:
-            lines_needed = int(text_width / (col_width - 2)) + 1
-            if lines_needed > max_lines: max_lines = lines_needed
-    row_height = max_lines * line_height
-    
-    if pdf.get_y() + row_height > 190: 
-        pdf.add_page(orientation='L')
-    
-    x_start = pdf.get_x()
-    y_start = pdf.get_y()
-    for i, width in enumerate(widths):
-        pdf.set_xy(x_start + sum(widths[:i]), y_start)
-        content = sanitize_text(str(data[i]))
-        pdf.multi_cell(width, line_height, content, 1, align, fill)
-    pdf.set_xy(x_start, y_start + row_height)
-
-def generate_pdf_report(df_filtered, inconsistency_df=None):
+BB_TXT_HEADER = f"{'0':<11}{'Projeto':<31}{'NumCartão':<10} {'Nome':<40} {'RG':<12} {'CPF':<15}\n"
+
+# Registro de detalhe: (coluna, caracteres mantidos, largura do campo). O campo é str(valor)
+# cortado e alinhado à esquerda; cartão pode passar da largura (não é cortado em 10).
+BB_TXT_RECORD_PREFIX = f"{'1':<11}"
+BB_TXT_FIELDS = [('programa', 30, 31), ('num_cartao', 15, 10), ('nome', 40, 40), ('rg', 12, 12), ('cpf', 14, 15)]
+BB_TXT_SEPARATORS = ['', '', ' ', ' ', ' ']
+BB_TXT_BLOCK_ROWS = 50000
+
+def bb_txt_field(df, col, size, width):
+    """Campo da coluna inteira: str(valor)[:size] alinhado em width; coluna ausente vira brancos"""
+    if col not in df.columns: return pd.Series(' ' * width, index=df.index, dtype=object)
+    s = df[col]
+    if s.dtype != object and pd.api.types.is_string_dtype(s.dtype):
+        # Dtype de texto (pyarrow no pandas 3): fica nativo; ausente vira str(na_value), como no str(valor)
+        texts = s.fillna(str(s.dtype.na_value))
+    elif s.dtype == object and pd.api.types.infer_dtype(s, skipna=True) != 'string':
+        texts = s.map(str)  # tipos misturados: 1 e 1.0 se igualam na fatoração, mas o texto difere
+    elif s.dtype == object:
+        texts = s.copy()
+        na = s.isna()
+        if na.any(): texts[na] = s[na].map(str)  # None e NaN têm textos diferentes ('None', 'nan')
+    else:
+        texts = map_distinct(str, s)
+    return texts.str.slice(0, size).str.ljust(width)
+
+def bb_txt_lines(df):
+    """Linhas de detalhe do layout BB (sem cabeçalho), montadas por coluna"""
+    if df.empty: return ''
+    lines = BB_TXT_RECORD_PREFIX
+    for (col, size, width), sep in zip(BB_TXT_FIELDS, BB_TXT_SEPARATORS):
+        lines = lines + sep + bb_txt_field(df, col, size, width)
+    return '\n'.join(lines.tolist()) + '\n'
+
+def write_bb_txt(chunks, out):
+    """Remessa BB num stream de texto: cabeçalho e um bloco de até BB_TXT_BLOCK_ROWS linhas por vez.
+    chunks é um DataFrame ou um iterável de DataFrames (blocos de iter_payment_chunks)"""
+    if isinstance(chunks, pd.DataFrame): chunks = [chunks]
+    out.write(BB_TXT_HEADER)
+    for chunk in chunks:
+        for start in range(0, len(chunk), BB_TXT_BLOCK_ROWS):
+            out.write(bb_txt_lines(chunk.iloc[start:start + BB_TXT_BLOCK_ROWS]))
+
+# --- Exportações (Relatórios e Exportação) ---
+# Geradas só no clique, lidas do SQLite em blocos e escritas direto num SpooledTemporaryFile
+# (memória até EXPORT_SPOOL_MAX_MB, depois disco). O arquivo fica no cache de artefatos por
+# formato + filtro + geração da base, e o conteúdo só é lido quando o download é clicado.
+
+EXPORT_CHUNK_ROWS = 50000
+EXPORT_SPOOL_MAX_MB = 16
+XLSX_MAX_DATA_ROWS = 1048575  # limite de linhas da planilha, menos o cabeçalho
+
+def payment_export_where(programas=None, partition=None):
+    """WHERE do filtro de projetos + partição {coluna: valor} (valor None casa com NULL)"""
+    conds, params = [], []
+    if programas:
+        conds.append(f"programa IN ({','.join('?' * len(programas))})")
+        params += list(programas)
+    for col, val in (partition or {}).items():
+        conds.append(f"{check_group_column(col)} IS ?")
+        params.append(val)
+    return (" WHERE " + " AND ".join(conds) if conds else ""), tuple(params)
+
+def iter_payment_chunks(programas=None, chunk_rows=EXPORT_CHUNK_ROWS, partition=None):
+    """Pagamentos do filtro (como get_payments_by_programas) em DataFrames de até chunk_rows linhas"""
+    conn = get_db_connection()
+    try:
+        cols = [r[1] for r in conn.execute("PRAGMA table_info(payments)") if r[1] not in MATCH_KEY_COLUMNS]
+        where, params = payment_export_where(programas, partition)
+        yield from pd.read_sql(f"SELECT {', '.join(cols)} FROM payments{where} ORDER BY id", conn, params=params, chunksize=chunk_rows)
+    finally:
+        conn.close()
+
+def write_payments_csv(chunks, out):
+    out.write(codecs.BOM_UTF8)
+    for i, chunk in enumerate(chunks):
+        out.write(chunk.to_csv(index=False, sep=';', header=i == 0).encode('utf-8'))
+
+def write_payments_xlsx(chunks, out):
+    """Planilha em modo constant_memory (linha a linha); passando do limite de linhas abre outra aba"""
+    wb = xlsxwriter.Workbook(out, {'constant_memory': True})
+    header_fmt = wb.add_format({'bold': True, 'border': 1, 'align': 'center'})
+    ws, row = None, XLSX_MAX_DATA_ROWS
+    for chunk in chunks:
+        values = chunk.astype(object).where(chunk.notna(), None)
+        for record in values.itertuples(index=False, name=None):
+            if row >= XLSX_MAX_DATA_ROWS:
+                ws = wb.add_worksheet(f"Sheet{len(wb.worksheets()) + 1}")
+                ws.write_row(0, 0, list(chunk.columns), header_fmt)
+                row = 0
+            row += 1
+            ws.write_row(row, 0, record)
+    if ws is None: wb.add_worksheet()
+    wb.close()
+
+def write_payments_bb_txt(chunks, out):
+    write_bb_txt(chunks, codecs.getwriter('utf-8')(out))
+
+EXPORT_FORMATS = {
+    'csv': {'titulo': "📄 Dados Completos", 'rotulo': "CSV", 'arquivo': "dados_pot.csv", 'mime': "text/csv", 'gerar': write_payments_csv},
+    'xlsx': {'titulo': "📊 Planilha Excel", 'rotulo': "Excel", 'arquivo': "dados_pot.xlsx", 'mime': "application/vnd.ms-excel", 'gerar': write_payments_xlsx},
+    'txt': {'titulo': "🏦 Layout Banco (BB)", 'rotulo': "TXT", 'arquivo': "remessa_bb.txt", 'mime': "text/plain", 'gerar': write_payments_bb_txt},
+}
+
+def spool_payment_export(fmt, programas):
+    """Exportação do filtro gerada em blocos num SpooledTemporaryFile; devolve (arquivo, tamanho)"""
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_MB * 1024 ** 2)
+    try:
+        EXPORT_FORMATS[fmt]['gerar'](iter_payment_chunks(programas), out)
+    except Exception:
+        out.close()
+        raise
+    return out, out.tell()
+
+def payment_export_key(fmt, programas):
+    return ('export', fmt, tuple(programas) if programas else None, get_db_generation())
+
+def prepare_payment_export(fmt, programas, cache):
+    """Garante a exportação no cache de artefatos (sem ler o conteúdo) e devolve a chave"""
+    key = payment_export_key(fmt, programas)
+    if not cache.has(key):
+        out, size = spool_payment_export(fmt, programas)
+        cache.put(key, out, size if size <= EXPORT_SPOOL_MAX_MB * 1024 ** 2 else 0)
+    return key
+
+def read_payment_export(fmt, programas, cache, key):
+    """Conteúdo para o download, lido só no clique; se saiu do cache nesse meio-tempo, é gerado de novo"""
+    data = cache.get(key)
+    if data is None:
+        out, _ = spool_payment_export(fmt, programas)
+        with out:
+            out.seek(0)
+            data = out.read()
+    return data
+
+# --- Pacote de exportação (uma pasta por projeto e/ou gerenciadora, num ZIP) ---
+# Cada partição é gerada num processo filho (run_process_pool, spawn), que lê só as suas linhas
+# do SQLite e grava os arquivos numa pasta temporária; o processo principal só junta tudo no
+# ZIP. Passado EXPORT_BUNDLE_TIMEOUT os filhos são encerrados e a tarefa falha.
+
+EXPORT_WORKERS = os.cpu_count() or 1
+EXPORT_BUNDLE_DIR = 'exportacoes'
+EXPORT_BUNDLE_KEEP = 10   # pacotes antigos além destes são apagados
+EXPORT_BUNDLE_TIMEOUT = 30 * 60  # segundos para gerar todas as partições
+EXPORT_PARTITIONS = {'programa': "Projeto", 'gerenciadora': "Gerenciadora"}
+
+def list_export_partitions(conn, programas, particao):
+    """Partições existentes no filtro, da maior para a menor (equilibra o pool)"""
+    cols = ', '.join(check_group_column(c) for c in particao)
+    where, params = payment_export_where(programas)
+    rows = conn.execute(f"SELECT {cols} FROM payments{where} GROUP BY {cols} ORDER BY COUNT(*) DESC", params).fetchall()
+    return [dict(zip(particao, r)) for r in rows]
+
+def partition_folder(partition):
+    return "__".join(re.sub(r'[^A-Z0-9]+', '_', remove_accents(str(v or ''))).strip('_') or f"SEM_{c.upper()}"
+                     for c, v in partition.items())
+
+def tally_chunks(chunks, totals):
+    """Repassa os blocos somando registros e valor (para o manifesto)"""
+    for chunk in chunks:
+        totals['registros'] += len(chunk)
+        totals['valor_total'] += float(chunk['valor_pagto'].sum()) if 'valor_pagto' in chunk else 0.0
+        yield chunk
+
+def write_export_partition(partition, programas, formatos, pasta):
+    """Roda no processo filho: grava os formatos da partição em pasta e devolve a linha do manifesto"""
+    folder = partition_folder(partition)
+    os.makedirs(os.path.join(pasta, folder), exist_ok=True)
+    totals = {'registros': 0, 'valor_total': 0.0}
+    arquivos = []
+    for i, fmt in enumerate(formatos):
+        chunks = iter_payment_chunks(programas, partition=partition)
+        if i == 0: chunks = tally_chunks(chunks, totals)
+        nome = f"{folder}/{EXPORT_FORMATS[fmt]['arquivo']}"
+        with open(os.path.join(pasta, nome), 'wb') as out:
+            EXPORT_FORMATS[fmt]['gerar'](chunks, out)
+        arquivos.append(nome)
+    return dict(partition, pasta=folder, **totals, arquivos=arquivos)
+
+def build_export_bundle(programas, particao, formatos, destino, on_progress=None):
+    """
+    ZIP em destino com uma pasta por partição (particao: colunas de EXPORT_PARTITIONS) e
+    manifesto.csv com registros e valor total de cada uma. Devolve (manifesto, erros).
+    """
+    conn = get_db_connection()
+    try:
+        parts = list_export_partitions(conn, programas, particao)
+    finally:
+        conn.close()
+    pasta = tempfile.mkdtemp(dir=os.path.dirname(destino))
+    try:
+        results = run_process_pool(write_export_partition, [(part, programas, formatos, pasta) for part in parts],
+                                   max_workers=EXPORT_WORKERS, on_progress=on_progress, timeout=EXPORT_BUNDLE_TIMEOUT)
+        erros = [f"{partition_folder(part)}: {err}" for part, (_, err) in zip(parts, results) if err is not None]
+        linhas = [res for res, err in results if err is None]
+        manifesto = pd.DataFrame(linhas, columns=particao + ['pasta', 'registros', 'valor_total', 'arquivos'])
+        with zipfile.ZipFile(destino, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for linha in linhas:
+                for nome in linha['arquivos']:
+                    zf.write(os.path.join(pasta, nome), nome)  # em blocos, direto do disco
+            zf.writestr('manifesto.csv', manifesto.assign(arquivos=manifesto['arquivos'].str.join(', '))
+                        .to_csv(index=False, sep=';').encode('utf-8-sig'))
+    finally:
+        shutil.rmtree(pasta, ignore_errors=True)
+    return manifesto, erros
+
+def export_bundle_path(job_id):
+    os.makedirs(EXPORT_BUNDLE_DIR, exist_ok=True)
+    antigos = sorted((f for f in os.listdir(EXPORT_BUNDLE_DIR) if f.endswith('.zip')), key=lambda f: os.path.getmtime(os.path.join(EXPORT_BUNDLE_DIR, f)))
+    for f in antigos[:max(len(antigos) - EXPORT_BUNDLE_KEEP + 1, 0)]:
+        os.remove(os.path.join(EXPORT_BUNDLE_DIR, f))
+    return os.path.abspath(os.path.join(EXPORT_BUNDLE_DIR, f"pacote_{job_id}.zip"))
+
+def export_download(fmt, programas):
+    spec = EXPORT_FORMATS[fmt]
+    st.markdown(f"###### {spec['titulo']}")
+    cache = get_artifact_cache()
+    key = payment_export_key(fmt, programas)
+    # Já gerada para este filtro e geração da base: o download aparece direto, em qualquer rerun
+    if not cache.has(key):
+        if not st.button(f"⚙️ Gerar {spec['rotulo']}", key=f"exportar_{fmt}"): return
+        with st.spinner(f"Gerando {spec['rotulo']}..."):
+            key = prepare_payment_export(fmt, programas, cache)
+    # Download adiado: o arquivo só é lido no clique (fora da página), não a cada rerun
+    st.download_button(f"⬇️ Baixar {spec['rotulo']}", lambda: read_payment_export(fmt, programas, cache, key),
+                       spec['arquivo'], spec['mime'], key=f"baixar_{fmt}", on_click='ignore')
+
+# --- Tabelas em PDF ---
+# Cada valor é convertido e sanitizado uma vez (por valor distinto, bloco a bloco), a largura
+# de cada texto é medida uma vez na fonte do corpo e as colunas têm posição fixa. Tabelas
+# longas quebram página com o cabeçalho repetido e param em max_rows linhas.
+
+PDF_TABLE_CHUNK_ROWS = 5000
+PDF_CELL_MAX_LINES = 6
+PDF_INCONSISTENCY_MAX_ROWS = 300
+PDF_AUDIT_MAX_ROWS = 5000
+PDF_CONFERENCE_MAX_ROWS = 5000
+
+def pdf_cell_texts(s):
+    """Texto final de cada célula da coluna: str + sanitize_text, uma vez por valor distinto"""
+    return map_distinct(lambda v: sanitize_text(str(v)), s).tolist()
+
+class PdfTable:
+    """
+    Tabela de colunas fixas no FPDF. columns: [(coluna do DataFrame, cabeçalho, largura)].
+    Antes de uma linha que não cabe na página a tabela marca "continua", abre outra página
+    na mesma orientação e repete o cabeçalho com "(continuação)".
+    """
+    def __init__(self, pdf, columns, title, font_size=8, line_height=5, header_fill=(240, 240, 240)):
+        self.pdf = pdf
+        self.keys = [c[0] for c in columns]
+        self.headers = [sanitize_text(c[1]) for c in columns]
+        self.widths = [c[2] for c in columns]
+        self.offsets = [sum(self.widths[:i]) for i in range(len(self.widths))]
+        self.title = sanitize_text(title)
+        self.font_size = font_size
+        self.line_height = line_height
+        self.header_fill = header_fill
+        self._text_widths = {}  # texto -> largura na fonte do corpo (uma fonte por tabela)
+        self._lines = {}        # (texto, largura da coluna) -> linhas
+
+    def text_width(self, text):
+        w = self._text_widths.get(text)
+        if w is None:
+            w = self._text_widths[text] = self.pdf.get_string_width(text)
+        return w
+
+    def wrap(self, text, width):
+        """Linhas do texto na largura útil da coluna: quebra por palavra e, se a palavra não cabe, por caractere"""
+        key = (text, width)
+        lines = self._lines.get(key)
+        if lines is not None: return lines
+        room = width - 2 * self.pdf.c_margin
+        if self.text_width(text) <= room:
+            lines = [text]
+        else:
+            lines, line, line_w = [], '', 0.0
+            space = self.text_width(' ')
+            for word in text.split(' '):
+                word_w = self.text_width(word)
+                if line and line_w + space + word_w <= room:
+                    line, line_w = f"{line} {word}", line_w + space + word_w
+                    continue
+                if line: lines.append(line)
+                while word_w > room and len(word) > 1:
+                    acc, cut = 0.0, 0
+                    for ch in word:
+                        acc += self.text_width(ch)
+                        if acc > room: break
+                        cut += 1
+                    cut = max(cut, 1)
+                    lines.append(word[:cut])
+                    word = word[cut:]
+                    word_w = self.text_width(word)
+                line, line_w = word, word_w
+            lines.append(line)
+            if len(lines) > PDF_CELL_MAX_LINES:
+                lines = lines[:PDF_CELL_MAX_LINES]
+                lines[-1] = lines[-1][:-3] + '...'
+        self._lines[key] = lines
+        return lines
+
+    def header(self):
+        pdf = self.pdf
+        pdf.set_font("Arial", 'B', 8)
+        pdf.set_fill_color(*self.header_fill)
+        for h, w in zip(self.headers, self.widths): pdf.cell(w, 8, h, 1, 0, 'C', True)
+        pdf.ln()
+        pdf.set_font("Arial", '', self.font_size)
+
+    def break_page(self):
+        pdf = self.pdf
+        pdf.set_font("Arial", 'I', 7)
+        pdf.cell(0, 5, sanitize_text("(continua na próxima página)"), 0, 1, 'R')
+        pdf.add_page(pdf.cur_orientation)
+        pdf.cell(0, 5, sanitize_text(f"{self.title} (continuação)"), 0, 1, 'L')
+        self.header()
+
+    def fit(self, height):
+        if self.pdf.get_y() + height > self.pdf.page_break_trigger: self.break_page()
+
+    def row(self, cells):
+        pdf, lh = self.pdf, self.line_height
+        wrapped = [self.wrap(t, w) for t, w in zip(cells, self.widths)]
+        n = max(len(lines) for lines in wrapped)
+        self.fit(n * lh)
+        if n == 1:
+            for (line,), w in zip(wrapped, self.widths): pdf.cell(w, lh, line, 1)
+            pdf.ln(lh)
+            return
+        x, y = pdf.l_margin, pdf.get_y()
+        for lines, w, off in zip(wrapped, self.widths, self.offsets):
+            pdf.rect(x + off, y, w, n * lh)
+            for i, line in enumerate(lines):
+                pdf.set_xy(x + off, y + i * lh)
+                pdf.cell(w, lh, line)
+        pdf.set_xy(x, y + n * lh)
+
+    def render(self, df, max_rows=None, label="registros"):
+        """Cabeçalho + até max_rows linhas de df (None = todas); devolve quantas linhas foram desenhadas"""
+        pdf = self.pdf
+        auto, margin = pdf.auto_page_break, pdf.b_margin
+        pdf.set_auto_page_break(False, margin)  # a quebra é da tabela, com cabeçalho repetido
+        try:
+            if pdf.get_y() + 8 + self.line_height > pdf.page_break_trigger: pdf.add_page(pdf.cur_orientation)
+            self.header()
+            shown = df if max_rows is None else df.iloc[:max_rows]
+            for start in range(0, len(shown), PDF_TABLE_CHUNK_ROWS):
+                chunk = shown.iloc[start:start + PDF_TABLE_CHUNK_ROWS]
+                cols = [pdf_cell_texts(chunk[k]) if k in chunk.columns else [''] * len(chunk) for k in self.keys]
+                for cells in zip(*cols): self.row(cells)
+            if len(shown) < len(df):
+                self.fit(8)
+                pdf.set_font("Arial", '', 8)
+                pdf.cell(0, 8, sanitize_text(f"... e mais {len(df) - len(shown)} {label} (veja no sistema)."), 1, 1, 'C')
+        finally:
+            pdf.set_auto_page_break(auto, margin)
+        return len(shown)
+
+def pdf_figure_image(pdf, name, fig):
+    """
+    Registra a figura como imagem do PDF direto do buffer RGB do Agg (FlateDecode), sem
+    PNG temporário: o FPDF 1.7 só lê imagens de arquivo, então a entrada vai pronta em pdf.images.
+    """
+    canvas = FigureCanvasAgg(fig)
+    canvas.draw()
+    rgb = np.asarray(canvas.buffer_rgba())[:, :, :3]
+    pdf.images[name] = {'i': len(pdf.images) + 1, 'w': rgb.shape[1], 'h': rgb.shape[0], 'cs': 'DeviceRGB',
+                        'bpc': 8, 'f': 'FlateDecode', 'data': zlib.compress(rgb.tobytes())}
+    return name
+
+def generate_pdf_report(df_filtered, inconsistency_df=None, max_rows=PDF_INCONSISTENCY_MAX_ROWS):
     if FPDF is None: return b"Erro: FPDF ausente."
     pdf = FPDF()
     pdf.add_page(orientation='L')
@@ -818,21 +3032,17 @@ def generate_pdf_report(df_filtered, inconsistency_df=None):
 
     pdf.set_font("Arial", 'B', 12)
     pdf.cell(0, 10, sanitize_text("2. Visualização Gráfica"), 0, 1)
-    if plt and 'programa' in df_filtered.columns and not df_filtered.empty:
+    if Figure and 'programa' in df_filtered.columns and not df_filtered.empty:
         try:
-            plt.figure(figsize=(10, 4))
+            fig = Figure(figsize=(10, 4), dpi=100)
+            ax = fig.add_subplot()
             grp = df_filtered.groupby('programa')['valor_pagto'].sum().sort_values()
-            plt.barh(grp.index, grp.values, color='#4682B4') 
-            plt.title('Valor Total por Projeto')
-            plt.xlabel('Valor (R$)')
-            plt.grid(axis='x', linestyle='--', alpha=0.7)
-            plt.tight_layout()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".png") as tmp:
-                plt.savefig(tmp.name, dpi=100)
-                img_path = tmp.name
-            pdf.image(img_path, x=20, w=180)
-            plt.close()
-            os.remove(img_path)
+            ax.barh(grp.index, grp.values, color='#4682B4')
+            ax.set_title('Valor Total por Projeto')
+            ax.set_xlabel('Valor (R$)')
+            ax.grid(axis='x', linestyle='--', alpha=0.7)
+            fig.tight_layout()
+            pdf.image(pdf_figure_image(pdf, 'grafico_projetos', fig), x=20, w=180)
         except: pass
     else: pdf.cell(0, 10, sanitize_text("Gráfico indisponível."), 0, 1)
     pdf.ln(10)
@@ -867,23 +3077,10 @@ def generate_pdf_report(df_filtered, inconsistency_df=None):
         pdf.multi_cell(0, 6, sanitize_text("Abaixo estão listados os registros contendo inconsistências críticas."))
         pdf.ln(2)
         
-        pdf.set_font("Arial", 'B', 8)
-        pdf.set_fill_color(255, 230, 230)
-        widths = [45, 12, 28, 28, 60, 95]
-        cols = ['ARQUIVO', 'LIN', 'CPF', 'CARTÃO', 'NOME', 'DESCRIÇÃO DO ERRO']
-        for i, col in enumerate(cols): pdf.cell(widths[i], 8, sanitize_text(col), 1, 0, 'C', True)
-        pdf.ln()
-        pdf.set_font("Arial", '', 8)
-        
-        max_rows = 300
-        count = 0
-        for _, row in inconsistency_df.iterrows():
-            if count >= max_rows:
-                pdf.cell(0, 8, sanitize_text(f"... e mais {len(inconsistency_df)-max_rows} inconsistências (veja no sistema)."), 1, 1, 'C')
-                break
-            data_row = [str(row['ARQUIVO']), str(row['LINHA']), str(row['CPF']), str(row['CARTÃO']), str(row['NOME']), str(row['ERRO'])]
-            print_pdf_row_multiline(pdf, widths, data_row)
-            count += 1
+        columns = [('ARQUIVO', 'ARQUIVO', 45), ('LINHA', 'LIN', 12), ('CPF', 'CPF', 28),
+                   ('CARTÃO', 'CARTÃO', 28), ('NOME', 'NOME', 60), ('ERRO', 'DESCRIÇÃO DO ERRO', 95)]
+        PdfTable(pdf, columns, "Inconsistências", header_fill=(255, 230, 230)).render(
+            inconsistency_df, max_rows, "inconsistências")
     else:
         pdf.set_text_color(0, 128, 0)
         pdf.set_font("Arial", 'B', 11)
@@ -892,26 +3089,18 @@ def generate_pdf_report(df_filtered, inconsistency_df=None):
 
     return pdf.output(dest='S').encode('latin-1', 'replace')
 
-def generate_audit_log_pdf(logs_df):
+def generate_audit_log_pdf(logs_df, max_rows=PDF_AUDIT_MAX_ROWS):
     if FPDF is None: return b"Erro FPDF"
     pdf = FPDF()
     pdf.add_page()
     pdf.set_font("Arial", 'B', 14)
     pdf.cell(0, 10, sanitize_text("Relatório de Auditoria do Sistema"), 0, 1, 'C')
     pdf.ln(5)
-    pdf.set_font("Arial", 'B', 8)
-    pdf.set_fill_color(240, 240, 240)
-    w = [35, 45, 40, 70]
-    headers = ["DATA/HORA", "USUÁRIO", "AÇÃO", "DETALHES"]
-    for i, h in enumerate(headers): pdf.cell(w[i], 8, sanitize_text(h), 1, 0, 'C', True)
-    pdf.ln()
-    pdf.set_font("Arial", '', 8)
-    for _, row in logs_df.iterrows():
-        data = [str(row['timestamp']), str(row['user_email']), str(row['action']), str(row['details'])]
-        print_pdf_row_multiline(pdf, w, data)
+    columns = [('timestamp', "DATA/HORA", 35), ('user_email', "USUÁRIO", 45), ('action', "AÇÃO", 40), ('details', "DETALHES", 70)]
+    PdfTable(pdf, columns, "Relatório de Auditoria do Sistema").render(logs_df, max_rows, "registros de log")
     return pdf.output(dest='S').encode('latin-1', 'replace')
 
-def generate_conference_pdf(hist_df):
+def generate_conference_pdf(hist_df, max_rows=PDF_CONFERENCE_MAX_ROWS):
     if FPDF is None: return b"Erro: FPDF ausente."
     pdf = FPDF()
     pdf.add_page(orientation='L')
@@ -927,18 +3116,387 @@ def generate_conference_pdf(hist_df):
     if hist_df.empty:
         pdf.cell(0, 10, sanitize_text("Nenhuma divergência registrada."), 0, 1)
         return pdf.output(dest='S').encode('latin-1', 'replace')
-    pdf.set_font("Arial", 'B', 8)
-    pdf.set_fill_color(255, 240, 240)
-    widths = [30, 80, 80, 50]
-    headers = ["CARTÃO", "NOME NO SISTEMA", "NOME NO BANCO", "DIVERGÊNCIA"]
-    for i, h in enumerate(headers): pdf.cell(widths[i], 8, sanitize_text(h), 1, 0, 'C', True)
-    pdf.ln()
-    pdf.set_font("Arial", '', 7)
-    for _, row in hist_df.iterrows():
-        row_data = [str(row.get('cartao','')), str(row.get('nome_sis','')), str(row.get('nome_bb','')), str(row.get('divergencia',''))]
-        print_pdf_row_multiline(pdf, widths, row_data)
+    columns = [('cartao', "CARTÃO", 30), ('nome_sis', "NOME NO SISTEMA", 80), ('nome_bb', "NOME NO BANCO", 80), ('divergencia', "DIVERGÊNCIA", 50)]
+    PdfTable(pdf, columns, "Relatório de Divergências Bancárias", font_size=7, header_fill=(255, 240, 240)).render(
+        hist_df, max_rows, "divergências")
     return pdf.output(dest='S').encode('latin-1', 'replace')
 
+# ===========================================
+# TAREFAS EM SEGUNDO PLANO (JOBS)
+# ===========================================
+# Upload, conferência bancária, backfilling e o relatório PDF rodam num pool de threads
+# do processo. A página só enfileira a tarefa e acompanha a linha dela na tabela jobs,
+# então um rerun, um refresh ou a sessão de outro analista não interrompem nada.
+
+JOB_WORKERS = 2
+JOB_POLL_SECONDS = 2
+JOB_PROGRESS_INTERVAL = 0.5
+JOB_LIST_LIMIT = 5
+JOB_KEEP = JOB_LIST_LIMIT  # terminadas além destas (por usuário e tipo) saem da tabela, com o resultado
+JOB_ACTIVE = ('na_fila', 'executando')
+JOB_STATUS_LABELS = {'na_fila': '⏳ Na fila', 'executando': '⚙️ Em execução', 'concluido': '✅ Concluída', 'erro': '❌ Erro'}
+
+# tipo -> função(job, **params); o resultado devolvido fica gravado em jobs.resultado
+JOB_HANDLERS = {}
+
+def register_job(tipo, handler):
+    JOB_HANDLERS[tipo] = handler
+
+def utc_timestamp():
+    """Mesmo formato de CURRENT_TIMESTAMP do SQLite"""
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+class JobFile(io.BytesIO):
+    """Cópia do upload que acompanha a tarefa: o UploadedFile some no próximo rerun da página"""
+    def __init__(self, name, data):
+        super().__init__(data)
+        self.name = name
+        self.size = len(data)
+
+class JobContext:
+    """O que a função da tarefa enxerga: quem pediu, progresso (gravado no máximo a cada JOB_PROGRESS_INTERVAL) e avisos"""
+    def __init__(self, job_id, usuario):
+        self.id = job_id
+        self.usuario = usuario
+        self.avisos = []
+        self._last = 0.0
+
+    def progress(self, fraction, mensagem=None):
+        now = time.monotonic()
+        if now - self._last < JOB_PROGRESS_INTERVAL: return
+        self._last = now
+        conn = sqlite3.connect(DB_FILE, timeout=1)
+        try:
+            conn.execute("UPDATE jobs SET progresso = ?, mensagem = COALESCE(?, mensagem) WHERE id = ?",
+                         (min(max(float(fraction), 0.0), 1.0), mensagem, self.id))
+            conn.commit()
+        except sqlite3.OperationalError:
+            pass  # base ocupada por outra escrita: o próximo progresso grava
+        finally:
+            conn.close()
+
+    def warn(self, texto):
+        self.avisos.append(texto)
+
+def update_job(job_id, **fields):
+    conn = get_db_connection()
+    try:
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?", (*fields.values(), job_id))
+        conn.commit()
+    finally:
+        conn.close()
+
+def run_job(job_id, usuario, handler, params):
+    job = JobContext(job_id, usuario)
+    update_job(job_id, status='executando', iniciado_em=utc_timestamp())
+    try:
+        resultado = handler(job, **params)
+        update_job(job_id, status='concluido', progresso=1.0, finalizado_em=utc_timestamp(),
+                   avisos=json.dumps(job.avisos), resultado=pickle.dumps(resultado))
+    except Exception as e:
+        update_job(job_id, status='erro', finalizado_em=utc_timestamp(), avisos=json.dumps(job.avisos),
+                   erro=f"{type(e).__name__}: {e}")
+    request_snapshot_refresh()  # upload, backfill etc. gravam em payments (também quando falham no meio)
+    prune_jobs(job_id)
+
+def prune_jobs(job_id, keep=JOB_KEEP):
+    """
+    Apaga as tarefas terminadas do mesmo usuário e tipo de job_id além das keep mais
+    recentes: o resultado gravado (PDF, DataFrames) não fica na base para sempre.
+    """
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT usuario, tipo FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None: return
+        conn.execute(f"""
+            DELETE FROM jobs WHERE usuario IS ? AND tipo = ? AND status NOT IN ({','.join('?' * len(JOB_ACTIVE))})
+              AND id NOT IN (SELECT id FROM jobs WHERE usuario IS ? AND tipo = ? ORDER BY id DESC LIMIT ?)
+        """, (*row, *JOB_ACTIVE, *row, keep))
+        conn.commit()
+    finally:
+        conn.close()
+
+@st.cache_resource
+def get_job_executor():
+    # Um pool por processo, compartilhado entre sessões e reruns. Tarefas que estavam na
+    # fila ou rodando morreram com o processo anterior.
+    conn = get_db_connection()
+    conn.execute("""
+        UPDATE jobs SET status = 'erro', erro = 'Interrompida: o servidor foi reiniciado', finalizado_em = ?
+        WHERE status IN ('na_fila', 'executando')
+    """, (utc_timestamp(),))
+    conn.commit()
+    conn.close()
+    return ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='pot-job')
+
+def submit_job(tipo, usuario, descricao, **params):
+    executor = get_job_executor()
+    conn = get_db_connection()
+    try:
+        job_id = conn.execute("INSERT INTO jobs (tipo, usuario, descricao, status) VALUES (?, ?, ?, 'na_fila')",
+                              (tipo, usuario, descricao)).lastrowid
+        conn.commit()
+    finally:
+        conn.close()
+    executor.submit(run_job, job_id, usuario, JOB_HANDLERS[tipo], params)
+    return job_id
+
+def list_jobs(usuario, tipo, limit=JOB_LIST_LIMIT):
+    conn = get_db_connection()
+    try:
+        return pd.read_sql("""
+            SELECT id, tipo, descricao, status, progresso, mensagem, avisos, erro, criado_em, iniciado_em, finalizado_em,
+                   (julianday(COALESCE(finalizado_em, CURRENT_TIMESTAMP)) - julianday(iniciado_em)) * 86400 AS duracao_s
+            FROM jobs WHERE usuario = ? AND tipo = ? ORDER BY id DESC LIMIT ?
+        """, conn, params=(usuario, tipo, limit))
+    finally:
+        conn.close()
+
+def get_job_result(job_id):
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT resultado FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    finally:
+        conn.close()
+    return pickle.loads(row[0]) if row and row[0] is not None else None
+
+# --- Tarefas ---
+
+def job_upload(job, files, layouts):
+    """Leitura, validação contra o histórico e gravação dos arquivos de pagamento"""
+    # Mesmo nome duas vezes no envio: só o primeiro entra (a checagem abaixo só vê o que já foi gravado)
+    unicos = {}
+    for f in files:
+        if f.name in unicos: job.warn(f"Ignorado (repetido neste envio): {f.name}")
+        else: unicos[f.name] = f
+    files = list(unicos.values())
+    conn = get_db_connection()
+    exist = [f.name for f in files if conn.execute("SELECT 1 FROM payments WHERE arquivo_origem = ? LIMIT 1", (f.name,)).fetchone()]
+    conn.close()
+    dfs, pool_files = [], []
+    saved, issue_frames, conflict_frames = 0, [], []
+    for i, f in enumerate(files):
+        if f.name in exist:
+            job.warn(f"Ignorado (já existe): {f.name}")
+            continue
+        if 'REL.CADASTRO' in f.name.upper():
+            job.warn(f"Ignorado (Parece arquivo de conferência bancária): {f.name}")
+            continue
+        if is_large_upload(f):
+            job.progress(i / len(files), f"Processando {f.name} em blocos...")
+            conn = get_db_connection()
+            try:
+                falhas = Counter()
+                n, f_issues, f_conflicts = ingest_file_streaming(conn, f, f.name, falhas, layouts.get(f.name))
+                conn.commit()
+                if falhas: job.warn(format_falhas(f.name, falhas))
+                saved += n
+                issue_frames.append(f_issues)
+                conflict_frames.append(f_conflicts)
+            except Exception as e:
+                conn.rollback()
+                job.warn(f"Erro ao ler {f.name}: {e}")
+            finally:
+                conn.close()
+            continue
+        pool_files.append(f)
+
+    # Leitura + padronização em paralelo; gravação segue com um único escritor
+    if pool_files:
+        job.progress(0.5, f"Lendo {len(pool_files)} arquivo(s) em até {min(UPLOAD_WORKERS, len(pool_files))} processos...")
+        results = run_process_pool(read_upload_bytes, [(f.name, f.getvalue(), layouts.get(f.name)) for f in pool_files])
+        for f, (res, err) in zip(pool_files, results):
+            if err is not None:
+                job.warn(f"Erro ao ler {f.name}: {err}")
+                continue
+            df_std, file_warnings = res
+            for w in file_warnings: job.warn(w)
+            if not df_std.empty: dfs.append(df_std)
+    if dfs:
+        job.progress(0.8, "Gravando registros...")
+        final = pd.concat(dfs, ignore_index=True)
+        conn = get_db_connection()
+        try:
+            # Validação contra o histórico e gravação na mesma transação
+            conflict_frames.append(check_keys_against_history(conn, final))
+            insert_payments(conn, final)
+            conn.commit()
+        finally:
+            conn.close()
+        saved += len(final)
+        issue_frames.append(detect_inconsistencies(final))
+    if saved:
+        log_action(job.usuario, "UPLOAD", f"Upload de {len(files)} arquivos, {saved} registros")
+    issue_frames = [d for d in issue_frames if not d.empty]
+    conflict_frames = [d for d in conflict_frames if not d.empty]
+    return {
+        'salvos': saved,
+        'inconsistencias': pd.concat(issue_frames, ignore_index=True) if issue_frames else pd.DataFrame(),
+        'conflitos': pd.concat(conflict_frames, ignore_index=True) if conflict_frames else pd.DataFrame(),
+    }
+
+register_job('upload', job_upload)
+
+def job_bank_reconcile(job, files, reprocess):
+    """Conferência dos arquivos do banco contra o histórico (malha fina)"""
+    # Arquivos já conferidos (mesmo conteúdo) nem são lidos de novo
+    hashes = {}
+    for f in files:
+        hashes.setdefault(file_content_hash(f), f)
+    conn = get_db_connection()
+    done = {} if reprocess else get_processed_bank_files(conn, hashes)
+    conn.close()
+    for h, (arquivo, quando) in done.items():
+        job.warn(f"{hashes[h].name}: conteúdo já conferido em {quando} (como {arquivo}). Ignorado.")
+
+    dfs, runs = [], []
+    for i, (h, f) in enumerate(hashes.items()):
+        if h in done: continue
+        job.progress(i / len(hashes) * 0.6, f"Lendo {f.name}...")
+        try:
+            d = parse_smart_bb(f, f.name)
+            if not d.empty:
+                dfs.append(d)
+                runs.append((h, f.name, d['tipo_arquivo'].iloc[0], len(d)))
+            else:
+                job.warn(f"Arquivo {f.name} lido, mas sem dados reconhecidos.")
+        except Exception as e: job.warn(f"Erro ao ler {f.name}: {e}")
+
+    if not dfs:
+        return {'registros': 0, 'divergencias': 0, 'novas': 0, 'ignorados': len(done)}
+    job.progress(0.6, "Cruzando com o histórico...")
+    final_bb = pd.concat(dfs, ignore_index=True)
+    conn = get_db_connection()
+    try:
+        dd = reconcile_bank_records(conn, final_bb)
+        novas = save_bank_discrepancies(conn, dd)
+        per_file = dd['arquivo_origem'].value_counts()
+        record_bank_runs(conn, [(h, nome, tipo, qtd, int(per_file.get(nome, 0))) for h, nome, tipo, qtd in runs])
+        if not dd.empty: bump_generation(conn)
+        conn.commit()
+    finally:
+        conn.close()
+    return {'registros': len(final_bb), 'divergencias': len(dd), 'novas': novas, 'ignorados': len(done)}
+
+register_job('conferencia_bb', job_bank_reconcile)
+
+def job_backfill(job, competencias, dry_run):
+    job.progress(0.0, "Mapeando histórico de contas (Chave Mestra)...")
+    conn = get_db_connection()
+    try:
+        res = run_backfill(conn, competencias, dry_run=dry_run,
+                           on_progress=lambda done, total: job.progress(done / max(total, 1), f"{done} de {total} registros pendentes"))
+    finally:
+        conn.close()
+    if not dry_run:
+        log_action(job.usuario, "BACKFILL", f"Recuperados: {res['atualizados']}")
+    return dict(res, dry_run=dry_run)
+
+register_job('backfill', job_backfill)
+
+def job_pdf_report(job, programas, artifacts):
+    job.progress(0.1, "Lendo pagamentos...")
+    df = get_payments_by_programas(programas, True, cached=False)
+    job.progress(0.4, "Gerando PDF (ou reaproveitando o já gerado para estes dados)...")
+    pdf_data = build_artifact(artifacts, 'relatorio_executivo', drop_match_keys(df, False),
+                              lambda d: generate_pdf_report(d, detect_inconsistencies(df)))
+    if not isinstance(pdf_data, bytes): raise RuntimeError(pdf_data)
+    log_action(job.usuario, "RELATORIO_PDF", "Gerou relatório executivo")
+    return {'pdf': pdf_data}
+
+register_job('relatorio_pdf', job_pdf_report)
+
+def job_export_bundle(job, programas, particao, formatos):
+    destino = export_bundle_path(job.id)
+    job.progress(0.0, "Listando partições...")
+    manifesto, erros = build_export_bundle(
+        programas, particao, formatos, destino,
+        on_progress=lambda done, total: job.progress(done / max(total, 1) * 0.9, f"{done} de {total} partições geradas"))
+    for e in erros: job.warn(f"Falha na partição {e}")
+    log_action(job.usuario, "PACOTE_EXPORTACAO", f"{len(manifesto)} partições por {'/'.join(particao)}, {int(manifesto['registros'].sum())} registros")
+    return {'arquivo': destino, 'manifesto': manifesto.drop(columns='arquivos')}
+
+register_job('pacote_exportacao', job_export_bundle)
+
+# --- Acompanhamento na página ---
+
+def show_upload_result(job_id, res):
+    if not res['salvos']: return
+    st.success(f"✅ {res['salvos']} registros salvos com sucesso!")
+    if not res['inconsistencias'].empty:
+        st.error("🚨 ATENÇÃO: ERROS DE DADOS AUSENTES OU INCONSISTÊNCIAS IDENTIFICADOS NO UPLOAD!")
+        st.dataframe(res['inconsistencias'], use_container_width=True)
+    if not res['conflitos'].empty:
+        st.error("🚨 ATENÇÃO: CPFs/CARTÕES DO UPLOAD CONFLITAM COM COMPETÊNCIAS ANTERIORES!")
+        st.dataframe(res['conflitos'], use_container_width=True)
+
+def show_bank_result(job_id, res):
+    if res['divergencias']:
+        st.error(f"🚨 ALERTA DE FRAUDE: {res['divergencias']} divergências de titularidade identificadas ({res['novas']} novas no histórico)!")
+    elif res['registros']:
+        st.success(f"✅ Auditoria Blindada: {res['registros']} registros processados. Nenhuma troca de titularidade detectada.")
+    elif not res['ignorados']:
+        st.warning("Nenhum dado válido extraído dos arquivos enviados.")
+
+def show_backfill_result(job_id, res):
+    logs_html = f"<div class='console-log'>✅ Histórico mapeado: {res['contas']} contas únicas com dados.</div>"
+    logs_html += f"<div class='console-log'>🔍 {res['pendentes']} registros com CPF/RG incompleto no escopo.</div>"
+    if res['retomado_de']:
+        logs_html += f"<div class='console-log'>↪️ Retomado após o registro {res['retomado_de']}.</div>"
+    if res['dry_run']:
+        logs_html += f"<div class='console-log'>🧪 Simulação: {res['atualizados']} registros seriam atualizados.<br>CPFs: {res['cpfs']} | RGs: {res['rgs']}</div>"
+    else:
+        logs_html += f"<div class='console-log'>🚀 Concluído! {res['atualizados']} registros atualizados.<br>CPFs: {res['cpfs']} | RGs: {res['rgs']}</div>"
+    st.markdown(logs_html, unsafe_allow_html=True)
+
+def show_pdf_result(job_id, res):
+    st.download_button("⬇️ Baixar PDF", res['pdf'], "relatorio_executivo.pdf", "application/pdf", key=f"job_pdf_{job_id}")
+
+def show_bundle_result(job_id, res):
+    manifesto = res['manifesto']
+    st.success(f"✅ {len(manifesto)} partições · {int(manifesto['registros'].sum())} registros · R$ {manifesto['valor_total'].sum():,.2f}")
+    st.dataframe(manifesto, use_container_width=True, hide_index=True)
+    if not os.path.exists(res['arquivo']):
+        st.info("O arquivo deste pacote já foi removido (ficam só os mais recentes). Gere novamente.")
+        return
+    with open(res['arquivo'], 'rb') as fh:
+        st.download_button("⬇️ Baixar Pacote (ZIP)", fh.read(), f"pacote_pot_{job_id}.zip", "application/zip", key=f"job_zip_{job_id}")
+
+JOB_RESULT_VIEWS = {
+    'upload': show_upload_result,
+    'conferencia_bb': show_bank_result,
+    'backfill': show_backfill_result,
+    'relatorio_pdf': show_pdf_result,
+    'pacote_exportacao': show_bundle_result,
+}
+
+def render_job_list(usuario, tipo, polling):
+    jobs = list_jobs(usuario, tipo)
+    active = jobs['status'].isin(JOB_ACTIVE).any()
+    if polling and not active:
+        st.rerun()  # terminou: página inteira recarrega com os dados novos e para de consultar
+    shown = False
+    for job in jobs.itertuples():
+        with st.container(border=True):
+            duracao = f" · {job.duracao_s:.0f}s" if pd.notna(job.duracao_s) else ""
+            st.markdown(f"**{JOB_STATUS_LABELS.get(job.status, job.status)}** · {job.descricao} · #{job.id}{duracao}")
+            if job.status in JOB_ACTIVE:
+                st.progress(float(job.progresso or 0), text=job.mensagem or "")
+            for aviso in json.loads(job.avisos or '[]'): st.warning(aviso)
+            if job.status == 'erro': st.error(job.erro)
+            elif job.status == 'concluido' and not shown:
+                # Só o resultado da última tarefa concluída é carregado
+                JOB_RESULT_VIEWS[tipo](job.id, get_job_result(job.id))
+                shown = True
+
+def render_jobs(usuario, tipo):
+    """Últimas tarefas do usuário; enquanto alguma está ativa o bloco se atualiza sozinho"""
+    jobs = list_jobs(usuario, tipo)
+    if jobs.empty: return
+    polling = bool(jobs['status'].isin(JOB_ACTIVE).any())
+    st.markdown("###### Tarefas em segundo plano")
+    st.fragment(render_job_list, run_every=JOB_POLL_SECONDS if polling else None)(usuario, tipo, polling)
+
 # ===========================================
 # INTERFACE
 # ===========================================
@@ -1011,26 +3569,20 @@ def main_app():
         st.session_state.clear()
         st.rerun()
 
-    conn = get_db_connection()
-    try:
-        df_payments = pd.read_sql("SELECT * FROM payments", conn)
-    except:
-        df_payments = pd.DataFrame()
-    conn.close()
-
     if choice == "Dashboard":
         render_header()
         st.markdown("### 📊 Dashboard Executivo")
         
-        if not df_payments.empty:
-            periods = df_payments['competencia'].unique()
+        kpis = get_payments_kpis()
+        if kpis['registros'] > 0:
+            periods = get_competencias()
             period_str = ", ".join(str(p) for p in periods if p)
             st.info(f"📅 **Competência(s) em Análise:** {period_str}")
             k1, k2, k3, k4 = st.columns(4)
-            total = df_payments['valor_pagto'].sum()
-            benef = df_payments['num_cartao'].nunique()
-            projs = df_payments['programa'].nunique()
-            gers = df_payments['gerenciadora'].nunique()
+            total = kpis['total']
+            benef = kpis['beneficiarios']
+            projs = kpis['projetos']
+            gers = kpis['gerenciadoras']
             k1.metric("Total Pago", f"R$ {total:,.2f}")
             k2.metric("Beneficiários Únicos", benef)
             k3.metric("Projetos Ativos", projs)
@@ -1038,11 +3590,11 @@ def main_app():
             c1, c2 = st.columns(2)
             with c1:
                 st.subheader("Total por Projeto")
-                g1 = df_payments.groupby('programa')['valor_pagto'].sum().reset_index()
+                g1 = get_totals_by('programa')
                 st.plotly_chart(px.bar(g1, x='valor_pagto', y='programa', orientation='h'), use_container_width=True)
             with c2:
                 st.subheader("Por Gerenciadora")
-                g2 = df_payments.groupby('gerenciadora')['valor_pagto'].sum().reset_index()
+                g2 = get_totals_by('gerenciadora')
                 st.plotly_chart(px.pie(g2, names='gerenciadora', values='valor_pagto'), use_container_width=True)
         else: st.info("Sem dados no sistema. Faça upload na aba 'Upload e Processamento'.")
 
@@ -1066,7 +3618,7 @@ def main_app():
     elif choice == "Upload e Processamento":
         render_header()
         st.markdown("### 📂 Upload de Pagamentos")
-        reg_count = len(df_payments)
+        reg_count = get_payments_count()
         if reg_count > 0:
             st.info(f"💾 **Banco de Dados Ativo:** {reg_count} registros já carregados.")
         else:
@@ -1075,41 +3627,13 @@ def main_app():
         files = st.file_uploader("Arquivos (CSV/XLSX)", accept_multiple_files=True)
         
         if files and st.button("Processar Arquivos"):
-            conn = get_db_connection()
-            try:
-                exist_query = pd.read_sql("SELECT DISTINCT arquivo_origem FROM payments", conn)
-                exist = exist_query['arquivo_origem'].tolist() if not exist_query.empty else []
-            except: exist = []
-            conn.close()
-            dfs = []
-            for f in files:
-                if f.name in exist:
-                    st.warning(f"Ignorado (já existe): {f.name}")
-                    continue
-                if 'REL.CADASTRO' in f.name.upper():
-                    st.warning(f"Ignorado (Parece arquivo de conferência bancária): {f.name}")
-                    continue
-                try:
-                    if f.name.endswith('.csv'): 
-                        try: df = pd.read_csv(f, sep=';', encoding='latin1', dtype=str, low_memory=False)
-                        except: f.seek(0); df = pd.read_csv(f, sep=',', encoding='utf-8', dtype=str, low_memory=False)
-                    else: df = pd.read_excel(f, dtype=str)
-                    df_std = standardize_dataframe(df, f.name)
-                    if not df_std.empty: dfs.append(df_std)
-                except Exception as e: st.error(f"Erro ao ler {f.name}: {e}")
-            if dfs:
-                final = pd.concat(dfs, ignore_index=True)
-                conn = get_db_connection()
-                final.to_sql('payments', conn, if_exists='append', index=False)
-                conn.close()
-                log_action(user['email'], "UPLOAD", f"Upload de {len(files)} arquivos, {len(final)} registros")
-                st.success(f"✅ {len(final)} registros salvos com sucesso!")
-                inconsistencies = detect_inconsistencies(final)
-                if not inconsistencies.empty:
-                    st.markdown("---")
-                    st.error("🚨 ATENÇÃO: ERROS DE DADOS AUSENTES OU INCONSISTÊNCIAS IDENTIFICADOS NO UPLOAD!")
-                    st.dataframe(inconsistencies, use_container_width=True)
-                st.warning("A tela será atualizada em instantes para consolidar os dados...")
+            job_files = [JobFile(f.name, f.getvalue()) for f in files]
+            # Layout dos CSVs detectado aqui, onde o cache de layouts da sessão está disponível
+            layouts = {f.name: sniff_csv_layout(f) for f in job_files if f.name.endswith('.csv')}
+            submit_job('upload', user['email'], f"Upload de {len(files)} arquivo(s)",
+                       files=job_files, layouts=layouts)
+            st.toast("Upload enviado para processamento em segundo plano.")
+        render_jobs(user['email'], 'upload')
                 
     # ===========================================
     # ANÁLISE E CORREÇÃO (ATUALIZADA COM MALHA FINA E BACKFILLING)
@@ -1128,18 +3652,16 @@ def main_app():
                 st.radio("Período de Análise", ["Mês Único", "Intervalo"], horizontal=True)
             
             with c_year:
-                anos_disp = sorted(df_payments['ano_ref'].unique().astype(str)) if not df_payments.empty else [str(datetime.now().year)]
+                anos_disp = sorted(str(a) for a in get_distinct_values('ano_ref')) or [str(datetime.now().year)]
                 sel_ano = st.selectbox("Ano", anos_disp, index=len(anos_disp)-1 if anos_disp else 0)
             
             with c_month:
-                meses_disp = sorted(df_payments['competencia'].unique().astype(str)) if not df_payments.empty else ["Outubro 2025"]
+                meses_disp = sorted(str(m) for m in get_competencias()) or ["Outubro 2025"]
                 sel_mes = st.selectbox("Mês/Competência", meses_disp)
 
         st.markdown("---")
 
-        df_filtered = df_payments.copy()
-        if not df_filtered.empty:
-            df_filtered = df_filtered[df_filtered['competencia'] == sel_mes]
+        df_filtered = get_payments_by_competencia(sel_mes)
 
         tabs = st.tabs([
             "Visão Geral", 
@@ -1160,7 +3682,7 @@ def main_app():
             st.markdown("#### Registros com Pendências (CPF ou Cartão)")
             if not df_filtered.empty:
                 # Usa a lógica já existente no seu app.py para detectar erros
-                errors = detect_inconsistencies(df_filtered)
+                errors = get_inconsistencies_by_competencia(sel_mes)
                 if not errors.empty:
                     st.error(f"{len(errors)} registros inconsistentes encontrados.")
                     st.dataframe(errors, use_container_width=True)
@@ -1170,13 +3692,15 @@ def main_app():
                          # Editor simples para correção pontual
                          ids_err = errors['ID'].dropna().tolist()
                          if ids_err:
-                            to_edit = df_payments[df_payments['id'].isin(ids_err)]
+                            to_edit = df_filtered[df_filtered['id'].isin(ids_err)]
                             edited = st.data_editor(to_edit, key='edit_missing_tab', use_container_width=True)
                             if st.button("Salvar Correções Pontuais"):
                                 conn = get_db_connection()
-                                conn.execute("DELETE FROM payments WHERE id IN (" + ",".join(map(str, ids_err)) + ")")
-                                edited.to_sql('payments', conn, if_exists='append', index=False)
+                                delete_payments(conn, "id IN (" + ",".join(map(str, ids_err)) + ")")
+                                insert_payments(conn, edited)
+                                conn.commit()
                                 conn.close()
+                                request_snapshot_refresh()
                                 st.success("Salvo!")
                                 st.rerun()
                 else:
@@ -1187,9 +3711,7 @@ def main_app():
 
         with tabs[3]:
             st.markdown("#### Cruzamento: Sistema vs Retorno Bancário")
-            conn = get_db_connection()
-            disc = pd.read_sql("SELECT * FROM bank_discrepancies", conn)
-            conn.close()
+            disc = get_bank_discrepancies()
             if not disc.empty:
                 st.dataframe(disc, use_container_width=True)
             else:
@@ -1204,70 +3726,30 @@ def main_app():
             todas as contas que possuem CPF válido em algum momento e preencherá onde está vazio na seleção atual.</p>
             """, unsafe_allow_html=True)
             
+            escopos_bf = ["Competência selecionada", "Intervalo de competências", "Base inteira"]
+            escopo_bf = st.radio("Escopo", escopos_bf, horizontal=True, key='backfill_escopo')
+            comps_bf = sorted(get_competencias(), key=competencia_sort_key)
+            if escopo_bf == escopos_bf[0]:
+                comp_sel = [sel_mes]
+            elif escopo_bf == escopos_bf[1] and comps_bf:
+                ini_bf, fim_bf = st.select_slider("Competências", options=comps_bf, value=(comps_bf[0], comps_bf[-1]))
+                comp_sel = comps_bf[comps_bf.index(ini_bf):comps_bf.index(fim_bf) + 1]
+            else:
+                comp_sel = None
+            dry_run = st.checkbox("Simular (só conta o que seria recuperado, sem gravar)", value=False)
+            
+            conn = get_db_connection()
+            checkpoint = get_backfill_checkpoint(conn, comp_sel)
+            conn.close()
+            if checkpoint:
+                st.info(f"Execução interrompida neste escopo em {checkpoint[2]}: será retomada após o registro {checkpoint[0]} "
+                        f"({checkpoint[1]} registros já atualizados).")
+            
             if st.button("🚀 Executar Backfilling", type="primary"):
-                status_box = st.empty()
-                log_box = st.empty()
-                logs_html = ""
-                
-                status_box.markdown("**🔄 Aplicando correções...**")
-                logs_html += "<div class='console-log'>🔍 Mapeando histórico de contas (Chave Mestra)...</div>"
-                log_box.markdown(logs_html, unsafe_allow_html=True)
-                
-                conn = get_db_connection()
-                master_map = build_master_key(conn)
-                time.sleep(1)
-                
-                logs_html += f"<div class='console-log'>✅ Histórico mapeado: {len(master_map)} contas únicas com dados.</div>"
-                log_box.markdown(logs_html, unsafe_allow_html=True)
-                
-                cursor = conn.cursor()
-                cursor.execute("SELECT id, num_cartao, cpf, rg FROM payments")
-                rows = cursor.fetchall()
-                
-                logs_html += f"<div class='console-log'>🔍 Analisando {len(rows)} registros na base...</div>"
-                log_box.markdown(logs_html, unsafe_allow_html=True)
-                
-                updated = 0
-                rec_cpf = 0
-                rec_rg = 0
-                prog_bar = st.progress(0)
-                
-                for i, row in enumerate(rows):
-                    rid, r_card, r_cpf, r_rg = row
-                    key = normalize_key(r_card)
-                    
-                    if key in master_map:
-                        info = master_map[key]
-                        changes = []
-                        n_cpf = r_cpf
-                        n_rg = r_rg
-                        
-                        curr_cpf = normalize_key(r_cpf)
-                        if (not curr_cpf or len(curr_cpf) < 5) and info['cpf']:
-                            n_cpf = info['cpf']
-                            changes.append('CPF')
-                            rec_cpf += 1
-                            
-                        curr_rg = normalize_key(r_rg)
-                        if (not curr_rg or len(curr_rg) < 3) and info['rg']:
-                            n_rg = info['rg']
-                            changes.append('RG')
-                            rec_rg += 1
-                            
-                        if changes:
-                            cursor.execute("UPDATE payments SET cpf = ?, rg = ? WHERE id = ?", (n_cpf, n_rg, rid))
-                            updated += 1
-                    
-                    if i % 500 == 0: prog_bar.progress((i+1)/len(rows))
-                
-                conn.commit()
-                conn.close()
-                prog_bar.progress(100)
-                
-                logs_html += f"<div class='console-log'>🚀 Concluído! {updated} registros atualizados.<br>CPFs: {rec_cpf} | RGs: {rec_rg}</div>"
-                log_box.markdown(logs_html, unsafe_allow_html=True)
-                status_box.success("Processo Finalizado com Sucesso!")
-                log_action(user['email'], "BACKFILL", f"Recuperados: {updated}")
+                escopo_txt = "base inteira" if comp_sel is None else ", ".join(comp_sel[:3]) + ("..." if len(comp_sel) > 3 else "")
+                submit_job('backfill', user['email'], f"{'Simulação de backfilling' if dry_run else 'Backfilling'} ({escopo_txt})",
+                           competencias=comp_sel, dry_run=dry_run)
+            render_jobs(user['email'], 'backfill')
             
             st.markdown('</div>', unsafe_allow_html=True)
 
@@ -1275,140 +3757,69 @@ def main_app():
         render_header()
         st.markdown("### 📥 Relatórios e Exportação")
         
-        if not df_payments.empty:
-            projs = df_payments['programa'].unique()
+        projs = get_distinct_values('programa')
+        if projs:
             sel_proj = st.multiselect("Filtrar Projeto", projs, default=projs)
             
-            if sel_proj:
-                df_exp = df_payments[df_payments['programa'].isin(sel_proj)]
-            else:
-                df_exp = df_payments
+            # Todos (ou nenhum) selecionados: exporta a base inteira, sem IN gigante
+            exp_filter = sorted(sel_proj) if sel_proj and len(sel_proj) < len(projs) else None
             
-            crit_subset = detect_inconsistencies(df_exp)
             st.markdown("---")
             c1, c2, c3, c4 = st.columns(4)
             
             with c1:
                 st.markdown("###### 📑 Relatório Executivo")
                 if st.button("Gerar Relatório PDF"):
-                    with st.spinner("Gerando PDF..."):
-                        pdf_data = generate_pdf_report(df_exp, crit_subset)
-                        if isinstance(pdf_data, bytes):
-                            st.download_button("⬇️ Baixar PDF", pdf_data, "relatorio_executivo.pdf", "application/pdf")
-                            log_action(user['email'], "RELATORIO_PDF", "Gerou relatório executivo")
-                        else: st.error(pdf_data)
-            
-            with c2:
-                st.markdown("###### 📄 Dados Completos")
-                csv = df_exp.to_csv(index=False, sep=';').encode('utf-8-sig')
-                st.download_button("⬇️ Baixar CSV", csv, "dados_pot.csv", "text/csv")
-            
-            with c3:
-                st.markdown("###### 📊 Planilha Excel")
-                buffer = io.BytesIO()
-                with pd.ExcelWriter(buffer, engine='xlsxwriter') as writer: df_exp.to_excel(writer, index=False)
-                st.download_button("⬇️ Baixar Excel", buffer.getvalue(), "dados_pot.xlsx", "application/vnd.ms-excel")
+                    submit_job('relatorio_pdf', user['email'], "Relatório executivo" + (f" ({len(exp_filter)} projeto(s))" if exp_filter else ""),
+                               programas=exp_filter, artifacts=get_artifact_cache())
+                render_jobs(user['email'], 'relatorio_pdf')
             
-            with c4:
-                st.markdown("###### 🏦 Layout Banco (BB)")
-                txt = generate_bb_txt(df_exp)
-                st.download_button("⬇️ Baixar TXT", txt, "remessa_bb.txt", "text/plain")
+            # Cada exportação só é gerada no clique, para o filtro atual
+            for col, fmt in zip((c2, c3, c4), EXPORT_FORMATS):
+                with col: export_download(fmt, exp_filter)
+
+            st.markdown("---")
+            st.markdown("###### 📦 Pacote por Projeto / Gerenciadora")
+            b1, b2 = st.columns(2)
+            particao = b1.multiselect("Separar por", list(EXPORT_PARTITIONS), default=['programa'], format_func=EXPORT_PARTITIONS.get)
+            formatos = b2.multiselect("Arquivos de cada pasta", list(EXPORT_FORMATS), default=['csv', 'txt'],
+                                      format_func=lambda f: EXPORT_FORMATS[f]['rotulo'])
+            if st.button("Gerar Pacote (ZIP)", disabled=not (particao and formatos)):
+                submit_job('pacote_exportacao', user['email'],
+                           f"Pacote por {' e '.join(EXPORT_PARTITIONS[c] for c in particao)} ({', '.join(EXPORT_FORMATS[f]['rotulo'] for f in formatos)})",
+                           programas=exp_filter, particao=particao, formatos=formatos)
+            render_jobs(user['email'], 'pacote_exportacao')
 
     elif choice == "Conferência Bancária (BB)":
         render_header()
         st.markdown("### 🏦 Conferência BB (Auditoria Avançada)")
         st.info("Suporte a: Relatórios de Cadastro, Arquivos de Lote (CNAB) e Resumos de Crédito (Spool).")
         
-        conn = get_db_connection()
-        try:
-            hist = pd.read_sql("SELECT * FROM bank_discrepancies", conn)
-        except: hist = pd.DataFrame()
-        conn.close()
+        hist = get_bank_discrepancies()
         
         if not hist.empty:
             st.warning(f"⚠️ {len(hist)} divergências encontradas no histórico.")
             st.dataframe(hist, use_container_width=True)
             c_pdf, c_limp = st.columns(2)
-            pdf_conf = generate_conference_pdf(hist)
-            if isinstance(pdf_conf, bytes):
-                c_pdf.download_button("📑 Baixar Relatório PDF (Divergências)", pdf_conf, "divergencias_bb.pdf", "application/pdf")
+            artifact_download(c_pdf, 'pdf_divergencias', hist, generate_conference_pdf, "Relatório PDF (Divergências)",
+                              "divergencias_bb.pdf", "application/pdf", version=get_db_generation())
             if user['role'] in ['admin_ti', 'admin_equipe']:
                 if c_limp.button("Limpar Histórico de Divergências"):
                     conn = get_db_connection()
                     conn.execute("DELETE FROM bank_discrepancies")
+                    conn.execute("DELETE FROM bank_reconciliation_runs")
+                    bump_generation(conn)
                     conn.commit()
                     conn.close()
                     st.success("Histórico limpo.")
                     st.rerun()
                 
         files = st.file_uploader("Upload Arquivos Banco (TXT)", accept_multiple_files=True)
+        reprocess = st.checkbox("Reconferir arquivos já processados", value=False)
         if files and st.button("Executar Cruzamento (Malha Fina)"):
-            dfs = []
-            for f in files:
-                try:
-                    d = parse_smart_bb(f, f.name)
-                    if not d.empty:
-                        dfs.append(d)
-                        st.toast(f"{f.name}: {len(d)} registros lidos.")
-                    else:
-                        st.warning(f"Arquivo {f.name} lido, mas sem dados reconhecidos.")
-                except Exception as e: st.error(f"Erro ao ler {f.name}: {e}")
-            
-            if dfs:
-                final_bb = pd.concat(dfs, ignore_index=True)
-                final_bb['key'] = final_bb['num_cartao'].astype(str).str.replace(r'^0+', '', regex=True).str.replace(r'\.0$', '', regex=True).str.strip()
-                
-                conn = get_db_connection()
-                df_sys = pd.read_sql("SELECT num_cartao, nome, cpf, rg FROM payments", conn)
-                conn.close()
-                df_sys['key'] = df_sys['num_cartao'].astype(str).str.replace(r'^0+', '', regex=True).str.replace(r'\.0$', '', regex=True).str.strip()
-                
-                merged = pd.merge(df_sys, final_bb, on='key', suffixes=('_sis', '_bb'))
-                divs = []
-                for _, row in merged.iterrows():
-                    nm_s = normalize_name(row.get('nome_sis', ''))
-                    nm_b = normalize_name(row.get('nome_bb', ''))
-                    if nm_s != nm_b:
-                        divs.append({
-                            'cartao': row['key'],
-                            'nome_sis': row.get('nome_sis', ''),
-                            'nome_bb': row.get('nome_bb', ''),
-                            'cpf_sis': row.get('cpf', ''),
-                            'cpf_bb': row.get('cpf_banco', ''),
-                            'rg_sis': row.get('rg', ''),
-                            'rg_bb': row.get('rg_banco', ''),
-                            'divergencia': 'ALERTA MÁXIMO: NOME DIVERGENTE',
-                            'arquivo_origem': row['arquivo_origem'],
-                            'tipo_erro': 'SUSPEITA_TROCA_TITULARIDADE'
-                        })
-                    cpf_bb = str(row.get('cpf_banco', '')).strip()
-                    if cpf_bb and len(cpf_bb) > 5:
-                        cpf_s_clean = str(row.get('cpf', '')).replace('.', '').replace('-', '').strip()
-                        cpf_b_clean = cpf_bb.replace('.', '').replace('-', '').strip()
-                        if cpf_s_clean != cpf_b_clean:
-                            divs.append({
-                                'cartao': row['key'],
-                                'nome_sis': row.get('nome_sis', ''),
-                                'nome_bb': row.get('nome_bb', ''),
-                                'cpf_sis': row.get('cpf', ''),
-                                'cpf_bb': cpf_bb,
-                                'rg_sis': row.get('rg', ''),
-                                'rg_bb': row.get('rg_banco', ''),
-                                'divergencia': 'CPF DIVERGENTE (FRAUDE)',
-                                'arquivo_origem': row['arquivo_origem'],
-                                'tipo_erro': 'DADOS_CADASTRAIS'
-                            })
-                if divs:
-                    dd = pd.DataFrame(divs)
-                    conn = get_db_connection()
-                    dd.to_sql('bank_discrepancies', conn, if_exists='append', index=False)
-                    conn.close()
-                    st.error(f"🚨 ALERTA DE FRAUDE: {len(dd)} divergências de titularidade identificadas!")
-                    st.rerun()
-                else: 
-                    st.success(f"✅ Auditoria Blindada: {len(final_bb)} registros processados. Nenhuma troca de titularidade detectada.")
-            else:
-                st.warning("Nenhum dado válido extraído dos arquivos enviados.")
+            submit_job('conferencia_bb', user['email'], f"Cruzamento de {len(files)} arquivo(s) do banco",
+                       files=[JobFile(f.name, f.getvalue()) for f in files], reprocess=reprocess)
+        render_jobs(user['email'], 'conferencia_bb')
 
     elif choice == "Gestão de Dados":
         render_header()
@@ -1435,9 +3846,11 @@ def main_app():
                 
                 if st.button(f"🗑️ Excluir registros de: {file_to_del}"):
                     conn = get_db_connection()
-                    conn.execute("DELETE FROM payments WHERE arquivo_origem = ?", (file_to_del,))
+                    delete_payments(conn, "arquivo_origem = ?", (file_to_del,), bulk=True)
                     conn.commit()
                     conn.close()
+                    discard_payments_snapshot()
+                    request_snapshot_refresh()
                     log_action(user['email'], "EXCLUIR_ARQUIVO", f"Excluiu arquivo: {file_to_del}")
                     st.success(f"Todos os registros do arquivo '{file_to_del}' foram removidos.")
                     st.rerun()
@@ -1467,9 +3880,10 @@ def main_app():
                         if st.button("Confirmar Exclusão dos Selecionados"):
                             conn = get_db_connection()
                             id_list = ','.join(map(str, ids_to_delete))
-                            conn.execute(f"DELETE FROM payments WHERE id IN ({id_list})")
+                            delete_payments(conn, f"id IN ({id_list})")
                             conn.commit()
                             conn.close()
+                            request_snapshot_refresh()
                             log_action(user['email'], "EXCLUIR_REGISTROS", f"Excluiu IDs: {id_list}")
                             st.success("Registros excluídos com sucesso!")
                             st.rerun()
@@ -1545,9 +3959,9 @@ def main_app():
         conn.close()
         st.dataframe(logs, use_container_width=True)
         c1, c2 = st.columns(2)
-        pdf_logs = generate_audit_log_pdf(logs)
-        if isinstance(pdf_logs, bytes):
-            c1.download_button("📄 Baixar Logs (PDF)", pdf_logs, "auditoria_sistema.pdf", "application/pdf")
+        # audit_logs só recebe inserções (AUTOINCREMENT) ou é esvaziada: quantidade + maior id identificam o conteúdo
+        artifact_download(c1, 'pdf_auditoria', logs, generate_audit_log_pdf, "Logs (PDF)", "auditoria_sistema.pdf", "application/pdf",
+                          version=(len(logs), int(logs['id'].max()) if len(logs) else 0))
         if c2.button("⚠️ LIMPAR LOGS"):
             conn = get_db_connection()
             conn.execute("DELETE FROM audit_logs")
@@ -1556,12 +3970,56 @@ def main_app():
             st.warning("Logs limpos.")
             st.rerun()
         st.markdown("---")
+        st.markdown("#### ⚡ Cache de Consultas")
+        cache_stats = get_query_cache().stats()
+        m1, m2, m3, m4 = st.columns(4)
+        m1.metric("Hit Rate", f"{cache_stats['hit_rate']:.0%}", f"{cache_stats['hits']} hits / {cache_stats['misses']} misses", delta_color="off")
+        m2.metric("Entradas", cache_stats['entradas'])
+        m3.metric("Memória", f"{cache_stats['memoria_mb']:.1f} / {cache_stats['limite_mb']:.0f} MB")
+        m4.metric("Evictions (LRU)", cache_stats['evictions'])
+        st.caption(f"Geração atual da base: {cache_stats['geracao']}")
+        artifact_stats = get_artifact_cache().stats()
+        st.caption(f"Relatórios e exportações em cache: {artifact_stats['entradas']} ({artifact_stats['arquivos']} em arquivo temporário; "
+                   f"{artifact_stats['memoria_mb']:.1f} / {artifact_stats['limite_mb']:.0f} MB em memória) · "
+                   f"{artifact_stats['hits']} reaproveitados · {artifact_stats['evictions']} descartados")
+        snap = snapshot_stats()
+        if snap and snap['indisponivel']:
+            st.caption(f"Snapshot colunar de pagamentos indisponível (leituras pelo SQLite): {snap['indisponivel']}")
+        elif snap:
+            st.caption(f"Snapshot colunar de pagamentos: {snap['linhas']:,} linhas na geração {snap['geracao']} · "
+                       f"{snap['segmentos']} segmento(s), {snap['substituidas']:,} linhas substituídas · {snap['disco_mb']:.0f} MB em disco")
+        cb1, cb2 = st.columns(2)
+        if cb1.button("Limpar Cache de Consultas"):
+            get_query_cache().clear()
+            get_artifact_cache().clear()
+            st.rerun()
+        if cb2.button("🔧 Reconstruir Índice CPF/Cartão e Agregados do Dashboard"):
+            with st.spinner("Reconstruindo a partir da tabela de pagamentos..."):
+                conn = get_db_connection()
+                rebuild_key_index(conn)
+                rebuild_rollup(conn)
+                bump_generation(conn)
+                conn.commit()
+                conn.close()
+                discard_payments_snapshot()
+                request_snapshot_refresh()
+            log_action(user['email'], "REBUILD_AGREGADOS", "Reconstruiu índice de chaves, rollup do dashboard e snapshot colunar")
+            st.success("Índice e agregados reconstruídos.")
+        st.markdown("---")
         if st.button("🗑️ LIMPAR DADOS PAGAMENTOS (RESET TOTAL)"):
             conn = get_db_connection()
-            conn.execute("DELETE FROM payments")
+            delete_payments_untracked(conn)
+            conn.execute("DELETE FROM payment_keys")
+            conn.execute("DELETE FROM payments_rollup")
+            conn.execute("DELETE FROM payments_rollup_cards")
             conn.execute("DELETE FROM bank_discrepancies")
+            conn.execute("DELETE FROM bank_reconciliation_runs")
+            conn.execute("DELETE FROM backfill_checkpoints")  # senão uma retomada traria ultimo_id e contadores da base antiga
+            bump_generation(conn)
             conn.commit()
             conn.close()
+            discard_payments_snapshot()
+            request_snapshot_refresh()
             log_action(user['email'], "RESET_DB", "Limpou todas as tabelas de dados")
             st.success("Banco de dados de pagamentos reiniciado.")
             st.rerun()
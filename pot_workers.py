@@ -0,0 +1,37 @@
+"""
+Entrada dos processos de trabalho do app.py (pool 'spawn', ver run_process_pool).
+
+Sob o Streamlit o app.py roda como um __main__ recriado a cada rerun, então as funções
+dele não podem ser referenciadas por pickle. Cada processo filho carrega o app.py uma vez
+como módulo comum (a interface fica sob if __name__ == "__main__") e chama a função pelo nome.
+"""
+import importlib.util
+import os
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+
+_app = None
+
+def app_module():
+    global _app
+    if _app is None:
+        # O spawn já executa o script principal como __mp_main__ quando ele é o app.py
+        main = sys.modules.get('__mp_main__')
+        if main is not None and os.path.abspath(getattr(main, '__file__', '') or '') == APP_PATH:
+            _app = main
+        else:
+            import streamlit.logger
+            streamlit.logger.set_log_level('error')  # fora do servidor as chamadas st.* só avisam
+            spec = importlib.util.spec_from_file_location('pot_app', APP_PATH)
+            _app = importlib.util.module_from_spec(spec)
+            sys.modules['pot_app'] = _app
+            spec.loader.exec_module(_app)
+    return _app
+
+def call(func_name, args):
+    """app.<func_name>(*args) no processo filho; devolve (resultado, erro)"""
+    try:
+        return getattr(app_module(), func_name)(*args), None
+    except Exception as e:
+        return None, str(e)
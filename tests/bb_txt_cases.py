@@ -0,0 +1,85 @@
+"""
+Quadros de entrada da remessa BB (layout TXT), usados pelo test_bb_txt.py e pelo bench_bb_txt.py.
+
+As saídas de referência em tests/data/bb_txt/ foram geradas pelo laço original linha a linha
+(reference_bb_txt_lines) com `python tests/bench_bb_txt.py --golden`.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+
+DATA_DIR = 'bb_txt'
+
+
+def reference_bb_txt_lines(df):
+    """Laço original (iterrows) das linhas de detalhe da remessa BB, referência do motor colunar"""
+    buffer = io.StringIO()
+    for _, row in df.iterrows():
+        projeto = str(row.get('programa', ''))[:30]
+        cartao = str(row.get('num_cartao', ''))[:15]
+        nome = str(row.get('nome', ''))[:40]
+        rg = str(row.get('rg', ''))[:12]
+        cpf = str(row.get('cpf', ''))[:14]
+        line = f"{'1':<11}{projeto:<31}{cartao:<10} {nome:<40} {rg:<12} {cpf:<15}\n"
+        buffer.write(line)
+    return buffer.getvalue()
+
+
+def text_na_dtype():
+    """Dtype de texto do pandas 3 (ausente = NaN); None onde o pandas instalado não o tem"""
+    try:
+        return pd.StringDtype(na_value=np.nan)
+    except TypeError:
+        return None
+
+
+def edge_frame():
+    """Ausentes (None/NaN), int e float misturados em colunas object, textos acima do corte"""
+    return pd.DataFrame({
+        'programa': pd.Series(['ABAE', None, np.nan, 'X' * 45, 'AÇÃO SOCIAL – ZONA LESTE', '', 12.5, 7], dtype=object),
+        'num_cartao': pd.Series(['123', '12345678901234567890', None, 4000123, 4000123.0, 'abc', np.nan, ''], dtype=object),
+        'nome': pd.Series(['JOSÉ DA SILVA', 'N' * 60, '', None, 'MARIA', '  espaços  ', np.nan, 'ÇÃÕ'], dtype=object),
+        'rg': pd.Series(['1', None, 2, np.nan, 'ÁÉ', '', None, 3.5], dtype=object),
+        'cpf': pd.Series(['123.456.789-09', None, '1' * 20, 12345678909, '', np.nan, 'x', '0'], dtype=object),
+        'outra': range(8),
+    })
+
+
+def random_frame(n=1500, seed=23):
+    """Pagamentos sintéticos: cartão/CPF como texto, int e float; RG inteiro; CPF float com NaN"""
+    rng = np.random.default_rng(seed)
+    programas = np.array(['POT ABAE', 'POT CONSTRUÇÃO CIVIL', 'OPERAÇÃO TRABALHO – JARDINAGEM E ZELADORIA URBANA', None], dtype=object)
+    nomes = np.array(['JOSÉ DA SILVA', 'MARIA APARECIDA DOS SANTOS DE OLIVEIRA FERREIRA', 'ANA LIMA', '', None], dtype=object)
+    cards = rng.integers(4_000_000, 4_000_050, n)
+    card_kind = rng.integers(0, 4, n)
+    num_cartao = np.array([str(c) if k == 0 else int(c) if k == 1 else float(c) if k == 2 else None
+                           for c, k in zip(cards, card_kind)], dtype=object)
+    cpf = rng.integers(10**10, 10**11, n).astype(float)
+    cpf[rng.random(n) < 0.05] = np.nan
+    return pd.DataFrame({
+        'id': np.arange(1, n + 1),
+        'programa': rng.choice(programas, n),
+        'num_cartao': num_cartao,
+        'nome': rng.choice(nomes, n),
+        'rg': rng.integers(1, 10**9, n),
+        'cpf': cpf,
+        'valor_pagto': rng.integers(10000, 200000, n) / 100,
+    })
+
+
+def bb_txt_cases():
+    """{nome: DataFrame} de cada caso com saída de referência"""
+    edge = edge_frame()
+    cases = {
+        'edge_object': edge,
+        'edge_string_na': edge.astype({'nome': 'string', 'programa': 'string'}).assign(
+            cpf=pd.Series(['123', None, pd.NA, '9' * 20, '', 'x', None, '0'], dtype='string')),
+        'edge_missing_columns': edge[['outra', 'nome']],
+        'empty': edge.iloc[:0],
+        'random': random_frame(),
+    }
+    text_dtype = text_na_dtype()
+    if text_dtype is not None:
+        cases['edge_text_nan'] = edge.astype({'nome': text_dtype, 'programa': text_dtype})
+    return cases
@@ -0,0 +1,75 @@
+"""
+Benchmark da remessa BB (layout TXT): laço original linha a linha x motor colunar do app.py.
+
+    python tests/bench_bb_txt.py                 # 10 mil e 200 mil linhas sintéticas
+    python tests/bench_bb_txt.py 1000000         # tamanhos à escolha
+    python tests/bench_bb_txt.py --db pot.db     # pagamentos de uma base real
+    python tests/bench_bb_txt.py --golden        # regrava tests/data/bb_txt/ com o laço original
+"""
+import argparse
+import importlib.util
+import io
+import os
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+
+from bb_txt_cases import DATA_DIR, bb_txt_cases, random_frame, reference_bb_txt_lines
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(TESTS)
+
+
+def load_app():
+    sys.path.insert(0, ROOT)
+    import streamlit.logger
+    streamlit.logger.set_log_level('error')
+    spec = importlib.util.spec_from_file_location('pot_app', os.path.join(ROOT, 'app.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def write_golden(app):
+    out_dir = os.path.join(TESTS, 'data', DATA_DIR)
+    os.makedirs(out_dir, exist_ok=True)
+    for name, df in bb_txt_cases().items():
+        with open(os.path.join(out_dir, f'{name}.txt'), 'wb') as f:
+            f.write((app.BB_TXT_HEADER + reference_bb_txt_lines(df)).encode('utf-8'))
+        print(f'{name}: {len(df)} linhas')
+
+
+def timed(func, df):
+    t = time.perf_counter()
+    text = func(df)
+    return text, time.perf_counter() - t
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('rows', nargs='*', type=int, default=[10000, 200000])
+    parser.add_argument('--db', help="base SQLite com a tabela payments")
+    parser.add_argument('--golden', action='store_true')
+    args = parser.parse_args()
+    app = load_app()
+    if args.golden:
+        return write_golden(app)
+    if args.db:
+        conn = sqlite3.connect(args.db)
+        frames = {'db': app.drop_match_keys(pd.read_sql("SELECT * FROM payments", conn), False)}
+        conn.close()
+    else:
+        frames = {f'{n} linhas': random_frame(n) for n in args.rows}
+    for name, df in frames.items():
+        ref, t_ref = timed(reference_bb_txt_lines, df)
+        out = io.StringIO()
+        _, t_new = timed(lambda d: app.write_bb_txt(d, out), df)
+        same = out.getvalue() == app.BB_TXT_HEADER + ref
+        print(f"{name}: original {t_ref:.2f}s ({len(df) / t_ref:,.0f} linhas/s), "
+              f"colunar {t_new:.2f}s ({len(df) / t_new:,.0f} linhas/s), {t_ref / t_new:.1f}x, saída igual: {same}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import importlib.util
+import os
+
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """app.py carregado como módulo, com a base (DB_FILE relativo) numa pasta temporária"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.syspath_prepend(ROOT)
+    spec = importlib.util.spec_from_file_location('pot_app', os.path.join(ROOT, 'app.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    mod.init_db()
+    return mod
+
+
+def payments(rows):
+    return pd.DataFrame(rows, columns=['programa', 'num_cartao', 'nome', 'cpf', 'rg', 'competencia', 'valor_pagto'])
+
+
+def test_card_with_two_historical_identities(app):
+    conn = app.get_db_connection()
+    app.insert_payments(conn, payments([
+        ('POT', '1001', 'José da Silva', '123.456.789-00', '11', '01/2024', 100.0),
+        # Mesma identidade, só formatação/RG diferentes: não é outra linha na conferência
+        ('POT', '1001', 'JOSE DA SILVA', '12345678900', '22', '02/2024', 100.0),
+        ('POT', '1001', 'Maria Souza', '98765432100', '33', '03/2024', 100.0),
+        ('POT', '2002', 'Ana Lima', '11122233344', '44', '03/2024', 100.0),
+    ]))
+    conn.commit()
+    bank = pd.DataFrame({
+        'num_cartao': ['1001', '2002'],
+        'nome_banco': ['PEDRO ALVES', 'ANA LIMA'],
+        'cpf_banco': ['55566677788', '11122233344'],
+        'rg_banco': ['99', '44'],
+        'arquivo_origem': ['lote.txt', 'lote.txt'],
+    })
+
+    dd = app.reconcile_bank_records(conn, bank)
+    assert sorted(dd['tipo_erro']) == ['DADOS_CADASTRAIS', 'SUSPEITA_TROCA_TITULARIDADE']
+    assert not dd.duplicated(app.BANK_DISCREPANCY_KEY).any()
+    nome = dd.loc[dd['tipo_erro'] == 'SUSPEITA_TROCA_TITULARIDADE', 'nome_sis'].iloc[0]
+    assert sorted(nome.split(' | ')) == ['JOSE DA SILVA', 'Maria Souza']
+
+    # Contagem informada = linhas gravadas, também ao reconferir o mesmo lote
+    assert app.save_bank_discrepancies(conn, dd) == len(dd)
+    conn.commit()
+    again = app.reconcile_bank_records(conn, bank)
+    assert app.save_bank_discrepancies(conn, again) == 0
+    conn.commit()
+    stored = conn.execute("SELECT COUNT(*) FROM bank_discrepancies").fetchone()[0]
+    assert stored == len(dd) == len(again)
+    conn.close()
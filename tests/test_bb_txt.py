@@ -0,0 +1,56 @@
+import importlib.util
+import io
+import os
+
+import pandas as pd
+import pytest
+
+from bb_txt_cases import DATA_DIR, bb_txt_cases
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CASES = bb_txt_cases()
+
+
+@pytest.fixture(scope='module')
+def app():
+    spec = importlib.util.spec_from_file_location('pot_app', os.path.join(ROOT, 'app.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def golden(name):
+    """Remessa gravada pelo laço original (bytes UTF-8, com cabeçalho)"""
+    with open(os.path.join(ROOT, 'tests', 'data', DATA_DIR, f'{name}.txt'), 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_lines_match_golden(app, name):
+    df = CASES[name].copy()
+    assert (app.BB_TXT_HEADER + app.bb_txt_lines(df)).encode('utf-8') == golden(name)
+    assert df.equals(CASES[name])
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_write_single_frame_matches_golden(app, name):
+    out = io.BytesIO()
+    app.write_payments_bb_txt(CASES[name], out)
+    assert out.getvalue() == golden(name)
+
+
+@pytest.mark.parametrize('name', sorted(CASES))
+def test_write_chunks_matches_golden(app, name, monkeypatch):
+    # Blocos de leitura (chunks) e de escrita (BB_TXT_BLOCK_ROWS) que não se alinham
+    monkeypatch.setattr(app, 'BB_TXT_BLOCK_ROWS', 5)
+    df = CASES[name]
+    chunks = (df.iloc[i:i + 7] for i in range(0, len(df), 7))
+    out = io.BytesIO()
+    app.write_payments_bb_txt(chunks, out)
+    assert out.getvalue() == golden(name)
+
+
+def test_write_text_stream(app):
+    out = io.StringIO()
+    app.write_bb_txt([CASES['random'].iloc[:700], pd.DataFrame(), CASES['random'].iloc[700:]], out)
+    assert out.getvalue().encode('utf-8') == golden('random')
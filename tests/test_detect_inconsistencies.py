@@ -0,0 +1,115 @@
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def app():
+    spec = importlib.util.spec_from_file_location('pot_app', os.path.join(ROOT, 'app.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def reference_detect(app, df):
+    """Laço original (linha a linha) de detect_inconsistencies, referência do motor colunar"""
+    if df is None or df.empty:
+        return pd.DataFrame()
+    for col in ['cpf', 'num_cartao', 'nome']:
+        if col not in df.columns:
+            df[col] = ''
+    df_check = df.copy()
+    df_check['cpf_raw'] = df_check['cpf'].fillna('').astype(str).str.strip()
+    df_check['card_raw'] = df_check['num_cartao'].fillna('').astype(str).str.strip()
+    df_check['cpf_clean'] = df_check['cpf_raw'].str.replace(r'\D', '', regex=True)
+    df_check['card_clean'] = df_check['card_raw'].str.replace(r'^0+', '', regex=True).str.replace(r'\.0$', '', regex=True)
+    df_check['nome_clean'] = df_check['nome'].apply(app.remove_accents)
+    errors = []
+    for _, row in df_check.iterrows():
+        motivos = []
+        cpf_val = row['cpf_raw']
+        if not cpf_val or str(cpf_val).lower() == 'nan':
+            motivos.append("CPF NÃO INFORMADO")
+        card_val = row['card_raw']
+        if not card_val or str(card_val).lower() == 'nan':
+            motivos.append("CARTÃO NÃO INFORMADO")
+        if motivos:
+            errors.append({'ID': row.get('id', None), 'ARQUIVO': row.get('arquivo_origem', '-'),
+                           'LINHA': row.get('linha_arquivo', '-'), 'CPF': cpf_val if cpf_val else "VAZIO",
+                           'CARTÃO': card_val if card_val else "VAZIO", 'NOME': row.get('nome', '-'),
+                           'ERRO': " | ".join(motivos), 'TIPO_ERRO': 'AUSENCIA'})
+    df_valid = df_check[(df_check['cpf_clean'] != '') & (df_check['cpf_clean'].str.len() > 5)]
+    for _, group in df_valid.groupby('cpf_clean'):
+        has_card = len([c for c in group['card_clean'].unique() if c]) > 1
+        has_name = len([n for n in group['nome_clean'].unique() if n]) > 1
+        if has_card or has_name:
+            motivo = []
+            if has_card:
+                motivo.append(f"CONFLITO CARTÃO ({', '.join(map(str, group['num_cartao'].unique()))})")
+            if has_name:
+                motivo.append("CONFLITO NOME")
+            for _, row in group.iterrows():
+                errors.append({'ID': row.get('id', None), 'ARQUIVO': row.get('arquivo_origem', '-'),
+                               'LINHA': row.get('linha_arquivo', '-'), 'CPF': row.get('cpf', '-'),
+                               'CARTÃO': row.get('num_cartao', '-'), 'NOME': row.get('nome', '-'),
+                               'ERRO': " | ".join(motivo), 'TIPO_ERRO': 'DUPLICIDADE'})
+    for card, group in df_valid.groupby('card_clean'):
+        if not card: continue
+        cpfs = [c for c in group['cpf_clean'].unique() if c]
+        if len(cpfs) > 1:
+            for _, row in group.iterrows():
+                errors.append({'ID': row.get('id', None), 'ARQUIVO': row.get('arquivo_origem', '-'),
+                               'LINHA': row.get('linha_arquivo', '-'), 'CPF': row.get('cpf', '-'),
+                               'CARTÃO': row.get('num_cartao', '-'), 'NOME': row.get('nome', '-'),
+                               'ERRO': f"FRAUDE: CARTÃO USADO EM {len(cpfs)} CPFs", 'TIPO_ERRO': 'FRAUDE'})
+    if not errors: return pd.DataFrame()
+    res = pd.DataFrame(errors)
+    res['PRIORIDADE'] = res['TIPO_ERRO'].map({'AUSENCIA': 1, 'FRAUDE': 2, 'DUPLICIDADE': 3})
+    res = res.sort_values('PRIORIDADE')
+    return res.drop_duplicates(subset=['ARQUIVO', 'LINHA', 'CPF', 'CARTÃO', 'ERRO']).drop(columns=['PRIORIDADE', 'TIPO_ERRO'])
+
+
+def as_rows(df):
+    """Linhas como texto, sem depender da ordem (o sort original não é estável)"""
+    return sorted(map(tuple, df.astype(object).map(repr).to_numpy().tolist()))
+
+
+def random_frame(seed, n=400):
+    rng = np.random.default_rng(seed)
+    cpfs = ['123.456.789-00', '12345678900', '98765432100', '111.222.333-44', '', None, np.nan, '123', ' 55566677788 ']
+    cards = ['1001', '01001', '1001.0', '2002', '3003', '', None, np.nan, 4004, 5005.0]
+    nomes = ['José da Silva', 'Maria Souza', 'Ana Lima', '', None]
+    return pd.DataFrame({
+        'id': np.arange(1, n + 1),
+        'cpf': pd.Series(rng.choice(np.array(cpfs, dtype=object), n), dtype=object),
+        'num_cartao': pd.Series(rng.choice(np.array(cards, dtype=object), n), dtype=object),
+        'nome': pd.Series(rng.choice(np.array(nomes, dtype=object), n), dtype=object),
+        'arquivo_origem': 'lote.csv',
+        'linha_arquivo': np.arange(2, n + 2),
+    })
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_original_loop(app, seed):
+    df = random_frame(seed)
+    assert as_rows(app.detect_inconsistencies(df.copy())) == as_rows(reference_detect(app, df.copy()))
+
+
+@pytest.mark.parametrize('dtype', [object, 'string'])
+def test_card_conflict_message_keeps_missing_cards(app, dtype):
+    df = pd.DataFrame({
+        'cpf': pd.Series(['12345678900', '123.456.789-00', '12345678900'], dtype=dtype),
+        'num_cartao': pd.Series(['1001', None, '2002'], dtype=dtype),
+        'nome': ['Ana Lima'] * 3,
+        'arquivo_origem': 'lote.csv',
+        'linha_arquivo': [2, 3, 4],
+    })
+    got = app.detect_inconsistencies(df.copy())
+    missing = str(df['num_cartao'][1])
+    assert f"CONFLITO CARTÃO (1001, {missing}, 2002)" in set(got['ERRO'])
+    assert as_rows(got) == as_rows(reference_detect(app, df.copy()))
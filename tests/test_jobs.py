@@ -0,0 +1,54 @@
+import importlib.util
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CSV = "Projeto;Cartão;Nome;CPF;Valor\nPOT;1001;Ana Lima;12345678900;100,00\nPOT;2002;José Silva;98765432100;100,00\n"
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    spec = importlib.util.spec_from_file_location('pot_app', os.path.join(ROOT, 'app.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    mod.init_db()
+    return mod
+
+
+def new_job(app, tipo, usuario, status='na_fila'):
+    conn = app.get_db_connection()
+    job_id = conn.execute("INSERT INTO jobs (tipo, usuario, descricao, status) VALUES (?, ?, '', ?)", (tipo, usuario, status)).lastrowid
+    conn.commit()
+    conn.close()
+    return job_id
+
+
+def test_finished_jobs_are_pruned_per_user_and_type(app):
+    running = new_job(app, 'relatorio_pdf', 'a@x', 'executando')
+    other = [new_job(app, 'relatorio_pdf', 'b@x') for _ in range(2)]
+    ids = [new_job(app, 'relatorio_pdf', 'a@x') for _ in range(app.JOB_KEEP + 3)]
+    for job_id in other + ids:
+        app.run_job(job_id, 'x', lambda job: {'pdf': b'%PDF' * 1000}, {})
+
+    conn = app.get_db_connection()
+    left = [r[0] for r in conn.execute("SELECT id FROM jobs ORDER BY id")]
+    conn.close()
+    # Tarefa em andamento e as de outro usuário ficam; das terminadas, só as JOB_KEEP mais recentes
+    assert left == [running] + other + ids[-app.JOB_KEEP:]
+    assert app.get_job_result(ids[-1]) == {'pdf': b'%PDF' * 1000}
+
+
+def test_upload_ignores_repeated_file_names(app):
+    files = [app.JobFile('lote.csv', CSV.encode('utf-8')), app.JobFile('lote.csv', CSV.encode('utf-8'))]
+    layouts = {f.name: app.sniff_csv_layout(f) for f in files}
+    job = app.JobContext(new_job(app, 'upload', 'a@x'), 'a@x')
+
+    res = app.job_upload(job, files, layouts)
+    assert res['salvos'] == 2
+    assert any('repetido' in aviso for aviso in job.avisos)
+    conn = app.get_db_connection()
+    assert conn.execute("SELECT COUNT(*) FROM payments").fetchone()[0] == 2
+    conn.close()
@@ -0,0 +1,140 @@
+import importlib.util
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def app(tmp_path, monkeypatch):
+    """app.py com a base em tmp_path/dados e o processo rodando em outra pasta"""
+    (tmp_path / 'dados').mkdir()
+    (tmp_path / 'outra').mkdir()
+    monkeypatch.chdir(tmp_path / 'outra')
+    spec = importlib.util.spec_from_file_location('pot_app', os.path.join(ROOT, 'app.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    monkeypatch.setattr(mod, 'DB_FILE', str(tmp_path / 'dados' / 'pot.db'))
+    mod.init_db()
+    return mod
+
+
+def payments(rows):
+    return pd.DataFrame(rows, columns=['programa', 'num_cartao', 'nome', 'cpf', 'competencia', 'valor_pagto', 'arquivo_origem'])
+
+
+def write(app, func, *args):
+    conn = app.get_db_connection()
+    func(conn, *args)
+    conn.commit()
+    conn.close()
+
+
+def select_all(app):
+    return app.drop_match_keys(app.query_df("SELECT * FROM payments"), False)
+
+
+def test_snapshot_lives_next_to_the_database(app, tmp_path):
+    write(app, app.insert_payments, payments([('POT', '1001', 'Ana Lima', '12345678900', '01/2024', 100.0, 'a.csv')]))
+    assert app.refresh_payments_snapshot() is not None
+    assert os.path.exists(tmp_path / 'dados' / app.SNAPSHOT_DIR / 'atual.json')
+    assert not os.path.exists(tmp_path / 'outra' / app.SNAPSHOT_DIR)
+
+
+def wait_refresh(app):
+    thread = app.get_snapshot_refresher().thread
+    if thread is not None: thread.join(30)
+
+
+def test_reads_fall_back_to_sql_and_writes_refresh(app, monkeypatch):
+    refreshes = []
+    refresh = app.refresh_payments_snapshot
+    monkeypatch.setattr(app, 'refresh_payments_snapshot', lambda: refreshes.append(1) or refresh())
+
+    # Escrita numa tarefa: o fim da tarefa pede a atualização, que roda na thread
+    rows = payments([('POT', '1001', 'Ana Lima', '12345678900', '01/2024', 100.0, 'a.csv'),
+                     ('ABAE', '2002', 'José Silva', '98765432100', '02/2024', 50.0, 'a.csv')])
+    conn = app.get_db_connection()
+    job_id = conn.execute("INSERT INTO jobs (tipo, usuario, descricao, status) VALUES ('upload', 'a@x', '', 'na_fila')").lastrowid
+    conn.commit()
+    conn.close()
+    app.run_job(job_id, 'a@x', lambda job: write(app, app.insert_payments, rows), {})
+    wait_refresh(app)
+    assert refreshes and app.load_snapshot_manifest()['geracao'] == app.get_db_generation()
+    assert app.get_payments_by_programas(cached=False).equals(select_all(app))
+
+    # Escrita sem atualização: a página não usa o snapshot velho nem espera por ele
+    write(app, app.delete_payments, "programa = 'ABAE'")
+    refreshes.clear()
+    monkeypatch.setattr(app, 'refresh_payments_snapshot', lambda: refreshes.append(1))
+    got = app.get_payments_by_programas(cached=False)
+    assert got.equals(select_all(app)) and got['programa'].tolist() == ['POT']
+    wait_refresh(app)
+    assert refreshes == [1]
+
+
+def on_mmap(arr):
+    while arr is not None and not isinstance(arr, np.memmap):
+        arr = getattr(arr, 'base', None)
+    return arr is not None
+
+
+def test_reads_share_one_decoded_frame(app):
+    write(app, app.insert_payments, payments([
+        ('POT', '1001', 'Ana Lima', '12345678900', '01/2024', 100.0, 'a.csv'),
+        ('ABAE', '2002', 'José Silva', None, '02/2024', None, 'a.csv'),
+        ('POT', '3003', 'Maria Souza', '11122233344', '02/2024', 75.5, 'b.csv'),
+    ]))
+    app.refresh_payments_snapshot()
+    first, second = app.get_payments_by_programas(), app.get_payments_by_programas(['POT'])
+    assert first.equals(select_all(app))
+    assert second.equals(app.drop_match_keys(app.query_df("SELECT * FROM payments WHERE programa = 'POT'"), False))
+    assert app.get_payments_by_competencia('02/2024')['num_cartao'].tolist() == ['2002', '3003']
+    # Mesmo quadro em toda leitura, com as colunas numéricas no mmap; nada no cache de consultas
+    again = app.get_payments_by_programas()
+    assert again is not first and np.shares_memory(again['id'].to_numpy(), first['id'].to_numpy())
+    assert on_mmap(app.get_snapshot_frames().frame['id'].to_numpy())
+    assert app.get_query_cache().stats()['entradas'] == 0
+
+    # Segmento incremental (linha nova + linha alterada): mesmo resultado do SQLite
+    write(app, app.insert_payments, payments([('ABAE', '4004', 'Ana Lima', '12345678900', '03/2024', 10.0, 'c.csv')]))
+    write(app, lambda conn: conn.execute("UPDATE payments SET valor_pagto = 80.0 WHERE num_cartao = '1001'") and app.bump_generation(conn))
+    app.refresh_payments_snapshot()
+    assert len(app.load_snapshot_manifest()['segmentos']) == 2
+    assert app.get_payments_by_programas().equals(select_all(app))
+
+
+def count(app, sql):
+    conn = app.get_db_connection()
+    n = conn.execute(sql).fetchone()[0]
+    conn.close()
+    return n
+
+
+def test_bulk_deletes_skip_dirty_marks_and_rebuild(app):
+    write(app, app.insert_payments, payments([
+        ('POT', '1001', 'Ana Lima', '12345678900', '01/2024', 100.0, 'a.csv'),
+        ('POT', '2002', 'José Silva', '98765432100', '01/2024', 50.0, 'a.csv'),
+        ('ABAE', '3003', 'Maria Souza', '11122233344', '02/2024', 75.5, 'b.csv'),
+    ]))
+    app.refresh_payments_snapshot()
+
+    # Arquivo inteiro: nenhuma marca por linha e o gatilho volta para as outras exclusões
+    write(app, app.delete_payments, "arquivo_origem = ?", ('b.csv',), True)
+    assert count(app, "SELECT COUNT(*) FROM payments_snapshot_dirty") == 0
+    assert count(app, "SELECT COUNT(*) FROM sqlite_master WHERE name = 'trg_payments_snapshot_delete'") == 1
+    # Mesmo com o manifesto antigo ainda em disco, a atualização não segue por partes sem as marcas
+    write(app, app.insert_payments, payments([('ABAE', '4004', 'Ana Lima', '12345678900', '03/2024', 10.0, 'c.csv')]))
+    man = app.refresh_payments_snapshot()
+    assert len(man['segmentos']) == 1 and man['reset'] == 1
+    assert app.get_payments_by_programas().equals(select_all(app))
+
+    # RESET TOTAL (a geração fica com o chamador, como no botão)
+    write(app, lambda conn: app.delete_payments_untracked(conn) or app.bump_generation(conn))
+    assert count(app, "SELECT COUNT(*) FROM payments") == 0
+    assert count(app, "SELECT COUNT(*) FROM payments_snapshot_dirty") == 0
+    man = app.refresh_payments_snapshot()
+    assert man['linhas'] == 0 and man['reset'] == 2
@@ -0,0 +1,37 @@
+import importlib.util
+import os
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope='module')
+def app():
+    spec = importlib.util.spec_from_file_location('pot_app', os.path.join(ROOT, 'app.py'))
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def test_slow_reader_from_older_generation(app):
+    cache = app.QueryCache(1024 ** 2)
+    # Leitor lento começa na geração 1; uma escrita leva a base para a 2 e outra sessão já cacheou
+    cache.put(('a',), 2, 'novo')
+    cache.put(('b',), 1, 'velho')  # chega depois, com a geração antiga
+
+    assert cache.generation == 2
+    assert cache.get(('a',), 2) == (True, 'novo')
+    assert cache.get(('b',), 2) == (False, None)
+    # Leitura com a geração antiga não usa nem apaga o cache
+    assert cache.get(('a',), 1) == (False, None)
+    assert cache.get(('a',), 2) == (True, 'novo')
+
+
+def test_newer_generation_clears(app):
+    cache = app.QueryCache(1024 ** 2)
+    cache.put(('a',), 1, 'x')
+    assert cache.get(('a',), 2) == (False, None)
+    assert cache.stats()['entradas'] == 0 and cache.generation == 2
+    cache.put(('a',), 2, 'y')
+    assert cache.get(('a',), 2) == (True, 'y')